@@ -0,0 +1,235 @@
+# Offline benchmark runner: replays sample and synthetic queries against a stub LLM
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.stub_llm_server import StubLLMServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_QUERIES_PATH = os.path.join(ROOT, "src", "constants", "sample_queries.json")
+TITANIC_PATH = os.path.join(ROOT, "src", "data", "titanic.csv")
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+SYNTHETIC_SIZES = {"1m": 1_000_000, "10m": 10_000_000}
+
+SYNTHETIC_QUERIES = [
+    "hello",
+    "thanks",
+    "What is the average Fare?",
+    "How many rows have Survived equal to 1?",
+    "What was the survival rate by passenger class?",
+    "Show me a bar chart of passengers by embarkation port",
+    "Plot the distribution of Age",
+    "What percentage of passengers were female?",
+]
+
+
+def make_synthetic(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """Titanic-shaped data with n_rows rows, so the stub's pandas queries apply to it."""
+    rng = np.random.default_rng(seed)
+    age = rng.normal(30, 14, n_rows).clip(0.4, 80).round(1)
+    age[rng.random(n_rows) < 0.2] = np.nan
+    return pd.DataFrame({
+        "PassengerId": np.arange(1, n_rows + 1, dtype=np.int32),
+        "Survived": (rng.random(n_rows) < 0.38).astype(np.int8),
+        "Pclass": rng.choice(np.array([1, 2, 3], dtype=np.int8), n_rows, p=[0.24, 0.21, 0.55]),
+        "Sex": pd.Categorical(rng.choice(["male", "female"], n_rows, p=[0.65, 0.35])),
+        "Age": age.astype(np.float32),
+        "Fare": rng.gamma(1.5, 22.0, n_rows).round(2).astype(np.float32),
+        "Embarked": pd.Categorical(rng.choice(["S", "C", "Q"], n_rows, p=[0.72, 0.19, 0.09])),
+    })
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples)
+    return {
+        "count": int(len(values)),
+        "mean": round(float(values.mean()), 4),
+        "p50": round(float(np.percentile(values, 50)), 4),
+        "p95": round(float(np.percentile(values, 95)), 4),
+        "p99": round(float(np.percentile(values, 99)), 4),
+        "max": round(float(values.max()), 4),
+    }
+
+
+def peak_rss_mb() -> Dict[str, float]:
+    """Peak resident set size of this process and of its (sandbox) children."""
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    per_mb = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / per_mb, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / per_mb, 1),
+    }
+
+
+async def run_workload(name: str, questions: List[str], call, concurrency: int, repeat: int, stub: StubLLMServer) -> Dict:
+    """Run `call(question)` for every question `repeat` times with bounded concurrency."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(question: str):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                failed = await call(question)
+                errors += bool(failed)
+            except Exception as e:
+                errors += 1
+                print(f"  [{name}] error on {question!r}: {e}", file=sys.stderr)
+            latencies.append(time.perf_counter() - started)
+
+    stub.reset()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(q) for _ in range(repeat) for q in questions))
+    wall = time.perf_counter() - started
+    return {
+        "workload": name,
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 3) if wall else None,
+        "latency_seconds": percentiles(latencies),
+        "llm_calls": stub.stats(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+async def bench_dataset(label: str, df: pd.DataFrame, questions: List[str], args, stub: StubLLMServer) -> List[Dict]:
+    # Imported after the environment points the OpenAI clients at the stub
+    from src.modules.agent_langchain import ChatwithCSV
+    from src.modules.classifier_agent import ClassifierAgent, _classification_cache
+    from src.modules.fingerprint import fingerprint_dataframe
+    from src.modules.pipeline import answer_message
+
+    api_key = os.environ["OPENAI_API_KEY"]
+    results = []
+
+    started = time.perf_counter()
+    fingerprint = fingerprint_dataframe(df)
+    chatbots = {}
+    for flag in (False, True):
+        chatbots[flag] = ChatwithCSV(api_key, df, needs_visualization=flag, dataset_fingerprint=fingerprint, use_answer_cache=args.answer_cache)
+    setup_seconds = time.perf_counter() - started
+    print(f"[{label}] {len(df):,} rows, agents ready in {setup_seconds:.2f}s")
+
+    classifier = ClassifierAgent(api_key, use_local_classifier=args.local_classifier)
+
+    async def classify(question: str) -> bool:
+        await classifier.aclassify_message(question)
+        return False
+
+    async def get_chatbot(needs_visualization: bool):
+        return chatbots[needs_visualization]
+
+    async def pipeline(question: str) -> bool:
+        _, result = await answer_message(classifier, get_chatbot, question, speculative=args.speculative)
+        return result is not None and bool(result.get("error"))
+
+    for concurrency in args.concurrency:
+        _classification_cache.clear()
+        classify_result = await run_workload("classify", questions, classify, concurrency, args.repeat, stub)
+        _classification_cache.clear()
+        pipeline_result = await run_workload("pipeline", questions, pipeline, concurrency, args.repeat, stub)
+        for result in (classify_result, pipeline_result):
+            result.update({"dataset": label, "rows": int(len(df)), "setup_seconds": round(setup_seconds, 3)})
+            results.append(result)
+            latency = result["latency_seconds"]
+            print(
+                f"[{label}] {result['workload']:<8} c={concurrency:<3} n={result['requests']:<4} "
+                f"p50={latency.get('p50', 0):.3f}s p95={latency.get('p95', 0):.3f}s p99={latency.get('p99', 0):.3f}s "
+                f"rps={result['throughput_rps']} llm_calls={result['llm_calls']['total']} errors={result['errors']} "
+                f"rss={result['peak_rss_mb']['self']}MB"
+            )
+    return results
+
+
+def load_dataset(label: str, args) -> pd.DataFrame:
+    from src.modules.ingestion import read_csv_optimized
+
+    if label == "titanic":
+        df, _ = read_csv_optimized(TITANIC_PATH)
+        return df
+    n_rows = SYNTHETIC_SIZES.get(label)
+    if n_rows is None:
+        raise ValueError(f"Unknown dataset {label!r}; use titanic, {', '.join(SYNTHETIC_SIZES)}")
+    return make_synthetic(n_rows, seed=args.seed)
+
+
+async def main_async(args) -> Dict:
+    stub = StubLLMServer(latency_ms=args.latency_ms, chunk_latency_ms=args.chunk_latency_ms, seed=args.seed).start()
+    # Both litellm and the OpenAI SDK used by ChatOpenAI honour these
+    os.environ["OPENAI_BASE_URL"] = stub.base_url
+    os.environ["OPENAI_API_BASE"] = stub.base_url
+    os.environ["OPENAI_API_KEY"] = "stub-key"
+    # Stub completions must not land in the shared LLM cache, and repeated runs should measure real calls
+    os.environ["LLM_CACHE_ENABLED"] = "false"
+    print(f"Stub LLM at {stub.base_url} (latency {args.latency_ms} ms)")
+
+    with open(SAMPLE_QUERIES_PATH, "r", encoding="utf-8") as f:
+        questions = [q["question"] for q in json.load(f)] + SYNTHETIC_QUERIES
+
+    results = []
+    try:
+        for label in args.datasets:
+            df = load_dataset(label, args)
+            results.extend(await bench_dataset(label, df, questions, args, stub))
+            del df
+    finally:
+        stub.stop()
+
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline ChatwithCSV benchmarks against a stub LLM server")
+    parser.add_argument("--datasets", default="titanic,1m", help="Comma-separated: titanic, 1m, 10m")
+    parser.add_argument("--concurrency", default="1,8", help="Comma-separated concurrency levels")
+    parser.add_argument("--repeat", type=int, default=2, help="Times each question is replayed")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Stub latency per LLM request")
+    parser.add_argument("--chunk-latency-ms", type=float, default=2.0, help="Stub latency per streamed chunk")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--speculative", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--local-classifier", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--answer-cache", action=argparse.BooleanOptionalAction, default=False,
+                        help="Serve repeated questions from the answer cache (off to measure the full path)")
+    parser.add_argument("--output", default=None, help="JSON report path (default: benchmarks/results/<timestamp>.json)")
+    args = parser.parse_args(argv)
+    args.datasets = [d.strip() for d in args.datasets.split(",") if d.strip()]
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(main_async(args))
+    output = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# Deterministic OpenAI-compatible chat completions server for offline benchmarks
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# Pandas code the stub agent "writes" for a question, first match wins.
+# Column names follow titanic.csv, which the synthetic datasets mirror.
+AGENT_QUERIES = [
+    (re.compile(r"percent|percentage|male|female|gender|sex"), "df['Sex'].value_counts(normalize=True)"),
+    (re.compile(r"fare"), "df['Fare'].describe()"),
+    (re.compile(r"\bage|ages\b"), "df['Age'].dropna()"),
+    (re.compile(r"embark|port"), "df['Embarked'].value_counts()"),
+    (re.compile(r"class"), "df.groupby('Pclass')['Survived'].mean()"),
+    (re.compile(r"surviv"), "df['Survived'].value_counts()"),
+]
+DEFAULT_AGENT_QUERY = "df.describe()"
+
+CHART_RE = re.compile(r"chart|histogram|plot|graph|visuali[sz]|pie|bar")
+CHIT_CHAT_RE = re.compile(r"^\s*(hi|hello|hey|thanks|thank you|good (morning|afternoon|evening)|how are you)\b")
+
+STUB_PLOTLY_CODE = (
+    "numeric = df.select_dtypes('number').columns\n"
+    "fig = px.histogram(df, x=numeric[0] if len(numeric) else df.columns[0], title='Distribution')"
+)
+
+
+def _tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def _text(message: Dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return str(content)
+
+
+def _question(messages: List[Dict]) -> str:
+    """The user's question: the 'Current question:' line of the agent input, else the last user message."""
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            text = _text(message)
+            match = re.search(r"Current question:\s*(.+)", text)
+            if match:
+                return match.group(1).strip()
+            match = re.search(r"User message:\s*(.+)", text)
+            if match:
+                return match.group(1).strip()
+            return text.strip()
+    return ""
+
+
+class StubBrain:
+    """Decides the reply to a chat completions request. Stateless and deterministic."""
+
+    def reply(self, body: Dict) -> Tuple[str, Optional[str], Optional[List[Dict]]]:
+        """Return (kind, content, tool_calls)."""
+        messages = body.get("messages") or []
+        system = " ".join(_text(m) for m in messages if m.get("role") == "system").lower()
+        prompt = _text(messages[-1]) if messages else ""
+        tools = [t.get("function", {}).get("name") for t in body.get("tools") or []]
+
+        if tools:
+            return self._agent_reply(messages, tools)
+        if "classification" in system or (body.get("response_format") or {}).get("type") == "json_object":
+            return "classifier", self._classify(_question(messages)), None
+        if "visualization expert" in system:
+            return "plotly", STUB_PLOTLY_CODE, None
+        if "running summary" in prompt:
+            return "summary", "The user asked about the dataset; answers covered counts, rates and distributions.", None
+        return "other", "OK.", None
+
+    def _classify(self, question: str) -> str:
+        lowered = question.lower()
+        chit_chat = bool(CHIT_CHAT_RE.search(lowered))
+        return json.dumps({
+            "message_type": "chit_chat" if chit_chat else "data_query",
+            "needs_visualization": bool(CHART_RE.search(lowered)) and not chit_chat,
+            "reasoning": "stub",
+        })
+
+    def _agent_reply(self, messages: List[Dict], tools: List[str]):
+        question = _question(messages)
+        lowered = question.lower()
+        tool_results = [m for m in messages if m.get("role") == "tool"]
+        if not tool_results:
+            code = next((q for pattern, q in AGENT_QUERIES if pattern.search(lowered)), DEFAULT_AGENT_QUERY)
+            return "agent_tool", None, [self._tool_call("python_repl_ast", {"query": code})]
+        if len(tool_results) == 1 and "generate_plotly_visualization" in tools and CHART_RE.search(lowered):
+            return "agent_tool", None, [self._tool_call("generate_plotly_visualization", {
+                "query": question,
+                "data_output": _text(tool_results[0])[:500],
+                "dataframe_info": "see dataset profile",
+            })]
+        observation = " ".join(_text(tool_results[0]).split())[:200]
+        return "agent_answer", f"Based on the query result, here is the answer: {observation}", None
+
+    @staticmethod
+    def _tool_call(name: str, arguments: Dict) -> Dict:
+        return {
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": name, "arguments": json.dumps(arguments)},
+        }
+
+
+class StubLLMServer:
+    """Runs the stub on a background thread and counts calls per request kind.
+
+    Latency is a fixed delay per request plus a delay per streamed chunk, with
+    seeded jitter so runs are reproducible.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 50.0, chunk_latency_ms: float = 2.0, jitter: float = 0.1, seed: int = 0):
+        self.latency = latency_ms / 1000.0
+        self.chunk_latency = chunk_latency_ms / 1000.0
+        self.jitter = jitter
+        self.brain = StubBrain()
+        self.calls: Dict[str, int] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "StubLLMServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.calls, total=sum(self.calls.values()))
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+
+    def _delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency * (1 + self._random.uniform(-self.jitter, self.jitter)))
+
+    def _count(self, kind: str) -> None:
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, payload: Dict) -> None:
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/stats":
+                    self._send_json(200, server.stats())
+                else:
+                    self._send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path.rstrip("/") == "/reset":
+                    server.reset()
+                    self._send_json(200, {"ok": True})
+                    return
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send_json(404, {"error": "not found"})
+                    return
+
+                kind, content, tool_calls = server.brain.reply(body)
+                server._count(kind)
+                time.sleep(server._delay())
+                prompt_tokens = sum(_tokens(_text(m)) for m in body.get("messages") or [])
+                completion_tokens = _tokens(content or json.dumps(tool_calls))
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+                model = body.get("model", "stub")
+                if body.get("stream"):
+                    self._stream(model, content, tool_calls, usage, body.get("stream_options") or {})
+                    return
+                message = {"role": "assistant", "content": content}
+                if tool_calls:
+                    message["tool_calls"] = tool_calls
+                self._send_json(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+                    "usage": usage,
+                })
+
+            def _stream(self, model, content, tool_calls, usage, stream_options) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+                def send(delta, finish_reason=None, chunk_usage=None, choices=True):
+                    payload = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+                    payload["choices"] = [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if choices else []
+                    if chunk_usage is not None:
+                        payload["usage"] = chunk_usage
+                    self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+                send({"role": "assistant", "content": ""})
+                if tool_calls:
+                    for index, call in enumerate(tool_calls):
+                        send({"tool_calls": [dict(call, index=index)]})
+                else:
+                    for word in re.findall(r"\S+\s*", content or ""):
+                        time.sleep(server.chunk_latency)
+                        send({"content": word})
+                send({}, finish_reason="tool_calls" if tool_calls else "stop")
+                if stream_options.get("include_usage"):
+                    send(None, chunk_usage=usage, choices=False)
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic OpenAI-compatible stub server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--chunk-latency-ms", type=float, default=2.0)
+    args = parser.parse_args()
+    server = StubLLMServer(args.host, args.port, args.latency_ms, args.chunk_latency_ms)
+    print(f"Stub LLM server listening on {server.base_url} (set OPENAI_BASE_URL to this)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
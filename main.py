@@ -2,16 +2,22 @@
 
 import streamlit as st
 import os
-import time
 import re
 import json
 import pandas as pd
 from dotenv import load_dotenv
 from src import ChatwithCSV
+from src.modules.agent_pool import get_agent_pool
+from src.modules.chat_history import ChatHistoryManager
 from src.modules.classifier_agent import ClassifierAgent
+from src.modules.fingerprint import fingerprint_stream
+from src.modules.pipeline import astream_answer
+from src.modules.tracing import current_trace, stage, start_trace
+from src.modules.upload_cache import get_upload_cache
 from src.constants.prompts import CHIT_CHAT_RESPONSES
 import asyncio
 from src import get_logger
+from src.modules.logging_config import payload
 
 # Initialize logger for this module
 logger = get_logger(__name__)
@@ -26,6 +32,25 @@ def strip_base64_images_from_answer(text: str) -> str:
         return text or ""
     return STRIP_BASE64_IMAGE_RE.sub("", text).strip()
 
+
+# Rows of a pandas query result kept in the chat history; the current turn shows it in full
+HISTORY_RESULT_MAX_ROWS = 50
+
+
+def history_query_result(query_result):
+    """Bounded copy of a live query result for st.session_state.messages, or None if not pandas."""
+    if isinstance(query_result, (pd.DataFrame, pd.Series)):
+        return query_result.head(HISTORY_RESULT_MAX_ROWS).copy()
+    return None
+
+
+def render_query_output(query_output, query_result=None):
+    """Show the query result as a table when the live pandas object is available."""
+    if isinstance(query_result, (pd.DataFrame, pd.Series)):
+        st.dataframe(query_result, width='stretch')
+    elif query_output:
+        st.markdown(f"```\n{str(query_output)}\n```")
+
 # Load environment variables
 load_dotenv()
 
@@ -35,10 +60,30 @@ if not OPENAI_API_KEY:
     st.error("⚠️ OPENAI_API_KEY not found in .env file. Please create a .env file with your OpenAI API key.")
     st.stop()
 
+# Start the data agent concurrently with classification (cancelled for chit-chat)
+SPECULATIVE_EXECUTION = os.getenv("SPECULATIVE_EXECUTION", "true").lower() in ("1", "true", "yes")
+
+# Progress shown while the agent is calling a tool
+TOOL_PROGRESS_LABELS = {
+    "python_repl_ast": "Running pandas query...",
+    "generate_plotly_visualization": "Building chart...",
+}
+
 st.set_page_config(page_title="Interactive CSV Q&A Chatbot", layout="wide")
 
 st.title("Interactive CSV Q&A Chatbot")
 
+
+def release_chatbots():
+    """Return this session's pooled agents so they can be evicted once idle."""
+    for needs_visualization in (True, False):
+        chatbot_key = f"chatbot_{needs_visualization}"
+        lease = st.session_state.get(f"{chatbot_key}_lease")
+        if lease is not None:
+            lease.release()
+            st.session_state[f"{chatbot_key}_lease"] = None
+        st.session_state[chatbot_key] = None
+
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
@@ -52,13 +97,16 @@ if "df" not in st.session_state:
     # Load default CSV file
     default_csv_path = os.path.join("src", "data", "titanic.csv")
     try:
-        st.session_state.df = pd.read_csv(default_csv_path)
+        df, dataset_fingerprint, ingestion_report = get_upload_cache().load(default_csv_path)
+        st.session_state.df = df
+        st.session_state.dataset_fingerprint = dataset_fingerprint
+        st.session_state.ingestion_report = ingestion_report
         st.session_state.csv_uploaded = True
         st.session_state.default_csv_loaded = True
-        logger.info(f"Loaded default CSV file: {default_csv_path}")
+        logger.info("Loaded default CSV file: %s", default_csv_path)
     except Exception as e:
         st.error(f"Error loading default CSV file: {e}")
-        logger.error(f"Error loading default CSV: {e}")
+        logger.error("Error loading default CSV: %s", e)
         st.session_state.csv_uploaded = False
         st.session_state.default_csv_loaded = False
 
@@ -82,18 +130,37 @@ with st.sidebar:
 
     if uploaded_file:
         try:
-            df = pd.read_csv(uploaded_file)
-            st.session_state.df = df
-            st.session_state.csv_uploaded = True
-            st.session_state.default_csv_loaded = False
+            # Every rerun sees the same UploadedFile; only hash and parse when it is a new upload
+            upload_id = getattr(uploaded_file, "file_id", None) or (uploaded_file.name, uploaded_file.size)
+            if st.session_state.get("upload_id") != upload_id:
+                dataset_fingerprint = fingerprint_stream(uploaded_file)
+                if dataset_fingerprint != st.session_state.get("dataset_fingerprint"):
+                    df, dataset_fingerprint, ingestion_report = get_upload_cache().load(
+                        uploaded_file, fingerprint=dataset_fingerprint
+                    )
+                    st.session_state.df = df
+                    st.session_state.ingestion_report = ingestion_report
+                    st.session_state.dataset_fingerprint = dataset_fingerprint
+                    # Agents hold a reference to the old DataFrame; rebuild them on next use
+                    release_chatbots()
+                    logger.info("Uploaded file: %s", uploaded_file.name)
+                st.session_state.upload_id = upload_id
+                st.session_state.csv_uploaded = True
+                st.session_state.default_csv_loaded = False
             st.success(f"File `{uploaded_file.name}` uploaded successfully and will be used instead of default.")
-            logger.info(f"Uploaded file: {uploaded_file.name}")
         except Exception as e:
             st.error(f"Error reading the CSV file: {e}")
-            logger.error(f"Error reading CSV: {e}")
+            logger.error("Error reading CSV: %s", e)
 
     if st.session_state.csv_uploaded:
         st.info("✅ CSV file is ready for querying.")
+        ingestion_report = st.session_state.get("ingestion_report")
+        if ingestion_report:
+            st.caption(
+                f"Memory: {ingestion_report['memory_before_bytes'] / 1e6:.1f} MB → "
+                f"{ingestion_report['memory_after_bytes'] / 1e6:.1f} MB "
+                f"({ingestion_report['reduction_ratio']:.1f}x smaller after dtype optimization)"
+            )
     
     # Display DataFrame preview
     st.markdown("---")
@@ -116,9 +183,28 @@ async def initialize_chatbot(needs_visualization: bool = False):
     chatbot_key = f"chatbot_{needs_visualization}"
     if chatbot_key not in st.session_state or st.session_state.get(chatbot_key) is None:
         df = st.session_state.df
-        chatbot = ChatwithCSV(api_key=OPENAI_API_KEY, df=df, needs_visualization=needs_visualization)
-        st.session_state[chatbot_key] = chatbot
-        logger.info(f"Chatbot initialized successfully with OpenAI and Langchain agent (visualization: {needs_visualization}).")
+        dataset_fingerprint = st.session_state.get("dataset_fingerprint")
+        ingestion_report = st.session_state.get("ingestion_report") or {}
+        # Sessions on the same dataset share one agent from the process-wide pool. The
+        # lease lives in the session state, so it is also released when the session ends
+        lease = await get_agent_pool().alease(
+            dataset_fingerprint,
+            needs_visualization,
+            lambda: ChatwithCSV(
+                api_key=OPENAI_API_KEY,
+                df=df,
+                needs_visualization=needs_visualization,
+                dataset_fingerprint=dataset_fingerprint,
+            ),
+            dataset_bytes=ingestion_report.get("memory_after_bytes", 0),
+        )
+        st.session_state[chatbot_key] = lease.chatbot
+        st.session_state[f"{chatbot_key}_lease"] = lease
+        logger.info("Chatbot initialized successfully with OpenAI and Langchain agent (visualization: %s).", needs_visualization)
+    else:
+        lease = st.session_state.get(f"{chatbot_key}_lease")
+        if lease is not None:
+            lease.touch()
     return st.session_state[chatbot_key]
 
 # Chat tab
@@ -148,148 +234,151 @@ with tab_chat:
                         # Show query details for assistant messages
                         query_executed = content.get("query_executed")
                         query_output = content.get("query_output")
+                        query_result = content.get("query_result")
                         if query_executed:
                             with st.expander("🔍 View Query Executed", expanded=False):
                                 st.code(query_executed, language="python")
-                        if query_output:
+                        if query_output or query_result is not None:
                             with st.expander("📊 View Query Output", expanded=False):
-                                st.markdown(f"```\n{str(query_output)}\n```")
+                                render_query_output(query_output, query_result)
                 else:
                     # Old format - just display the string
                     st.markdown(content)
 
-        def response_generator(response):
-            for word in response.split():
-                yield word + " "
-                time.sleep(0.05)
-
         def normalize_text(text):
             return re.sub(r'[^\w\s]', '', text).lower().strip()
 
-        def get_chat_history_for_context(max_turns: int = 10):
-            """Build chat history from session messages for LLM context. Excludes the last message (current user prompt)."""
+        async def get_chat_history_for_context():
+            """Build token-budgeted chat history (rolling summary + recent turns). Excludes the current user prompt."""
             messages = st.session_state.get("messages", [])
             if len(messages) <= 1:
                 return []
+            if st.session_state.get("history_manager") is None:
+                st.session_state.history_manager = ChatHistoryManager(api_key=OPENAI_API_KEY)
             # Exclude the last message (current user message just appended)
-            previous = messages[:-1]
-            out = []
-            for m in previous[-max_turns * 2 :]:
-                role = m.get("role", "")
-                content = m.get("content", "")
-                if isinstance(content, dict):
-                    content = content.get("answer", str(content))
-                if role and content:
-                    out.append({"role": role, "content": str(content)[:500]})
-            return out
+            return await st.session_state.history_manager.abuild(messages[:-1])
 
         async def handle_user_input(prompt: str):
             st.session_state.messages.append({"role": "user", "content": prompt})
             with st.chat_message("user"):
                 st.markdown(prompt)
 
-            # Classify the message
-            classification = st.session_state.classifier.classify_message(prompt)
-            message_type = classification.get("message_type", "data_query")
-            needs_visualization = classification.get("needs_visualization", False)
-            
-            logger.info(f"Classification: {message_type}, needs_visualization: {needs_visualization}")
-
-            # Handle chit-chat messages
-            if message_type == "chit_chat":
-                normalized_prompt = normalize_text(prompt)
-                if normalized_prompt in CHIT_CHAT_RESPONSES:
-                    response = CHIT_CHAT_RESPONSES[normalized_prompt]
-                else:
-                    response = "Hello! How can I help you with your data analysis today?"
-                
-                st.session_state.messages.append({"role": "assistant", "content": response})
-                with st.chat_message("assistant"):
-                    st.markdown(response)
-            else:
-                # Handle data queries
-                with st.spinner("Thinking..."):
-                    try:
-                        # Initialize chatbot with visualization capability if needed
-                        chatbot = await initialize_chatbot(needs_visualization=needs_visualization)
-                        
-                        # Pass chat history for context (previous turns only; current prompt not in history yet)
-                        chat_history = get_chat_history_for_context()
-                        result = await chatbot.chat_with_a_df(prompt, chat_history=chat_history)
-                        # Handle both dict (new format) and string (old format) for backward compatibility
-                        if isinstance(result, dict):
-                            answer = result.get("answer", "I don't know")
-                            query_executed = result.get("query_executed")
-                            query_output = result.get("query_output")
-                            visualization_figure = result.get("visualization_figure")
-                            plotly_code = result.get("plotly_code")
-                            # When we embed Plotly directly, remove base64 image markdown from the answer
-                            if visualization_figure is not None:
-                                answer = strip_base64_images_from_answer(answer)
-                        else:
-                            # Fallback for old format
-                            answer = result
-                            query_executed = None
-                            query_output = None
-                            visualization_figure = None
-                            plotly_code = None
-                    except Exception as e:
-                        st.error(f"Error processing your request: {e}")
-                        logger.error(f"Error: {e}")
-                        import traceback
-                        logger.error(traceback.format_exc())
-                        answer = "I'm sorry, I couldn't process your request."
-                        query_executed = None
-                        query_output = None
-                        visualization_figure = None
-                        plotly_code = None
-
-                # Store message with query details
+            message_type = "data_query"
+            needs_visualization = False
+            result = None
+            with st.chat_message("assistant"):
+                progress_placeholder = st.empty()
+                message_placeholder = st.empty()
+                progress_placeholder.caption("Thinking...")
+                streamed = ""
+                try:
+                    # Pass chat history for context (previous turns only; current prompt not in history yet)
+                    with stage("history"):
+                        chat_history = await get_chat_history_for_context()
+                    trace = current_trace.get()
+                    async for event in astream_answer(
+                        st.session_state.classifier,
+                        initialize_chatbot,
+                        prompt,
+                        chat_history=chat_history,
+                        speculative=SPECULATIVE_EXECUTION,
+                    ):
+                        event_type = event["type"]
+                        if event_type == "classification":
+                            classification = event["classification"]
+                            message_type = classification.get("message_type", "data_query")
+                            needs_visualization = classification.get("needs_visualization", False)
+                            logger.info("Classification: %s, needs_visualization: %s", message_type, needs_visualization)
+                        elif event_type == "tool_start":
+                            # Text streamed before a tool call was an intermediate step, not the answer
+                            streamed = ""
+                            message_placeholder.empty()
+                            label = TOOL_PROGRESS_LABELS.get(event["tool"], f"Running {event['tool']}...")
+                            progress_placeholder.caption(label)
+                        elif event_type == "token":
+                            if trace is not None:
+                                trace.mark("first_token")
+                            streamed += event["content"]
+                            message_placeholder.markdown(streamed + "▌")
+                        elif event_type == "result":
+                            result = event["result"]
+                except Exception as e:
+                    st.error(f"Error processing your request: {e}")
+                    logger.error("Error: %s", e)
+                    import traceback
+                    logger.error(traceback.format_exc())
+                    result = {"answer": "I'm sorry, I couldn't process your request."}
+                progress_placeholder.empty()
+
+                # Handle chit-chat messages
+                if message_type == "chit_chat":
+                    normalized_prompt = normalize_text(prompt)
+                    if normalized_prompt in CHIT_CHAT_RESPONSES:
+                        response = CHIT_CHAT_RESPONSES[normalized_prompt]
+                    else:
+                        response = "Hello! How can I help you with your data analysis today?"
+                    st.session_state.messages.append({"role": "assistant", "content": response})
+                    message_placeholder.markdown(response)
+                    return
+
+                result = result if isinstance(result, dict) else {"answer": str(result) if result else "I don't know"}
+                answer = result.get("answer") or "I don't know"
+                query_executed = result.get("query_executed")
+                query_output = result.get("query_output")
+                query_result = result.get("query_result")
+                visualization_figure = result.get("visualization_figure")
+                plotly_code = result.get("plotly_code")
+                # When we embed Plotly directly, remove base64 image markdown from the answer
+                if visualization_figure is not None:
+                    answer = strip_base64_images_from_answer(answer)
+
+                # Store message with query details; history keeps only the first rows of the result
                 message_content = {
                     "answer": answer,
                     "query_executed": query_executed,
                     "query_output": query_output,
+                    "query_result": history_query_result(query_result),
                     "visualization_figure": visualization_figure,
                     "plotly_code": plotly_code,
                     "needs_visualization": needs_visualization
                 }
                 st.session_state.messages.append({"role": "assistant", "content": message_content})
 
-                with st.chat_message("assistant"):
-                    # Display the answer as markdown
-                    message_placeholder = st.empty()
-                    full_response = ""
-                    for word in response_generator(answer):
-                        full_response += word
-                        message_placeholder.markdown(full_response + "▌")
-                    message_placeholder.markdown(full_response)
-                    
+                with stage("render"):
+                    # Replace the streamed text with the final answer
+                    message_placeholder.markdown(answer)
+
                     # Display visualization if available
                     if visualization_figure is not None:
                         st.plotly_chart(visualization_figure, use_container_width=True)
                         logger.info("Displayed plotly visualization")
-                    
+
                     # Display query executed and output in expandable sections
                     if query_executed:
                         with st.expander("🔍 View Query Executed", expanded=False):
                             st.code(query_executed, language="python")
-                        logger.debug(f"Displayed query_executed: {query_executed[:100] if query_executed else None}")
+                        logger.debug("Displayed query_executed: %s", payload(query_executed, 100))
                     else:
-                        logger.warning(f"query_executed is None or empty for prompt: {prompt}")
-                    
-                    if query_output:
+                        logger.warning("query_executed is None or empty for prompt: %s", prompt)
+
+                    if query_output or query_result is not None:
                         with st.expander("📊 View Query Output", expanded=False):
-                            # Display as markdown code block for better formatting
-                            st.markdown(f"```\n{str(query_output)}\n```")
-                        logger.debug(f"Displayed query_output (length): {len(str(query_output))}")
+                            # Live DataFrame/Series render as a table; other results as a code block
+                            render_query_output(query_output, query_result)
+                        logger.debug("Displayed query_output: %s", payload(query_output, 200))
                     else:
-                        logger.warning(f"query_output is None or empty for prompt: {prompt}")
-                    
-                        logger.info(f"User prompt: {prompt} | Response: {answer}")
+                        logger.warning("query_output is None or empty for prompt: %s", prompt)
+
+                logger.info("User prompt: %s | Response: %s", prompt, payload(answer))
+
+        async def handle_traced_user_input(prompt: str):
+            # Stage timings, LLM calls and tokens of this request go to logs/traces.jsonl
+            with start_trace("chat", speculative=SPECULATIVE_EXECUTION, dataset=st.session_state.get("dataset_fingerprint")):
+                await handle_user_input(prompt)
 
         prompt = st.chat_input(placeholder="Ask me anything about your CSV data...")
         if prompt:
-            asyncio.run(handle_user_input(prompt))
+            asyncio.run(handle_traced_user_input(prompt))
 
 # FAQs tab
 with tab_faqs:
@@ -328,7 +417,7 @@ with tab_samples:
                 st.session_state.sample_queries = []
         else:
             st.warning(f"JSON file not found at path: {json_file_path}")
-            logger.warning(f"Sample queries JSON file not found at: {json_file_path}")
+            logger.warning("Sample queries JSON file not found at: %s", json_file_path)
             st.session_state.sample_queries = []
     
     sample_queries = st.session_state.get("sample_queries", [])
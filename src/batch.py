@@ -0,0 +1,328 @@
+# Batch question answering over one CSV (run with `python -m src.batch`)
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Dict, Iterable, Iterator, Optional, Set
+from dotenv import load_dotenv
+from .modules.agent_langchain import ChatwithCSV
+from .modules.classifier_agent import ClassifierAgent
+from .modules.logging_config import get_logger
+from .modules.upload_cache import get_upload_cache
+
+load_dotenv()
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "3"))
+BATCH_BACKOFF_SECONDS = float(os.getenv("BATCH_BACKOFF_SECONDS", "2.0"))
+BATCH_MAX_BACKOFF_SECONDS = 60.0
+
+logger = get_logger(__name__)
+
+
+def read_questions(path: str) -> Iterator[Dict]:
+    """
+    Read questions from a JSONL file, one per line.
+
+    A line is either a JSON object with "question" (and optional "id", "chat_history",
+    "needs_visualization") or a JSON string. Blank lines are skipped, and so are
+    malformed lines and lines without a question, with a warning.
+
+    Args:
+        path: Path to the JSONL file
+
+    Yields:
+        dict: {"id", "question", ...}; id defaults to the line number
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning("Skipping line %s of %s: invalid JSON (%s)", line_number, path, e)
+                continue
+            if isinstance(item, str):
+                item = {"question": item}
+            if not isinstance(item, dict) or not item.get("question"):
+                logger.warning("Skipping line %s of %s: no question", line_number, path)
+                continue
+            item.setdefault("id", line_number)
+            yield item
+
+
+def completed_ids(path: str) -> Set[str]:
+    """Ids already answered without error in an output file, for resuming a batch."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A partial last line from an interrupted run
+                continue
+            if not record.get("error"):
+                done.add(str(record.get("id")))
+    return done
+
+
+class BatchRunner:
+    """Answers many questions about one dataset with a fixed number of concurrent agent runs.
+
+    Both agents (with and without visualization tooling) are built once and shared
+    by all workers. Concurrent questions do not see each other's code: each agent run
+    has its own REPL namespace with a shallow copy of the dataset, in the sandbox or
+    in-process, so in-place edits by one question never reach another. Failed questions (exceptions or results carrying 'error') are
+    retried with exponential backoff and jitter. Each result is appended to the
+    output as soon as it completes.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        df,
+        dataset_fingerprint: Optional[str] = None,
+        concurrency: int = BATCH_CONCURRENCY,
+        max_retries: int = BATCH_MAX_RETRIES,
+        backoff_seconds: float = BATCH_BACKOFF_SECONDS,
+        visualize: str = "auto",
+        include_figures: bool = False,
+        engine: str = "pandas",
+        source_path: Optional[str] = None,
+    ):
+        if visualize not in ("auto", "always", "never"):
+            raise ValueError("visualize must be 'auto', 'always' or 'never'")
+        self.logger = get_logger(__name__)
+        self.api_key = api_key
+        self.df = df
+        self.dataset_fingerprint = dataset_fingerprint
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max(0, max_retries)
+        self.backoff_seconds = backoff_seconds
+        self.visualize = visualize
+        self.include_figures = include_figures
+        self.engine = engine
+        self.source_path = source_path
+        self.classifier = ClassifierAgent(api_key=api_key) if visualize == "auto" else None
+        self._chatbots: Dict[bool, ChatwithCSV] = {}
+        self.stats = {"completed": 0, "failed": 0, "retries": 0}
+
+    def _chatbot(self, needs_visualization: bool) -> ChatwithCSV:
+        chatbot = self._chatbots.get(needs_visualization)
+        if chatbot is None:
+            chatbot = ChatwithCSV(
+                api_key=self.api_key,
+                df=self.df,
+                needs_visualization=needs_visualization,
+                dataset_fingerprint=self.dataset_fingerprint,
+                engine=self.engine,
+                source_path=self.source_path,
+            )
+            self._chatbots[needs_visualization] = chatbot
+        return chatbot
+
+    async def _needs_visualization(self, item: Dict) -> bool:
+        if "needs_visualization" in item:
+            return bool(item["needs_visualization"])
+        if self.visualize != "auto":
+            return self.visualize == "always"
+        classification = await self.classifier.aclassify_message(item["question"])
+        return bool(classification.get("needs_visualization", False))
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.backoff_seconds * (2 ** attempt), BATCH_MAX_BACKOFF_SECONDS)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _record(self, item: Dict, result: Optional[Dict], error: Optional[str], attempts: int, started: float) -> Dict:
+        result = result or {}
+        query_output = result.get("query_output")
+        record = {
+            "id": item["id"],
+            "question": item["question"],
+            "answer": result.get("answer"),
+            "query_executed": result.get("query_executed"),
+            "query_output": None if query_output is None else str(query_output),
+            "plotly_code": result.get("plotly_code"),
+            "cached": bool(result.get("cached", False)),
+            "error": error,
+            "attempts": attempts,
+            "duration_seconds": round(time.perf_counter() - started, 3),
+        }
+        figure = result.get("visualization_figure")
+        if self.include_figures and figure is not None:
+            record["figure_json"] = figure.to_json()
+        return record
+
+    async def answer(self, item: Dict) -> Dict:
+        """
+        Answer one question, retrying failures.
+
+        Args:
+            item: {"id", "question", "chat_history"?, "needs_visualization"?}
+
+        Returns:
+            dict: Output record; 'error' is set if every attempt failed
+        """
+        started = time.perf_counter()
+        result, error = None, None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats["retries"] += 1
+                delay = self._backoff(attempt - 1)
+                self.logger.info("Retrying question %s in %.1fs (attempt %s): %s", item["id"], delay, attempt + 1, error)
+                await asyncio.sleep(delay)
+            try:
+                chatbot = self._chatbot(await self._needs_visualization(item))
+                result = await chatbot.chat_with_a_df(item["question"], chat_history=item.get("chat_history"))
+                error = (result or {}).get("error") if result is not None else "No result"
+            except Exception as e:
+                result, error = None, f"{type(e).__name__}: {e}"
+            if not error:
+                return self._record(item, result, None, attempt + 1, started)
+        return self._record(item, result, error, self.max_retries + 1, started)
+
+    async def run(self, items: Iterable[Dict], output_path: str, resume: bool = False) -> Dict:
+        """
+        Answer every question and append one JSON line per result to output_path.
+
+        Args:
+            items: Question dicts, e.g. from read_questions; consumed lazily
+            output_path: JSONL file results are appended to as they complete
+            resume: Skip questions whose id already has a successful record in output_path
+
+        Returns:
+            dict: Counts of completed, failed, skipped and retried questions and the wall time
+        """
+        skip = completed_ids(output_path) if resume else set()
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        # Build the shared agents before workers start, so they are not built concurrently
+        if self.visualize != "always":
+            self._chatbot(False)
+        if self.visualize != "never":
+            self._chatbot(True)
+
+        iterator = iter(items)
+        skipped = 0
+        started = time.perf_counter()
+
+        def next_item() -> Optional[Dict]:
+            nonlocal skipped
+            for item in iterator:
+                if str(item["id"]) in skip:
+                    skipped += 1
+                    continue
+                return item
+            return None
+
+        with open(output_path, "a" if resume else "w", encoding="utf-8") as out:
+
+            async def worker():
+                # Questions are pulled one at a time, so inputs of any size use constant memory
+                while (item := next_item()) is not None:
+                    record = await self.answer(item)
+                    out.write(json.dumps(record, default=str) + "\n")
+                    out.flush()
+                    if record["error"]:
+                        self.stats["failed"] += 1
+                        self.logger.warning("Question %s failed: %s", item["id"], record["error"])
+                    else:
+                        self.stats["completed"] += 1
+                    done = self.stats["completed"] + self.stats["failed"]
+                    if done % 50 == 0:
+                        self.logger.info("Batch progress: %s answered, %s failed", self.stats["completed"], self.stats["failed"])
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        summary = dict(self.stats, skipped=skipped, wall_seconds=round(time.perf_counter() - started, 3))
+        self.logger.info("Batch finished: %s", summary)
+        return summary
+
+
+async def run_batch(
+    csv_path: str,
+    questions_path: str,
+    output_path: str,
+    api_key: Optional[str] = None,
+    concurrency: int = BATCH_CONCURRENCY,
+    max_retries: int = BATCH_MAX_RETRIES,
+    backoff_seconds: float = BATCH_BACKOFF_SECONDS,
+    visualize: str = "auto",
+    include_figures: bool = False,
+    resume: bool = False,
+    engine: str = "pandas",
+) -> Dict:
+    """
+    Answer every question of a JSONL file about a CSV, streaming results to a JSONL file.
+
+    Args:
+        csv_path: The dataset
+        questions_path: JSONL questions (see read_questions)
+        output_path: JSONL results, written as each question completes
+        api_key: OpenAI API key (defaults to OPENAI_API_KEY)
+        concurrency: Questions answered at once
+        max_retries: Retries per failed question
+        backoff_seconds: Base delay of the exponential backoff between retries
+        visualize: 'auto' (classifier decides), 'always' or 'never'
+        include_figures: Store the Plotly figure JSON in each record
+        resume: Skip questions already answered in output_path
+        engine: 'pandas' loads the CSV into memory; 'duckdb' queries the file in place with SQL
+
+    Returns:
+        dict: Batch summary (see BatchRunner.run)
+    """
+    df, dataset_fingerprint = None, None
+    if engine == "pandas":
+        df, dataset_fingerprint, _ = await asyncio.to_thread(get_upload_cache().load, csv_path)
+    runner = BatchRunner(
+        api_key or os.getenv("OPENAI_API_KEY", ""),
+        df,
+        dataset_fingerprint=dataset_fingerprint,
+        concurrency=concurrency,
+        max_retries=max_retries,
+        backoff_seconds=backoff_seconds,
+        visualize=visualize,
+        include_figures=include_figures,
+        engine=engine,
+        source_path=csv_path,
+    )
+    return await runner.run(read_questions(questions_path), output_path, resume=resume)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions about a CSV")
+    parser.add_argument("--csv", required=True, help="Dataset to query (CSV, or Parquet with --engine duckdb)")
+    parser.add_argument("--questions", required=True, help="JSONL file of questions")
+    parser.add_argument("--output", required=True, help="JSONL file results are appended to")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--retries", type=int, default=BATCH_MAX_RETRIES)
+    parser.add_argument("--backoff", type=float, default=BATCH_BACKOFF_SECONDS, help="Base retry delay in seconds")
+    parser.add_argument("--visualize", choices=("auto", "always", "never"), default="auto")
+    parser.add_argument("--include-figures", action="store_true", help="Store Plotly figure JSON in the output")
+    parser.add_argument("--resume", action="store_true", help="Skip questions already answered in --output")
+    parser.add_argument("--engine", choices=("pandas", "duckdb"), default="pandas",
+                        help="duckdb queries the file in place, for datasets larger than memory")
+    args = parser.parse_args()
+    summary = asyncio.run(run_batch(
+        args.csv,
+        args.questions,
+        args.output,
+        concurrency=args.concurrency,
+        max_retries=args.retries,
+        backoff_seconds=args.backoff,
+        visualize=args.visualize,
+        include_figures=args.include_figures,
+        resume=args.resume,
+        engine=args.engine,
+    ))
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
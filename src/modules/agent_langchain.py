@@ -2,12 +2,36 @@
 
 import asyncio
 import json
+import uuid
 import pandas as pd
+from typing import AsyncIterator, Dict
+from langchain_classic.agents import AgentExecutor, create_tool_calling_agent
 from langchain_experimental.agents import create_pandas_dataframe_agent
-from langchain_openai import ChatOpenAI
 from langchain_core.callbacks import BaseCallbackHandler
-from .logging_config import get_logger  # Ensure correct relative import
-from .plotly_tool import PlotlyVisualizationTool
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.tools import StructuredTool
+from pydantic import BaseModel, Field
+from .answer_cache import AnswerCache, get_answer_cache
+from .chart_templates import build_template_chart
+from .chat_history import HISTORY_MAX_TOKENS, trim_history
+from .dataset_profile import get_dataset_profile
+from .duckdb_engine import DUCKDB_MAX_RESULT_ROWS, DUCKDB_TABLE, DuckDBQueryError, get_duckdb_dataset
+from .fingerprint import fingerprint_dataframe
+from .llm_cache import CachedChatOpenAI, get_langchain_llm_cache
+from .logging_config import get_logger, payload  # Ensure correct relative import
+from .plot_cache import describe_result_schema
+from .plotly_tool import PlotlyVisualizationTool, result_frame_info, result_to_frame
+from .run_store import current_run_id, figure_store, format_result, result_store
+from .sandbox import SANDBOX_ENABLED, SandboxError, SandboxPool, _run_repl, get_sandbox_pool
+from .tracing import TracingCallbackHandler, current_trace, stage
+
+# Wall-clock limit on one agent run
+AGENT_TIMEOUT_SECONDS = 120.0
+
+# pandas: the whole dataset is loaded into a DataFrame and queried with Python.
+# duckdb: the CSV/Parquet file is queried in place with SQL; only results are loaded.
+ENGINES = ("pandas", "duckdb")
 
 
 def _extract_json_from_observation(observation_str: str):
@@ -60,35 +84,41 @@ def _get_observation_string(observation):
     return str(observation).strip()
 
 
-def _format_chat_history_for_input(chat_history: list, current_question: str, max_history_chars: int = 2500) -> str:
-    """Format chat history and current question into a single input string for the agent."""
+def _format_chat_history_for_input(chat_history: list, current_question: str, max_history_tokens: int = HISTORY_MAX_TOKENS) -> str:
+    """
+    Format chat history and current question into a single input string for the agent.
+
+    History is expected to be budgeted already (see ChatHistoryManager); trimming to
+    max_history_tokens here only guards callers that pass raw history. A leading
+    system message carries the summary of older turns.
+    """
     if not chat_history:
         return current_question
     lines = ["Previous conversation:"]
-    total = 0
-    for m in chat_history:
-        if total >= max_history_chars:
-            break
+    for m in trim_history(chat_history, max_history_tokens):
         role = (m.get("role") or "").strip().lower()
-        content = (m.get("content") or "").strip()
-        if not content:
+        if role == "system":
+            lines.append(m["content"])
             continue
         prefix = "User" if role == "user" else "Assistant"
-        line = f"{prefix}: {content}"
-        if total + len(line) > max_history_chars:
-            line = line[: max_history_chars - total - 4] + "..."
-        lines.append(line)
-        total += len(line)
+        lines.append(f"{prefix}: {m['content']}")
     lines.append("")
     lines.append(f"Current question: {current_question}")
     return "\n".join(lines)
 
 
 class QueryCaptureCallback(BaseCallbackHandler):
-    """Callback to capture the pandas query executed and its output (not the plotly tool)."""
-    def __init__(self):
+    """Callback to capture the pandas/SQL query executed and its output (not the plotly tool).
+
+    The REPL and SQL tools return the live result object (DataFrame/Series/scalar); it is kept
+    as-is in query_result and published to the run's result store, and query_output
+    holds a bounded text rendering for display.
+    """
+    def __init__(self, run_id: str = None):
+        self.run_id = run_id
         self.query_executed = None
         self.query_output = None
+        self.query_result = None
         self.logger = None
         self._skip_next_output = False
         
@@ -103,7 +133,7 @@ class QueryCaptureCallback(BaseCallbackHandler):
         else:
             self.query_executed = str(input_str)
         if self.logger:
-            self.logger.debug(f"Captured query: {self.query_executed}")
+            self.logger.debug("Captured query: %s", payload(self.query_executed))
     
     def on_tool_end(self, output, **kwargs):
         """Capture the tool output only for the pandas/repl tool."""
@@ -111,34 +141,88 @@ class QueryCaptureCallback(BaseCallbackHandler):
             self._skip_next_output = False
             return
         self._skip_next_output = False
-        self.query_output = str(output)
+        self.query_result = output
+        self.query_output = format_result(output)
+        if self.run_id is not None:
+            result_store.put(self.run_id, "query_result", output)
         if self.logger:
-            self.logger.debug(f"Captured output (first 200 chars): {self.query_output[:200]}")
+            self.logger.debug("Captured output: %s", payload(self.query_output, 200))
 
 class ChatwithCSV:
-    def __init__(self, api_key: str, df: pd.DataFrame, needs_visualization: bool = False) -> None:
+    def __init__(
+        self,
+        api_key: str,
+        df: pd.DataFrame = None,
+        needs_visualization: bool = False,
+        dataset_fingerprint: str = None,
+        use_answer_cache: bool = True,
+        use_sandbox: bool = SANDBOX_ENABLED,
+        use_llm_cache: bool = True,
+        engine: str = "pandas",
+        source_path: str = None,
+    ) -> None:
+        """
+        Args:
+            api_key: OpenAI API key
+            df: The dataset (pandas engine)
+            needs_visualization: Give the agent the Plotly tool
+            dataset_fingerprint: Identity of the dataset, if already known
+            use_answer_cache: Serve repeated questions from the answer cache
+            use_sandbox: Run generated pandas/Plotly code in the sandbox pool (pandas engine)
+            use_llm_cache: Serve repeated LLM calls from the completion cache
+            engine: 'pandas' or 'duckdb'
+            source_path: CSV or Parquet file queried in place (duckdb engine)
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"engine must be one of {', '.join(ENGINES)}")
+        if engine == "duckdb" and not source_path:
+            raise ValueError("The duckdb engine needs source_path")
+        if engine == "pandas" and df is None:
+            raise ValueError("The pandas engine needs df")
         self.logger = get_logger(__name__)
         self.api_key = api_key
         self.df = df
+        self.engine = engine
         self.openai_model = "gpt-4o-mini"
         self.needs_visualization = needs_visualization
+        self._dataset_fingerprint = dataset_fingerprint
+        self.answer_cache = get_answer_cache() if use_answer_cache else None
+        self.duckdb = None
+        if engine == "duckdb":
+            self.duckdb = get_duckdb_dataset(source_path, dataset_fingerprint)
+            self._dataset_fingerprint = self.duckdb.fingerprint
+            # Only capped query results reach Python, so chart code runs in-process on them
+            use_sandbox = False
+        # Generated pandas/Plotly code runs in worker processes with resource limits
+        self.use_sandbox = use_sandbox
+        # In-process REPL variables of each run, keyed by run id
+        self._namespaces: Dict[str, Dict] = {}
+
+        # Schema, null counts, ranges and top values, computed once per dataset, so the
+        # agent doesn't spend tool iterations on df.head()/df.info()
+        if self.duckdb is not None:
+            self.dataset_profile = self.duckdb.profile()
+        else:
+            self.dataset_profile = get_dataset_profile(df, self.dataset_fingerprint)
         
         # Initialize plotly tool if visualization is needed
         self.plotly_tool = None
         self.plotly_tool_instance = None
         if needs_visualization:
-            self.plotly_tool_instance = PlotlyVisualizationTool(api_key=api_key)
-            self.plotly_tool = self.plotly_tool_instance.create_langchain_tool(df=df)
+            self.plotly_tool_instance = self._get_plotly_tool()
+            self.plotly_tool = self.plotly_tool_instance.create_langchain_tool(df=df, dataframe_info=self.dataset_profile)
         
         # Update instruction based on visualization capability
-        if needs_visualization:
+        if self.duckdb is not None:
+            self.instruction = self._sql_instruction(needs_visualization)
+        elif needs_visualization:
             self.instruction = (
                 "You are an excellent data analyst who can answer questions based on a given pandas dataframe. "
                 "You have two kinds of tools: (1) a Python REPL to run pandas queries on the dataframe 'df', and (2) generate_plotly_visualization to create charts. "
                 "When the user asks for a visualization, chart, graph, or histogram you MUST do the following in order: "
                 "STEP 1: Run a pandas query to get the relevant data (e.g. for a histogram of ages run df['Age'].dropna(); for counts by category run the appropriate groupby/value_counts). "
                 "Use the full dataset so the chart is meaningful, not just a few rows. "
-                "STEP 2: Call generate_plotly_visualization with 'query' (user question), 'data_output' (the exact string output from your pandas query in STEP 1), and 'dataframe_info' (e.g. df.columns.tolist() and df.info() or describe). "
+                "STEP 2: Call generate_plotly_visualization with 'query' (user question), 'data_output' (the exact string output from your pandas query in STEP 1), and 'dataframe_info' (a short note; the dataset profile below is passed to the tool automatically). "
                 "Do not call generate_plotly_visualization with only a sample or head(); always pass the result of a query that gets the data needed for the chart. "
                 "After the visualization tool succeeds, respond with ONE short sentence (e.g. 'Here is the histogram of ages.'). "
                 "Do not generate or embed any image or base64 in your response; the app will display the chart. "
@@ -149,16 +233,30 @@ class ChatwithCSV:
                 "You are an excellent data analyst who can answer questions based on a given pandas dataframe. "
                 "If you cannot figure out the answer, just politely say `The given context does not provide answer to the following problem`."
             )
+        inspect = "SELECT * ... LIMIT or DESCRIBE" if self.duckdb is not None else "df.head(), df.info() or df.columns"
+        self.instruction += (
+            f"\n\nDataset profile of 'df' (already computed; do not run {inspect} just to inspect it):\n"
+            + self.dataset_profile
+        )
         
-        self.logger.debug(f"Initializing ChatwithCSV with OpenAI and Langchain agent (visualization: {needs_visualization})")
+        self.logger.debug("Initializing ChatwithCSV with OpenAI and Langchain agent (visualization: %s)", needs_visualization)
 
-        self.llm = ChatOpenAI(
+        self.llm = CachedChatOpenAI(
             temperature=0,
             model=self.openai_model,
             openai_api_key=self.api_key,
-            streaming=True
+            streaming=True,
+            # Token usage on streamed responses, for tracing
+            stream_usage=True,
+            # Identical agent steps are served from the LLM cache shared by all processes
+            cache=(get_langchain_llm_cache() if use_llm_cache else None) or False,
         )
         
+        if self.duckdb is not None:
+            self.agent_executor = self._create_sql_agent()
+            self.logger.debug("Initialized DuckDB SQL agent executor")
+            return
+
         # Create agent with optional plotly tool (max_iterations to avoid timeout)
         agent_kwargs = {
             "llm": self.llm,
@@ -169,6 +267,7 @@ class ChatwithCSV:
             "prefix": self.instruction,
             "max_iterations": 10,
             "max_execution_time": 90.0,
+            "return_intermediate_steps": True,
         }
         
         # Add extra_tools if visualization is needed
@@ -177,187 +276,522 @@ class ChatwithCSV:
             self.logger.debug("Added Plotly visualization tool to agent")
         
         self.agent_executor = create_pandas_dataframe_agent(**agent_kwargs)
+        if self.use_sandbox:
+            self._use_sandboxed_repl()
+        else:
+            self._use_isolated_repl()
         self.logger.debug("Initialized OpenAI agent executor with Langchain")
 
-    async def chat_with_a_df(self, question: str, chat_history: list = None) -> dict:
+    @property
+    def dataset_fingerprint(self) -> str:
         """
-        Process a question and return both the answer and execution details.
+        Identity of the dataset, used as the key prefix of every downstream cache.
+
+        Callers that loaded the data from a file should pass the fingerprint of the raw
+        bytes (see fingerprint.fingerprint_stream); otherwise it is computed from the
+        DataFrame on first use.
+        """
+        if self._dataset_fingerprint is None:
+            self._dataset_fingerprint = fingerprint_dataframe(self.df)
+        return self._dataset_fingerprint
+
+    @staticmethod
+    def _sql_instruction(needs_visualization: bool) -> str:
+        instruction = (
+            "You are an excellent data analyst who can answer questions about a dataset stored in DuckDB as the table 'df'. "
+            "Use the sql_query tool to run one read-only DuckDB SQL SELECT per call. The table can be far larger than memory: "
+            "select only the columns you need, filter in WHERE and aggregate (GROUP BY, COUNT, AVG, ...) in SQL rather than fetching raw rows. "
+            f"Results are capped at {DUCKDB_MAX_RESULT_ROWS} rows. "
+        )
+        if needs_visualization:
+            instruction += (
+                "You also have generate_plotly_visualization to create charts. "
+                "When the user asks for a visualization, chart, graph, or histogram you MUST do the following in order: "
+                "STEP 1: Run a SQL query that returns the data for the chart, aggregated where possible "
+                "(e.g. counts per category with GROUP BY, or binned values for a histogram). "
+                "STEP 2: Call generate_plotly_visualization with 'query' (user question), 'data_output' (the exact output of your query in STEP 1), and 'dataframe_info' (a short note). "
+                "The chart is drawn from the result of your last query, so query the data the chart needs, not a sample. "
+                "After the visualization tool succeeds, respond with ONE short sentence (e.g. 'Here is the histogram of ages.'). "
+                "Do not generate or embed any image or base64 in your response; the app will display the chart. "
+                "If you cannot figure out the answer, say `The given context does not provide answer to the following problem`."
+            )
+        else:
+            instruction += (
+                "If you cannot figure out the answer, just politely say `The given context does not provide answer to the following problem`."
+            )
+        return instruction
+
+    def _create_sql_agent(self) -> AgentExecutor:
+        """Tool-calling agent whose query tool runs SQL against the DuckDB dataset."""
+        class SQLInputs(BaseModel):
+            query: str = Field(description=f"one DuckDB SQL SELECT statement against the table {DUCKDB_TABLE}")
+
+        def run_sql(query: str):
+            try:
+                result = self.duckdb.query(query)
+            except DuckDBQueryError as e:
+                # Returned as the observation, like REPL errors, so the agent can adjust
+                return f"{type(e).__name__}: {str(e)}"
+            if result.attrs.get("truncated"):
+                # As text, so the agent cannot take counts or sums of a partial result for complete ones
+                return (
+                    f"{format_result(result)}\n(truncated to {self.duckdb.max_result_rows} rows; "
+                    "aggregate or filter in SQL for a complete result)"
+                )
+            return result
+
+        async def arun_sql(query: str):
+            # DuckDB releases the GIL while scanning; the cap keeps conversion cheap
+            return await asyncio.to_thread(run_sql, query)
+
+        tools = [
+            StructuredTool.from_function(
+                func=run_sql,
+                coroutine=arun_sql,
+                name="sql_query",
+                description=(
+                    f"Run a read-only DuckDB SQL query on the table {DUCKDB_TABLE}. "
+                    f"Returns at most {DUCKDB_MAX_RESULT_ROWS} rows; aggregate and filter in SQL."
+                ),
+                args_schema=SQLInputs,
+            )
+        ]
+        if self.plotly_tool:
+            tools.append(self.plotly_tool)
+            self.logger.debug("Added Plotly visualization tool to agent")
+        prompt = ChatPromptTemplate.from_messages([
+            SystemMessage(content=self.instruction),
+            ("human", "{input}"),
+            MessagesPlaceholder("agent_scratchpad"),
+        ])
+        agent = create_tool_calling_agent(self.llm, tools, prompt)
+        # Same limits as the pandas agent
+        return AgentExecutor(
+            agent=agent,
+            tools=tools,
+            verbose=True,
+            max_iterations=10,
+            max_execution_time=90.0,
+            return_intermediate_steps=True,
+        )
+
+    def _plot_frame(self, query_result=None):
+        """DataFrame chart code runs on as 'df': the dataset, or the query result for the duckdb engine."""
+        if self.duckdb is None:
+            return self.df
+        return result_to_frame(query_result)
+
+    @property
+    def sandbox(self) -> SandboxPool:
+        """Worker pool holding this dataset (shared by all agents on the same fingerprint)."""
+        return get_sandbox_pool(self.dataset_fingerprint, self.df)
+
+    def _replace_repl_tool(self, run_query, arun_query) -> None:
+        """Swap the agent's Python REPL tool for one running the given functions."""
+        class PythonInputs(BaseModel):
+            query: str = Field(description="code snippet to run")
+
+        tools = list(self.agent_executor.tools)
+        for i, tool in enumerate(tools):
+            if tool.name == "python_repl_ast":
+                # Same name, description and schema as the tool already bound to the LLM
+                tools[i] = StructuredTool.from_function(
+                    func=run_query,
+                    coroutine=arun_query,
+                    name=tool.name,
+                    description=tool.description,
+                    args_schema=PythonInputs,
+                )
+        self.agent_executor.tools = tools
+
+    def _use_isolated_repl(self) -> None:
+        """
+        Give each run its own in-process REPL namespace, holding a shallow copy of df.
+
+        The stock REPL tool keeps one namespace for the agent's lifetime, so variables
+        and in-place edits of df would carry over to later questions, other sessions
+        of a pooled agent and concurrent batch questions.
+        """
+        def run_query(query: str):
+            run_id = current_run_id.get()
+            namespace = self._namespaces.get(run_id) if run_id is not None else None
+            if namespace is None:
+                namespace = {"df": self.df.copy(deep=False), "pd": pd}
+                if run_id is not None:
+                    namespace = self._namespaces.setdefault(run_id, namespace)
+            return _run_repl(query, namespace)
+
+        async def arun_query(query: str):
+            # Runs in a thread like the stock tool; the run id context is copied along
+            return await asyncio.to_thread(run_query, query)
+
+        self._replace_repl_tool(run_query, arun_query)
+        self.logger.debug("Python REPL tool uses a namespace per run")
+
+    def _use_sandboxed_repl(self) -> None:
+        """Swap the agent's in-process Python REPL for one that executes in the sandbox pool."""
+        def run_query(query: str):
+            try:
+                return self.sandbox.execute_query(query, run_id=current_run_id.get())
+            except SandboxError as e:
+                # Returned as the observation, like REPL errors, so the agent can adjust
+                return f"{type(e).__name__}: {str(e)}"
+
+        async def arun_query(query: str):
+            try:
+                return await self.sandbox.aexecute_query(query, run_id=current_run_id.get())
+            except SandboxError as e:
+                return f"{type(e).__name__}: {str(e)}"
+
+        self._replace_repl_tool(run_query, arun_query)
+        # Start the workers now so the first question does not pay for it
+        self.sandbox.start()
+        self.logger.debug("Python REPL tool runs in the sandbox worker pool")
+
+    def _get_plotly_tool(self) -> PlotlyVisualizationTool:
+        """Return the plotly tool, creating it lazily for agents built without visualization."""
+        if self.plotly_tool_instance is None:
+            self.plotly_tool_instance = PlotlyVisualizationTool(
+                api_key=self.api_key, dataset_fingerprint=self.dataset_fingerprint, use_sandbox=self.use_sandbox
+            )
+        return self.plotly_tool_instance
+
+    async def _result_from_cache(self, cached: dict) -> dict:
+        """Turn a cached answer back into a full result, rebuilding the figure from its code."""
+        visualization_figure = None
+        plotly_code = cached.get("plotly_code")
+        if cached.get("figure_json"):
+            # Template charts, and charts of query results (duckdb engine), have no code to re-run on df
+            import plotly.io as pio
+            visualization_figure = pio.from_json(cached["figure_json"])
+        elif plotly_code:
+            visualization_figure = await asyncio.to_thread(
+                self._get_plotly_tool().execute_plotly_code, plotly_code, self.df
+            )
+        return {
+            "answer": cached.get("answer"),
+            "query_executed": cached.get("query_executed"),
+            "query_output": cached.get("query_output"),
+            "visualization_figure": visualization_figure,
+            "plotly_code": plotly_code,
+            "needs_visualization": self.needs_visualization,
+            "cached": True,
+        }
+
+    async def _generate_visualization(self, question: str, query_output: str, query_result=None):
+        """
+        Generate a chart from an already computed query result (no agent round trip).
+
+        Args:
+            question: The user's question
+            query_output: Text rendering of the query result
+            query_result: The live result object, when captured from the REPL
+
+        Returns:
+            tuple: (figure or None, plotly code or None)
+        """
+        self.logger.info("Forcing visualization: generating chart from query result")
+        plotly_tool = self._get_plotly_tool()
+        try:
+            template = await asyncio.to_thread(build_template_chart, question, self.df, query_result)
+            if template is not None:
+                self.logger.info("Forced visualization generated by template engine")
+                return template
+            frame = self._plot_frame(query_result)
+            if frame is None:
+                self.logger.warning("Forced visualization: no query result to chart")
+                return None, None
+            result_schema = describe_result_schema(query_result) if isinstance(query_result, (pd.Series, pd.DataFrame)) else None
+            code = await plotly_tool.agenerate_plotly_code(
+                user_query=question,
+                data_output=query_output[:2000],
+                dataframe_info=self.dataset_profile if self.duckdb is None else result_frame_info(frame),
+                result_schema=result_schema,
+            )
+            if not code:
+                self.logger.warning("Forced visualization: generate_plotly_code returned None")
+                return None, None
+            fig = await asyncio.to_thread(plotly_tool.execute_plotly_code, code, frame)
+            if fig is None:
+                self.logger.warning("Forced visualization: execute_plotly_code returned None")
+                return None, None
+            plotly_tool.remember_plotly_code(question, query_output[:2000], code, result_schema=result_schema)
+            self.logger.info("Forced visualization generated successfully")
+            return fig, code
+        except Exception as e:
+            self.logger.error("Error in forced visualization: %s", e)
+            import traceback
+            self.logger.error(traceback.format_exc())
+            return None, None
+
+    def _error_response(self, answer: str, error: str) -> dict:
+        return {
+            "answer": answer,
+            "query_executed": None,
+            "query_output": None,
+            "visualization_figure": None,
+            "plotly_code": None,
+            "needs_visualization": False,
+            # Set only on failures, so callers can tell them from real answers
+            "error": error,
+        }
+
+    async def _build_response(self, result: dict, callback: QueryCaptureCallback, run_id: str, question: str, cache_key: str) -> dict:
+        """Turn the agent's final output into the response dict, attaching figures and query details."""
+        # Extract the output
+        ans = result.get("output", "I don't know")
+        
+        # Get captured query and output from callback
+        query_executed = callback.query_executed
+        query_output = callback.query_output
+        query_result = callback.query_result
         
+        # Check for plotly visualization in intermediate steps
+        visualization_figure = None
+        plotly_code = None
+        
+        if "intermediate_steps" in result:
+            intermediate_steps = result.get("intermediate_steps", [])
+            for step in intermediate_steps:
+                if isinstance(step, tuple) and len(step) >= 2:
+                    agent_action = step[0]
+                    observation = step[1]
+                    
+                    # Check if this step used the plotly tool
+                    if hasattr(agent_action, 'tool') and 'plotly' in str(agent_action.tool).lower():
+                        try:
+                            observation_str = _get_observation_string(observation)
+                            self.logger.debug("Plotly tool observation: %s", payload(observation_str, 200))
+                            # Try direct parse first, then extract in case of trailing text
+                            plotly_result = None
+                            try:
+                                plotly_result = json.loads(observation_str)
+                            except json.JSONDecodeError:
+                                plotly_result = _extract_json_from_observation(observation_str)
+                            if not plotly_result:
+                                raise ValueError("Could not extract JSON from observation")
+                            if plotly_result.get("success") and plotly_result.get("plotly_code"):
+                                plotly_code = plotly_result.get("plotly_code")
+                                
+                                # Reuse the figure the tool already built and validated
+                                fig = figure_store.pop(run_id, plotly_code)
+                                if fig is not None:
+                                    visualization_figure = fig
+                                    self.logger.info("Using plotly figure validated by the tool")
+                                    continue
+                                self.logger.info("Regenerating figure from code")
+                                try:
+                                    fig = await asyncio.to_thread(
+                                        self._get_plotly_tool().execute_plotly_code, plotly_code, self._plot_frame(query_result)
+                                    )
+                                    
+                                    if fig is not None:
+                                        visualization_figure = fig
+                                        self.logger.info("Successfully generated plotly visualization")
+                                    else:
+                                        self.logger.warning("Plotly code executed but no figure returned")
+                                except Exception as e:
+                                    self.logger.error("Error regenerating figure: %s", e)
+                                    import traceback
+                                    self.logger.error(traceback.format_exc())
+                                    # Do not overwrite visualization_figure with None if we already have one
+                        except json.JSONDecodeError as e:
+                            self.logger.warning("Could not parse plotly result as JSON: %s", e)
+                            self.logger.debug("Observation was: %s", payload(observation, 500))
+                        except ValueError as e:
+                            self.logger.warning("Could not extract JSON from observation: %s", e)
+                        except Exception as e:
+                            self.logger.error("Error extracting plotly visualization: %s", e)
+                            import traceback
+                            self.logger.error(traceback.format_exc())
+        
+        # The tool may have produced a figure even if intermediate steps were unavailable
+        if visualization_figure is None:
+            latest = figure_store.last(run_id)
+            if latest is not None:
+                plotly_code, visualization_figure = latest
+
+        # Fallback: Try to get query_executed from intermediate_steps if callback didn't capture
+        if not query_executed and "intermediate_steps" in result:
+            intermediate_steps = result.get("intermediate_steps", [])
+            if intermediate_steps:
+                for step in intermediate_steps:
+                    if isinstance(step, tuple) and len(step) >= 2:
+                        agent_action = step[0]
+                        if hasattr(agent_action, 'tool_input'):
+                            tool_input = agent_action.tool_input
+                            # Skip plotly tool inputs
+                            if hasattr(agent_action, 'tool') and 'plotly' not in str(agent_action.tool).lower():
+                                if isinstance(tool_input, dict):
+                                    query_executed = tool_input.get('query') or str(tool_input)
+                                else:
+                                    query_executed = str(tool_input)
+                                query_result = step[1]
+                                query_output = format_result(step[1]) if step[1] is not None else None
+                                break
+        
+        self.logger.info("Query executed: %s", payload(query_executed))
+        self.logger.info("Query output (length): %s", len(query_output) if query_output else 0)
+        self.logger.info("Visualization generated: %s", visualization_figure is not None)
+
+        # Force visualization when classifier said it's needed but agent didn't produce a figure
+        if self.needs_visualization and visualization_figure is None and query_output and question:
+            with stage("forced_visualization"):
+                forced_figure, forced_code = await self._generate_visualization(question, query_output, query_result)
+            if forced_figure is not None:
+                visualization_figure = forced_figure
+                plotly_code = forced_code
+        
+        self.logger.debug("Response: %s", payload(ans))
+        
+        response = {
+            "answer": ans,
+            "query_executed": query_executed,
+            "query_output": query_output,
+            "query_result": query_result,
+            "visualization_figure": visualization_figure,
+            "plotly_code": plotly_code,
+            "needs_visualization": self.needs_visualization
+        }
+        # A chart that was asked for but not produced is not worth caching
+        if cache_key is not None and not (self.needs_visualization and visualization_figure is None):
+            # Chart code of the duckdb engine ran on a query result that is not cached, so keep the figure
+            self.answer_cache.set(cache_key, response, store_figure=self.duckdb is not None)
+        return response
+
+    async def astream_chat(self, question: str, chat_history: list = None) -> AsyncIterator[dict]:
+        """
+        Answer a question, yielding progress events and answer tokens as the agent produces them.
+
+        Events are dicts with a 'type':
+            'tool_start': 'tool' and 'input' when the agent calls a tool
+            'tool_end': 'tool' when the tool returns
+            'token': 'content', a piece of model text. Text streamed before a tool_start
+                belongs to an intermediate step, not to the final answer
+            'result': 'result', the dict chat_with_a_df returns (always the last event)
+
         Args:
             question: The user's current question.
             chat_history: Optional list of previous messages [{"role": "user"|"assistant", "content": "..."}] for context.
-        
-        Returns:
-            dict: Contains 'answer', 'query_executed', 'query_output', 'visualization_figure', 'needs_visualization'
         """
         chat_history = chat_history or []
         agent_input = _format_chat_history_for_input(chat_history, question)
-        self.logger.info(f"Received question: {question}")
+        self.logger.info("Received question: %s", question)
+
+        cache_key = None
+        if self.answer_cache is not None:
+            cache_key = AnswerCache.make_key(
+                self.dataset_fingerprint,
+                question,
+                _format_chat_history_for_input(chat_history, ""),
+                self.needs_visualization,
+            )
+            cached = self.answer_cache.get(cache_key)
+            if cached is not None:
+                self.logger.info("Answer cache hit")
+                yield {"type": "result", "result": await self._result_from_cache(cached)}
+                return
+
+        # Tools publish live objects (validated figures) under this run id
+        run_id = uuid.uuid4().hex
+        run_token = current_run_id.set(run_id)
+        events = None
         try:
             # Create callback to capture query and output
-            callback = QueryCaptureCallback()
+            callback = QueryCaptureCallback(run_id=run_id)
             callback.logger = self.logger
-            
-            # Use ainvoke with callback to capture intermediate steps
-            # Add timeout to prevent hanging
-            try:
-                result = await asyncio.wait_for(
-                    self.agent_executor.ainvoke(
-                        {"input": agent_input},
-                        config={"callbacks": [callback]}
-                    ),
-                    timeout=120.0  # 2 minute timeout
-                )
-            except asyncio.TimeoutError:
-                self.logger.error("Agent execution timed out after 120 seconds")
-                return {
-                    "answer": "I'm sorry, the request took too long to process. Please try a simpler query.",
-                    "query_executed": None,
-                    "query_output": None,
-                    "visualization_figure": None,
-                    "plotly_code": None,
-                    "needs_visualization": False
-                }
-            
-            # Extract the output
-            ans = result.get("output", "I don't know")
-            
-            # Get captured query and output from callback
-            query_executed = callback.query_executed
-            query_output = callback.query_output
-            
-            # Check for plotly visualization in intermediate steps
-            visualization_figure = None
-            plotly_code = None
-            
-            if "intermediate_steps" in result:
-                intermediate_steps = result.get("intermediate_steps", [])
-                for step in intermediate_steps:
-                    if isinstance(step, tuple) and len(step) >= 2:
-                        agent_action = step[0]
-                        observation = step[1]
-                        
-                        # Check if this step used the plotly tool
-                        if hasattr(agent_action, 'tool') and 'plotly' in str(agent_action.tool).lower():
-                            try:
-                                observation_str = _get_observation_string(observation)
-                                self.logger.debug(f"Plotly tool observation: {observation_str[:200]}")
-                                # Try direct parse first, then extract in case of trailing text
-                                plotly_result = None
-                                try:
-                                    plotly_result = json.loads(observation_str)
-                                except json.JSONDecodeError:
-                                    plotly_result = _extract_json_from_observation(observation_str)
-                                if not plotly_result:
-                                    raise ValueError("Could not extract JSON from observation")
-                                if plotly_result.get("success") and plotly_result.get("plotly_code"):
-                                    plotly_code = plotly_result.get("plotly_code")
-                                    
-                                    # Regenerate figure from code (no caching)
-                                    self.logger.info("Regenerating figure from code")
-                                    try:
-                                        if self.plotly_tool_instance:
-                                            fig = self.plotly_tool_instance.execute_plotly_code(plotly_code, self.df)
-                                        else:
-                                            plotly_tool_instance = PlotlyVisualizationTool(api_key=self.api_key)
-                                            fig = plotly_tool_instance.execute_plotly_code(plotly_code, self.df)
-                                        
-                                        if fig is not None:
-                                            visualization_figure = fig
-                                            self.logger.info("Successfully generated plotly visualization")
-                                        else:
-                                            self.logger.warning("Plotly code executed but no figure returned")
-                                    except Exception as e:
-                                        self.logger.error(f"Error regenerating figure: {e}")
-                                        import traceback
-                                        self.logger.error(traceback.format_exc())
-                                        # Do not overwrite visualization_figure with None if we already have one
-                            except json.JSONDecodeError as e:
-                                self.logger.warning(f"Could not parse plotly result as JSON: {e}")
-                                self.logger.debug(f"Observation was: {str(observation)[:500]}")
-                            except ValueError as e:
-                                self.logger.warning(f"Could not extract JSON from observation: {e}")
-                            except Exception as e:
-                                self.logger.error(f"Error extracting plotly visualization: {e}")
-                                import traceback
-                                self.logger.error(traceback.format_exc())
-            
-            # Fallback: Try to get query_executed from intermediate_steps if callback didn't capture
-            if not query_executed and "intermediate_steps" in result:
-                intermediate_steps = result.get("intermediate_steps", [])
-                if intermediate_steps:
-                    for step in intermediate_steps:
-                        if isinstance(step, tuple) and len(step) >= 2:
-                            agent_action = step[0]
-                            if hasattr(agent_action, 'tool_input'):
-                                tool_input = agent_action.tool_input
-                                # Skip plotly tool inputs
-                                if hasattr(agent_action, 'tool') and 'plotly' not in str(agent_action.tool).lower():
-                                    if isinstance(tool_input, dict):
-                                        query_executed = tool_input.get('query') or str(tool_input)
-                                    else:
-                                        query_executed = str(tool_input)
-                                    query_output = str(step[1]) if step[1] else None
-                                    break
-            
-            self.logger.info(f"Query executed: {query_executed}")
-            self.logger.info(f"Query output (length): {len(query_output) if query_output else 0}")
-            self.logger.info(f"Visualization generated: {visualization_figure is not None}")
-
-            # Force visualization when classifier said it's needed but agent didn't produce a figure
-            if (
-                self.needs_visualization
-                and visualization_figure is None
-                and self.plotly_tool_instance is not None
-                and query_output
-                and question
-            ):
-                self.logger.info("Forcing visualization: generating chart from query result")
+            callbacks = [callback]
+            trace = current_trace.get()
+            if trace is not None:
+                callbacks.append(TracingCallbackHandler(trace))
+
+            events = self.agent_executor.astream_events(
+                {"input": agent_input},
+                config={"callbacks": callbacks},
+                version="v2",
+            )
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + AGENT_TIMEOUT_SECONDS
+            # Timed by hand: a stage() block would be held open across the yields
+            agent_start = trace.elapsed() if trace is not None else None
+            result = None
+            while True:
+                remaining = deadline - loop.time()
                 try:
-                    dataframe_info = f"Columns: {self.df.columns.tolist()}\nShape: {self.df.shape}\nDtypes:\n{self.df.dtypes}"
-                    code = self.plotly_tool_instance.generate_plotly_code(
-                        user_query=question,
-                        data_output=query_output[:2000],
-                        dataframe_info=dataframe_info,
-                    )
-                    if code:
-                        fig = self.plotly_tool_instance.execute_plotly_code(code, self.df)
-                        if fig is not None:
-                            visualization_figure = fig
-                            plotly_code = code
-                            self.logger.info("Forced visualization generated successfully")
-                        else:
-                            self.logger.warning("Forced visualization: execute_plotly_code returned None")
-                    else:
-                        self.logger.warning("Forced visualization: generate_plotly_code returned None")
-                except Exception as e:
-                    self.logger.error(f"Error in forced visualization: {e}")
-                    import traceback
-                    self.logger.error(traceback.format_exc())
-            
-            self.logger.debug(f"Response: {ans}")
-            
-            return {
-                "answer": ans,
-                "query_executed": query_executed,
-                "query_output": query_output,
-                "visualization_figure": visualization_figure,
-                "plotly_code": plotly_code,
-                "needs_visualization": self.needs_visualization
-            }
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    event = await asyncio.wait_for(events.__anext__(), timeout=remaining)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    self.logger.error("Agent execution timed out after %.0f seconds", AGENT_TIMEOUT_SECONDS)
+                    if trace is not None:
+                        trace.status = "timeout"
+                    yield {"type": "result", "result": self._error_response(
+                        "I'm sorry, the request took too long to process. Please try a simpler query.",
+                        f"Timed out after {AGENT_TIMEOUT_SECONDS:.0f} seconds",
+                    )}
+                    return
+
+                kind = event["event"]
+                if kind == "on_chat_model_stream":
+                    content = getattr(event["data"].get("chunk"), "content", None)
+                    if isinstance(content, str) and content:
+                        yield {"type": "token", "content": content}
+                elif kind == "on_tool_start":
+                    yield {"type": "tool_start", "tool": event["name"], "input": event["data"].get("input")}
+                elif kind == "on_tool_end":
+                    yield {"type": "tool_end", "tool": event["name"]}
+                elif kind == "on_chain_end" and not event.get("parent_ids"):
+                    # Output of the AgentExecutor itself, including intermediate steps
+                    result = event["data"].get("output")
+
+            if trace is not None:
+                trace.add_stage("agent", agent_start, trace.elapsed() - agent_start)
+            if not isinstance(result, dict):
+                raise ValueError("Agent stream ended without a final output")
+            with stage("postprocess"):
+                response = await self._build_response(result, callback, run_id, question, cache_key)
+            yield {"type": "result", "result": response}
         except Exception as e:
-            self.logger.error(f"Error in chat_with_a_df: {e}")
+            self.logger.error("Error in astream_chat: %s", e)
             import traceback
             self.logger.error(traceback.format_exc())
-            return {
-                "answer": "I'm sorry, I couldn't process your request.",
-                "query_executed": None,
-                "query_output": None,
-                "visualization_figure": None,
-                "plotly_code": None,
-                "needs_visualization": False
-            }
+            yield {"type": "result", "result": self._error_response(
+                "I'm sorry, I couldn't process your request.", f"{type(e).__name__}: {e}"
+            )}
+        finally:
+            if events is not None:
+                await events.aclose()
+            figure_store.discard(run_id)
+            result_store.discard(run_id)
+            self._namespaces.pop(run_id, None)
+            if self.use_sandbox:
+                self.sandbox.end_run(run_id)
+            try:
+                current_run_id.reset(run_token)
+            except ValueError:
+                # The generator was closed from another context (e.g. garbage collected)
+                pass
 
+    async def chat_with_a_df(self, question: str, chat_history: list = None) -> dict:
+        """
+        Process a question and return both the answer and execution details.
+        
+        Args:
+            question: The user's current question.
+            chat_history: Optional list of previous messages [{"role": "user"|"assistant", "content": "..."}] for context.
+        
+        Returns:
+            dict: Contains 'answer', 'query_executed', 'query_output', 'query_result' (live pandas object),
+            'visualization_figure', 'needs_visualization' (and 'cached': True when served from the answer cache,
+            'error' when the question could not be answered)
+        """
+        response = None
+        async for event in self.astream_chat(question, chat_history=chat_history):
+            if event["type"] == "result":
+                response = event["result"]
+        return response
 
 if __name__ == "__main__":
     import os
@@ -377,9 +811,9 @@ if __name__ == "__main__":
         csv_path = r"src\data\vitals.csv"  # Update this path as needed
         try:
             df = pd.read_csv(csv_path)
-            logger.info(f"Loaded CSV file from {csv_path}")
+            logger.info("Loaded CSV file from %s", csv_path)
         except Exception as e:
-            logger.error(f"Failed to load CSV file: {e}")
+            logger.error("Failed to load CSV file: %s", e)
             sys.exit(1)
 
         # Initialize ChatwithCSV
@@ -400,7 +834,7 @@ if __name__ == "__main__":
                 json.dump(samples, f, indent=4)
             logger.info("Sample queries saved successfully.")
         except Exception as e:
-            logger.error(f"Failed to save sample queries: {e}")
+            logger.error("Failed to save sample queries: %s", e)
 
         print("Files Saved")
 
@@ -0,0 +1,235 @@
+# Process-wide pool of ChatwithCSV agents shared across sessions
+
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from .logging_config import get_logger
+
+# Hard cap on the DataFrame memory referenced by pooled agents
+AGENT_POOL_MAX_BYTES = 2 * 1024 ** 3
+AGENT_POOL_MAX_ENTRIES = 32
+# Leased entries unused for this long may be evicted anyway: a session that ended
+# without releasing (closed tab, crashed script) must not pin its agent forever
+AGENT_POOL_IDLE_TTL_SECONDS = 30 * 60
+
+
+class _PoolEntry:
+    def __init__(self, chatbot, dataset_bytes: int, init_seconds: float):
+        self.chatbot = chatbot
+        self.dataset_bytes = dataset_bytes
+        self.init_seconds = init_seconds
+        self.refcount = 0
+        self.last_used = time.monotonic()
+
+
+class AgentLease:
+    """One session's reference to an agent from the pool.
+
+    The reference is returned by release(), or when the lease is garbage collected
+    (e.g. with the Streamlit session state that holds it), whichever comes first.
+    """
+
+    def __init__(self, pool: "AgentPool", fingerprint: str, needs_visualization: bool, chatbot):
+        self.fingerprint = fingerprint
+        self.needs_visualization = bool(needs_visualization)
+        self.chatbot = chatbot
+        self._pool = pool
+        self._finalizer = weakref.finalize(self, pool.release, fingerprint, needs_visualization, chatbot)
+
+    def touch(self) -> None:
+        """Mark the agent as in use, so the idle TTL does not evict it."""
+        self._pool.touch(self.fingerprint, self.needs_visualization)
+
+    def release(self) -> None:
+        """Return the reference; calling it again does nothing."""
+        self._finalizer()
+
+
+class AgentPool:
+    """Shares ChatwithCSV instances keyed by (dataset fingerprint, visualization flag).
+
+    Sessions acquire an agent and release it when their dataset changes or the
+    session ends (see AgentLease). Idle entries (refcount 0), then entries unused
+    for AGENT_POOL_IDLE_TTL_SECONDS, are evicted least recently used first when the
+    entry count or the memory cap is exceeded. Memory is accounted per dataset, since
+    both agents for a fingerprint reference the same DataFrame.
+
+    Note that without the sandbox (SANDBOX_ENABLED=false) pooled agents share their
+    Python REPL namespace, so variables defined by one session's generated code are
+    visible to other sessions on the same dataset. Sandboxed runs get their own.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = AGENT_POOL_MAX_BYTES,
+        max_entries: int = AGENT_POOL_MAX_ENTRIES,
+        idle_ttl_seconds: float = AGENT_POOL_IDLE_TTL_SECONDS,
+    ):
+        self.logger = get_logger(__name__)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, bool], _PoolEntry]" = OrderedDict()
+        # Agents handed out without pooling; their releases must not touch pooled entries
+        self._unpooled: "weakref.WeakSet" = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._building: Dict[Tuple[str, bool], threading.Lock] = {}
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "unpooled": 0,
+            "init_count": 0,
+            "init_seconds_total": 0.0,
+            "init_seconds_max": 0.0,
+        }
+
+    def _dataset_bytes_locked(self) -> int:
+        seen: Dict[str, int] = {}
+        for (fingerprint, _), entry in self._entries.items():
+            seen[fingerprint] = entry.dataset_bytes
+        return sum(seen.values())
+
+    def _evict_locked(self, incoming_fingerprint: Optional[str] = None, incoming_bytes: int = 0) -> None:
+        """Evict idle entries until the entry count and memory cap are respected."""
+        def over_limit() -> bool:
+            total = self._dataset_bytes_locked()
+            if incoming_fingerprint and all(fp != incoming_fingerprint for fp, _ in self._entries):
+                total += incoming_bytes
+            return len(self._entries) >= self.max_entries or total > self.max_bytes
+
+        while over_limit():
+            victim = next((key for key, entry in self._entries.items() if entry.refcount == 0), None)
+            if victim is None:
+                stale_before = time.monotonic() - self.idle_ttl_seconds
+                victim = next((key for key, entry in self._entries.items() if entry.last_used < stale_before), None)
+                if victim is None:
+                    return
+                # Sessions still holding it keep their agent; only the pool forgets it
+                self.logger.info("Evicting pooled agent %s idle with %s leases", victim, self._entries[victim].refcount)
+            del self._entries[victim]
+            self.metrics["evictions"] += 1
+            self.logger.info("Evicted pooled agent %s", victim)
+
+    def acquire(self, fingerprint: str, needs_visualization: bool, factory: Callable[[], object], dataset_bytes: int = 0):
+        """
+        Return a shared agent for the dataset, building it with factory on a miss.
+
+        Args:
+            fingerprint: Dataset fingerprint
+            needs_visualization: Whether the agent carries visualization tooling
+            factory: Zero-argument callable that builds a ChatwithCSV
+            dataset_bytes: Memory used by the dataset, for the pool's memory cap
+
+        Returns:
+            The pooled (or, if the memory cap cannot be met, an unpooled) ChatwithCSV
+        """
+        key = (fingerprint, bool(needs_visualization))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refcount += 1
+                entry.last_used = time.monotonic()
+                self._entries.move_to_end(key)
+                self.metrics["hits"] += 1
+                return entry.chatbot
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        # Build outside the pool lock; concurrent requests for the same key wait for one build
+        with build_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refcount += 1
+                    entry.last_used = time.monotonic()
+                    self.metrics["hits"] += 1
+                    return entry.chatbot
+                self.metrics["misses"] += 1
+
+            start = time.perf_counter()
+            chatbot = factory()
+            init_seconds = time.perf_counter() - start
+
+            with self._lock:
+                self._building.pop(key, None)
+                self.metrics["init_count"] += 1
+                self.metrics["init_seconds_total"] += init_seconds
+                self.metrics["init_seconds_max"] = max(self.metrics["init_seconds_max"], init_seconds)
+                self._evict_locked(fingerprint, dataset_bytes)
+                projected = self._dataset_bytes_locked()
+                if all(fp != fingerprint for fp, _ in self._entries):
+                    projected += dataset_bytes
+                if projected > self.max_bytes or len(self._entries) >= self.max_entries:
+                    self.metrics["unpooled"] += 1
+                    self._unpooled.add(chatbot)
+                    self.logger.warning("Agent pool full; serving %s without pooling", key)
+                    return chatbot
+                entry = _PoolEntry(chatbot, dataset_bytes, init_seconds)
+                entry.refcount = 1
+                self._entries[key] = entry
+                self.logger.info("Pooled new agent %s (init %.2fs)", key, init_seconds)
+                return chatbot
+
+    async def aacquire(self, fingerprint: str, needs_visualization: bool, factory: Callable[[], object], dataset_bytes: int = 0):
+        """Async wrapper of acquire; agent construction runs in a worker thread."""
+        return await asyncio.to_thread(self.acquire, fingerprint, needs_visualization, factory, dataset_bytes)
+
+    async def alease(self, fingerprint: str, needs_visualization: bool, factory: Callable[[], object], dataset_bytes: int = 0) -> AgentLease:
+        """Like aacquire, but returns an AgentLease that is released when garbage collected."""
+        chatbot = await self.aacquire(fingerprint, needs_visualization, factory, dataset_bytes)
+        return AgentLease(self, fingerprint, needs_visualization, chatbot)
+
+    def touch(self, fingerprint: str, needs_visualization: bool) -> None:
+        """Record use of a pooled agent by a session that already holds it."""
+        with self._lock:
+            entry = self._entries.get((fingerprint, bool(needs_visualization)))
+            if entry is not None:
+                entry.last_used = time.monotonic()
+
+    def release(self, fingerprint: str, needs_visualization: bool, chatbot) -> None:
+        """
+        Drop one reference to an agent returned by acquire; it stays cached until evicted.
+
+        Args:
+            fingerprint: Dataset fingerprint passed to acquire
+            needs_visualization: Visualization flag passed to acquire
+            chatbot: The agent acquire returned; releases of unpooled or already
+                evicted agents leave the pooled entry alone
+        """
+        key = (fingerprint, bool(needs_visualization))
+        with self._lock:
+            if chatbot in self._unpooled:
+                self._unpooled.discard(chatbot)
+                return
+            entry = self._entries.get(key)
+            if entry is not None and entry.chatbot is chatbot and entry.refcount > 0:
+                entry.refcount -= 1
+
+    def stats(self) -> Dict:
+        """Return pool size, memory use, hit/miss and init-time metrics."""
+        with self._lock:
+            metrics = dict(self.metrics)
+            metrics["entries"] = len(self._entries)
+            metrics["active_references"] = sum(e.refcount for e in self._entries.values())
+            metrics["unpooled_active"] = len(self._unpooled)
+            metrics["dataset_bytes"] = self._dataset_bytes_locked()
+            metrics["max_bytes"] = self.max_bytes
+            count = metrics["init_count"]
+            metrics["init_seconds_avg"] = metrics["init_seconds_total"] / count if count else 0.0
+            return metrics
+
+
+_agent_pool = None
+_agent_pool_lock = threading.Lock()
+
+
+def get_agent_pool() -> AgentPool:
+    """Return the process-wide AgentPool."""
+    global _agent_pool
+    with _agent_pool_lock:
+        if _agent_pool is None:
+            _agent_pool = AgentPool()
+        return _agent_pool
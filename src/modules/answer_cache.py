@@ -0,0 +1,102 @@
+# End-to-end answer cache for ChatwithCSV.chat_with_a_df
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+from .cache import LRUCache, SQLiteCache
+from .classifier_agent import normalize_message
+from .logging_config import get_logger
+
+# Fields of a chat_with_a_df result that are stored; the figure is rebuilt from plotly_code,
+# or stored as Plotly JSON when it was built without code (template charts) or from a query result
+CACHED_FIELDS = ("answer", "query_executed", "query_output", "plotly_code")
+
+ANSWER_CACHE_BACKEND = os.getenv("ANSWER_CACHE_BACKEND", "memory").lower()  # memory | sqlite | none
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", os.path.join(".cache", "answers.sqlite3"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+
+
+class AnswerCache:
+    """Caches chat_with_a_df results keyed by dataset, question, history and visualization flag.
+
+    The storage backend is pluggable: anything with get/set/stats/clear, such as
+    LRUCache (in-memory) or SQLiteCache (local disk, shared across processes).
+    """
+
+    def __init__(self, backend):
+        self.logger = get_logger(__name__)
+        self.backend = backend
+
+    @staticmethod
+    def make_key(dataset_fingerprint: str, question: str, history_text: str, needs_visualization: bool) -> str:
+        """
+        Build the cache key for a question.
+
+        Args:
+            dataset_fingerprint: Identity of the dataset being queried
+            question: The user's question (normalized before hashing)
+            history_text: The chat history as passed to the agent
+            needs_visualization: Whether the agent has visualization tooling
+
+        Returns:
+            str: Hex digest used as the cache key
+        """
+        history_digest = hashlib.sha256((history_text or "").encode("utf-8")).hexdigest()
+        raw = json.dumps(
+            [dataset_fingerprint, normalize_message(question), history_digest, bool(needs_visualization)]
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        return dict(entry)
+
+    def set(self, key: str, result: Dict, store_figure: bool = False) -> None:
+        """
+        Store a result.
+
+        Args:
+            key: Key from make_key
+            result: A chat_with_a_df result
+            store_figure: Keep the figure as Plotly JSON even when it has plotly_code
+                (the code cannot be re-run when its input is not the dataset)
+        """
+        entry = {field: result.get(field) for field in CACHED_FIELDS}
+        if entry["query_output"] is not None:
+            entry["query_output"] = str(entry["query_output"])
+        figure = result.get("visualization_figure")
+        if (store_figure or not entry["plotly_code"]) and figure is not None:
+            entry["figure_json"] = figure.to_json()
+        try:
+            self.backend.set(key, entry)
+        except Exception as e:
+            self.logger.warning("Could not store answer in cache: %s", e)
+
+    def stats(self) -> Dict:
+        return self.backend.stats()
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    """Return the process-wide AnswerCache configured by ANSWER_CACHE_BACKEND, or None if disabled."""
+    global _answer_cache
+    if ANSWER_CACHE_BACKEND in ("none", "off", "false", "0"):
+        return None
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            if ANSWER_CACHE_BACKEND == "sqlite":
+                backend = SQLiteCache(ANSWER_CACHE_PATH, max_entries=ANSWER_CACHE_MAX_ENTRIES, table="answers")
+            else:
+                backend = LRUCache(max_size=ANSWER_CACHE_MAX_ENTRIES)
+            _answer_cache = AnswerCache(backend)
+        return _answer_cache
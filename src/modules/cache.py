@@ -0,0 +1,238 @@
+# Caches shared across Streamlit sessions (in-memory and on local disk)
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU cache with an optional per-entry TTL.
+
+    A single instance is meant to be shared by every Streamlit session in the
+    process, so all access goes through one lock. Hit/miss counters are kept
+    so callers can expose cache effectiveness.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: Optional[float] = None):
+        if max_size <= 0:
+            raise ValueError("max_size must be a positive integer")
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Return the cached value for key, or default if missing or expired.
+
+        Args:
+            key: The cache key
+            default: Value returned on a miss
+
+        Returns:
+            The cached value or default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Store value under key, evicting the least recently used entries if full."""
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+            self._data[key] = (value, expires_at)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        """Remove key from the cache if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return a snapshot of size and hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+class SQLiteCache:
+    """Size-bounded, least-recently-used cache persisted in a local SQLite file.
+
+    Values must be JSON-serializable. The database runs in WAL mode with a busy
+    timeout, so several processes on one host can share the same file. Eviction
+    keeps at most max_entries rows and, if max_bytes is set, at most that many
+    bytes of stored values.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 10000,
+        ttl_seconds: Optional[float] = None,
+        table: str = "cache",
+        max_bytes: Optional[int] = None,
+    ):
+        if max_entries <= 0:
+            raise ValueError("max_entries must be a positive integer")
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError("max_bytes must be a positive integer")
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name: {table}")
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.table = table
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed_idx ON {table} (accessed_at)")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Return the cached value for key, or default if missing or expired."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            value, created_at = row
+            if self.ttl_seconds and created_at + self.ttl_seconds <= now:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self.misses += 1
+                return default
+            self._conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        """Store value under key, evicting least recently used rows beyond max_entries."""
+        payload = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, payload, len(payload), now, now),
+                )
+                self._evict_locked()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _evict_locked(self) -> None:
+        (count,) = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY accessed_at ASC LIMIT ?)",
+                (overflow,),
+            )
+            self.evictions += overflow
+        if self.max_bytes is None:
+            return
+        (total,) = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+        if total <= self.max_bytes:
+            return
+        # Walk from the least recently used row until enough bytes are freed
+        excess = total - self.max_bytes
+        doomed = []
+        for key, size in self._conn.execute(f"SELECT key, size FROM {self.table} ORDER BY accessed_at ASC"):
+            doomed.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", doomed)
+        self.evictions += len(doomed)
+
+    def delete(self, key: str) -> None:
+        """Remove key from the cache if present."""
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        return count
+
+    def stats(self) -> Dict[str, Any]:
+        """Return a snapshot of size and hit/miss counters (counters are per process)."""
+        size = len(self)
+        with self._lock:
+            (size_bytes,) = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "size": size,
+                "max_size": self.max_entries,
+                "size_bytes": size_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
@@ -0,0 +1,244 @@
+# Deterministic chart templates for common result shapes (no LLM call)
+
+import re
+from typing import Any, List, Optional, Tuple
+import pandas as pd
+from .logging_config import get_logger
+from .tracing import stage
+
+logger = get_logger(__name__)
+
+# Categorical charts with more bars/slices than this are left to LLM codegen
+TEMPLATE_MAX_CATEGORIES = 50
+
+_CHART_KIND_PATTERNS = [
+    ("histogram", re.compile(r"\b(histogram|histograms|distribution|distributions)\b")),
+    ("pie", re.compile(r"\b(pie|proportion|proportions|share|percentage breakdown)\b")),
+    ("box", re.compile(r"\b(box ?plot|box ?plots|box chart|whisker)\b")),
+    ("line", re.compile(r"\b(line chart|line graph|line plot|trend|trends|over time)\b")),
+    ("bar", re.compile(r"\b(bar|bars|bar chart|bar graph|count|counts|how many|number of)\b")),
+]
+
+# Aggregations and groupings over columns the templates cannot resolve on their own
+_AGGREGATE_RE = re.compile(r"\b(average|mean|median|sum|total|max|maximum|min|minimum|rate|ratio|percent|percentage)\b")
+_GROUPING_RE = re.compile(r"\b(by|per|each|vs|versus|compare|comparison|across|split)\b")
+
+# Words a question may contain, besides column names, for a template over the full dataset.
+# Anything else ("female", "older than 60", "first class") may be a filter, left to the LLM
+_UNQUALIFIED_WORDS = frozenset("""
+    a an the of for on in to and with me i you we can could would please want see show draw create make generate
+    give display plot plots chart charts graph graphs visualize visualise visualization visualisation diagram
+    histogram histograms distribution distributions pie bar bars box boxplot boxplots whisker whiskers line trend
+    trends over time count counts how many number proportion proportions share percentage breakdown all values
+    column columns field fields data dataset by per each vs versus across split against
+""".split())
+
+# Chart types the templates never attempt
+_EXOTIC_RE = re.compile(r"\b(scatter|heatmap|heat map|correlation|3d|map|sunburst|treemap|violin|bubble|facet|subplot|animation)\b")
+
+
+def detect_chart_kind(query: str) -> Optional[str]:
+    """Return the chart type asked for in the query, or None if unspecified or exotic."""
+    text = str(query or "").lower()
+    if _EXOTIC_RE.search(text):
+        return "exotic"
+    for kind, pattern in _CHART_KIND_PATTERNS:
+        if pattern.search(text):
+            return kind
+    return None
+
+
+def find_mentioned_columns(query: str, df: pd.DataFrame) -> List[str]:
+    """Return the DataFrame columns mentioned in the query, in order of appearance."""
+    text = str(query or "").lower()
+    found = []
+    for column in df.columns:
+        name = str(column).lower()
+        variants = {name, name.replace("_", " ")}
+        positions = [m.start() for v in variants for m in re.finditer(rf"\b{re.escape(v)}s?\b", text)]
+        if positions:
+            found.append((min(positions), column))
+    return [column for _, column in sorted(found, key=lambda item: item[0])]
+
+
+def has_qualifier(query: str, df: pd.DataFrame) -> bool:
+    """True if the query has words besides chart wording and column names, e.g. a filter."""
+    text = str(query or "").lower()
+    for column in df.columns:
+        name = str(column).lower()
+        for variant in {name, name.replace("_", " ")}:
+            text = re.sub(rf"\b{re.escape(variant)}s?\b", " ", text)
+    return any(word not in _UNQUALIFIED_WORDS for word in re.findall(r"[a-z0-9]+", text))
+
+
+def _is_numeric(series: pd.Series) -> bool:
+    return pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+
+
+def _label(column: Any) -> str:
+    return str(column).replace("_", " ")
+
+
+def _dataframe_template_code(query: str, df: pd.DataFrame, kind: Optional[str]) -> Optional[str]:
+    """Build plotly code over `df` from the columns mentioned in the query."""
+    text = str(query or "").lower()
+    if _AGGREGATE_RE.search(text):
+        return None
+    # The chart covers every row, so it is only right when the question filters nothing
+    if has_qualifier(query, df):
+        return None
+    columns = find_mentioned_columns(query, df)
+    if not columns or len(columns) > 2:
+        return None
+
+    if len(columns) == 1:
+        column = columns[0]
+        series = df[column]
+        is_continuous = _is_numeric(series) and series.nunique(dropna=True) > TEMPLATE_MAX_CATEGORIES
+        if is_continuous or (_is_numeric(series) and kind in ("histogram", "box")):
+            # "ages by gender" with an unrecognized grouping column needs the LLM
+            if _GROUPING_RE.search(text):
+                return None
+            if kind == "box":
+                return f"fig = px.box(df, y={column!r}, title={f'Box plot of {_label(column)}'!r})"
+            if kind in (None, "histogram"):
+                return f"fig = px.histogram(df, x={column!r}, title={f'Distribution of {_label(column)}'!r})"
+            return None
+        if series.nunique(dropna=True) <= TEMPLATE_MAX_CATEGORIES and kind in (None, "bar", "pie", "histogram"):
+            counts = (
+                f"counts = df[{column!r}].value_counts().reset_index()\n"
+                f"counts.columns = [{str(column)!r}, 'count']\n"
+                f"counts[{str(column)!r}] = counts[{str(column)!r}].astype(str)\n"
+            )
+            if kind == "pie":
+                return counts + f"fig = px.pie(counts, names={str(column)!r}, values='count', title={f'{_label(column)} breakdown'!r})"
+            return counts + f"fig = px.bar(counts, x={str(column)!r}, y='count', title={f'Count by {_label(column)}'!r})"
+        return None
+
+    first, second = columns
+    numeric = [c for c in (first, second) if _is_numeric(df[c]) and df[c].nunique(dropna=True) > TEMPLATE_MAX_CATEGORIES]
+    categorical = [c for c in (first, second) if c not in numeric and df[c].nunique(dropna=True) <= TEMPLATE_MAX_CATEGORIES]
+    datetimes = [c for c in (first, second) if pd.api.types.is_datetime64_any_dtype(df[c])]
+
+    if datetimes and kind == "line":
+        time_column = datetimes[0]
+        value_column = second if time_column == first else first
+        if not _is_numeric(df[value_column]):
+            return None
+        return (
+            f"data = df[[{time_column!r}, {value_column!r}]].dropna().sort_values({time_column!r})\n"
+            f"fig = px.line(data, x={time_column!r}, y={value_column!r}, "
+            f"title={f'{_label(value_column)} over {_label(time_column)}'!r})"
+        )
+    if len(numeric) == 1 and len(categorical) == 1:
+        value_column, group_column = numeric[0], categorical[0]
+        if kind == "box":
+            return (
+                f"fig = px.box(df, x={group_column!r}, y={value_column!r}, "
+                f"title={f'{_label(value_column)} by {_label(group_column)}'!r})"
+            )
+        if kind == "histogram":
+            return (
+                f"fig = px.histogram(df, x={value_column!r}, color={group_column!r}, barmode='overlay', "
+                f"title={f'Distribution of {_label(value_column)} by {_label(group_column)}'!r})"
+            )
+    return None
+
+
+def _result_template_figure(result: Any, kind: Optional[str]):
+    """Build a figure directly from a pandas query result."""
+    import plotly.express as px
+
+    if isinstance(result, pd.DataFrame):
+        numeric_columns = [c for c in result.columns if _is_numeric(result[c])]
+        if len(result.columns) == 1 and numeric_columns:
+            result = result[result.columns[0]]
+        elif len(result.columns) == 2 and len(numeric_columns) == 1:
+            label_column = next(c for c in result.columns if c not in numeric_columns)
+            result = result.set_index(label_column)[numeric_columns[0]]
+        else:
+            return None
+
+    if not isinstance(result, pd.Series) or result.empty:
+        return None
+
+    name = _label(result.name) if result.name is not None else "value"
+    index = result.index
+    # Unnamed integer labels are row positions (e.g. df['Age'].dropna()), not categories
+    row_index = not isinstance(index, pd.MultiIndex) and index.name is None and pd.api.types.is_integer_dtype(index)
+
+    raw_values = row_index or (kind in ("histogram", "box") and not index.is_unique)
+    if _is_numeric(result) and raw_values and not pd.api.types.is_datetime64_any_dtype(index):
+        values = result.dropna()
+        if kind == "box":
+            return px.box(y=values.values, labels={"y": name}, title=f"Box plot of {name}")
+        return px.histogram(x=values.values, labels={"x": name}, title=f"Distribution of {name}")
+
+    if not _is_numeric(result) or not index.is_unique:
+        return None
+    index_name = _label(index.name) if index.name is not None else "category"
+
+    if pd.api.types.is_datetime64_any_dtype(index):
+        data = result.sort_index()
+        return px.line(x=data.index, y=data.values, labels={"x": index_name, "y": name}, title=f"{name} over {index_name}")
+
+    if isinstance(index, pd.MultiIndex) or len(result) > TEMPLATE_MAX_CATEGORIES:
+        return None
+    labels = [str(v) for v in index]
+    if kind == "pie":
+        return px.pie(names=labels, values=result.values, title=f"{name} by {index_name}")
+    if kind in (None, "bar", "histogram"):
+        return px.bar(x=labels, y=result.values, labels={"x": index_name, "y": name}, title=f"{name} by {index_name}")
+    return None
+
+
+def build_template_chart(query: str, df: pd.DataFrame, result: Any = None) -> Optional[Tuple[Any, Optional[str]]]:
+    """
+    Build a chart for common result shapes without calling the LLM.
+
+    The live query result is used when available (Series/DataFrame from the REPL).
+    Without one, columns mentioned in the query are charted from `df`, but only for
+    questions with no other wording (see has_qualifier), since filters are not applied.
+
+    Args:
+        query: The user's question (its wording picks the chart type)
+        df: The full dataset, or None when it is not in memory
+        result: The pandas result of the agent's query, if captured
+
+    Returns:
+        tuple (figure, code) where code is None for result-based charts, or None
+        if the request needs LLM codegen
+    """
+    kind = detect_chart_kind(query)
+    if kind == "exotic":
+        return None
+    with stage("plot_template"):
+        return _build_template_chart(query, df, result, kind)
+
+
+def _build_template_chart(query: str, df: pd.DataFrame, result: Any, kind: Optional[str]):
+    try:
+        if isinstance(result, (pd.Series, pd.DataFrame)):
+            fig = _result_template_figure(result, kind)
+            if fig is not None:
+                logger.info("Built %s chart from query result with template engine", kind or 'default')
+                return fig, None
+            # The result holds what the agent computed (filters included); charting
+            # the full dataset instead could contradict it
+            return None
+        if df is None:
+            return None
+        code = _dataframe_template_code(query, df, kind)
+        if code is None:
+            return None
+        import plotly.express as px
+        local_vars = {"df": df, "pd": pd, "px": px}
+        exec(code, {"__builtins__": __builtins__}, local_vars)
+        fig = local_vars.get("fig")
+        if fig is None:
+            return None
+        logger.info("Built %s chart from dataset columns with template engine", kind or 'default')
+        return fig, code
+    except Exception as e:
+        logger.warning("Template chart failed, falling back to LLM codegen: %s", e)
+        return None
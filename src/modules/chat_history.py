@@ -0,0 +1,224 @@
+# Token-budgeted chat history with an incremental rolling summary
+
+import functools
+import os
+from typing import Dict, List, Optional
+from .cache import LRUCache
+from .logging_config import get_logger
+from .tracing import atraced_completion
+
+# Tokens of history (summary + verbatim turns) sent with each question
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "1500"))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "300"))
+# Cap on a single verbatim message (long answers, pasted tables)
+HISTORY_MESSAGE_MAX_TOKENS = 400
+# The latest exchange is always kept verbatim
+HISTORY_MIN_RECENT_MESSAGES = 2
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and a data analysis assistant about a CSV dataset.
+
+Current summary:
+{summary}
+
+New messages to fold into the summary:
+{messages}
+
+Write the updated summary in at most {max_words} words. Keep facts, numbers, column names, filters and user preferences that later questions may refer to. Drop greetings and filler. Return only the summary text."""
+
+
+@functools.lru_cache(maxsize=8)
+def _get_encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """Count tokens with tiktoken, or estimate at 4 characters per token without it."""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-4o-mini") -> str:
+    """Cut text to at most max_tokens tokens, on a token boundary."""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        max_chars = max_tokens * 4
+        return text if len(text) <= max_chars else text[: max_chars - 3] + "..."
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[: max_tokens - 1]) + "..."
+
+
+def message_content(message: Dict) -> str:
+    """Text of a chat message; assistant messages stored as result dicts use their answer."""
+    content = message.get("content", "")
+    if isinstance(content, dict):
+        content = content.get("answer") or ""
+    return str(content or "").strip()
+
+
+def trim_history(chat_history: List[Dict], max_tokens: int = HISTORY_MAX_TOKENS, model: str = "gpt-4o-mini") -> List[Dict]:
+    """
+    Keep the newest messages that fit in a token budget, without summarizing.
+
+    Args:
+        chat_history: Messages [{"role", "content"}], oldest first
+        max_tokens: Budget for the returned messages
+        model: Model whose tokenizer is used for counting
+
+    Returns:
+        list of messages, oldest first
+    """
+    kept = []
+    total = 0
+    for message in reversed(chat_history or []):
+        content = message_content(message)
+        if not content:
+            continue
+        content = truncate_to_tokens(content, HISTORY_MESSAGE_MAX_TOKENS, model)
+        tokens = count_tokens(content, model)
+        if kept and total + tokens > max_tokens:
+            break
+        kept.append({"role": message.get("role", ""), "content": content})
+        total += tokens
+    kept.reverse()
+    return kept
+
+
+class ChatHistoryManager:
+    """Builds the history sent with each question within a fixed token budget.
+
+    Recent messages are kept verbatim. When they no longer fit, the oldest are
+    folded into a rolling summary with one small LLM call that only sees the
+    previous summary and the newly evicted messages, so each update costs the same
+    however long the conversation gets. Keep one instance per session; the summary
+    and token counts are cached on it.
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        max_tokens: int = HISTORY_MAX_TOKENS,
+        summary_max_tokens: int = HISTORY_SUMMARY_MAX_TOKENS,
+        model: str = "gpt-4o-mini",
+    ):
+        self.logger = get_logger(__name__)
+        self.api_key = api_key
+        self.model = model
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.summary = ""
+        # Number of leading messages already folded into the summary
+        self.summarized_upto = 0
+        self._token_counts = LRUCache(max_size=512)
+
+    def _count(self, text: str) -> int:
+        count = self._token_counts.get(text)
+        if count is None:
+            count = count_tokens(text, self.model)
+            self._token_counts.set(text, count)
+        return count
+
+    def _prepare(self, messages: List[Dict]) -> List[Dict]:
+        prepared = []
+        for message in messages:
+            content = message_content(message)
+            role = message.get("role", "")
+            if role and content:
+                prepared.append({"role": role, "content": truncate_to_tokens(content, HISTORY_MESSAGE_MAX_TOKENS, self.model)})
+        return prepared
+
+    def _recent_start(self, messages: List[Dict]) -> int:
+        """Index of the oldest message that still fits in the verbatim budget."""
+        # The summary's share is always reserved, so the total stays bounded after a fold
+        budget = max(self.max_tokens - self.summary_max_tokens, 0)
+        total = 0
+        start = len(messages)
+        for index in range(len(messages) - 1, -1, -1):
+            tokens = self._count(messages[index]["content"])
+            if len(messages) - index > HISTORY_MIN_RECENT_MESSAGES and total + tokens > budget:
+                break
+            total += tokens
+            start = index
+        return start
+
+    def _fallback_summary(self, new_messages: List[Dict]) -> str:
+        """Extractive summary used when the LLM call fails: first sentence of each message."""
+        parts = [self.summary] if self.summary else []
+        for message in new_messages:
+            first_sentence = message["content"].split("\n")[0].split(". ")[0]
+            parts.append(f"{message['role']}: {first_sentence}")
+        text = " | ".join(parts)
+        # Keep the newest part when over budget
+        while self._count(text) > self.summary_max_tokens and " | " in text:
+            text = text.split(" | ", 1)[1]
+        return truncate_to_tokens(text, self.summary_max_tokens, self.model)
+
+    async def _afold(self, new_messages: List[Dict]) -> None:
+        lines = [f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}" for m in new_messages]
+        prompt = SUMMARY_PROMPT.format(
+            summary=self.summary or "(empty)",
+            messages="\n".join(lines),
+            max_words=int(self.summary_max_tokens * 0.7),
+        )
+        try:
+            response = await atraced_completion(
+                "history_summary",
+                model=f"openai/{self.model}",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0,
+                max_tokens=self.summary_max_tokens,
+                api_key=self.api_key,
+            )
+            summary = (response.choices[0].message.content or "").strip()
+            self.summary = truncate_to_tokens(summary, self.summary_max_tokens, self.model)
+        except Exception as e:
+            self.logger.warning("Could not update history summary, using extractive fallback: %s", e)
+            self.summary = self._fallback_summary(new_messages)
+        self.logger.debug("History summary updated (%s tokens)", self._count(self.summary))
+
+    async def abuild(self, messages: List[Dict]) -> List[Dict]:
+        """
+        Return the history to send with the next question.
+
+        Args:
+            messages: All previous messages of the session, oldest first (the current
+                question excluded). Assistant content may be a result dict.
+
+        Returns:
+            list of {"role", "content"} messages: a system message with the summary of
+            older turns (if any) followed by the recent turns verbatim
+        """
+        if len(messages) < self.summarized_upto:
+            # The conversation was cleared or replaced
+            self.summary = ""
+            self.summarized_upto = 0
+
+        # Indexes refer to raw messages so summarized_upto stays valid as the session grows
+        pending = list(range(self.summarized_upto, len(messages)))
+        prepared = self._prepare([messages[i] for i in pending])
+        kept_indexes = [i for i in pending if message_content(messages[i]) and messages[i].get("role")]
+        start = self._recent_start(prepared)
+        if start > 0:
+            await self._afold(prepared[:start])
+            self.summarized_upto = kept_indexes[start - 1] + 1
+
+        history = []
+        if self.summary:
+            history.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+        history.extend(prepared[start:])
+        return history
+
+    def reset(self) -> None:
+        self.summary = ""
+        self.summarized_upto = 0
+        self._token_counts.clear()
@@ -1,21 +1,125 @@
 # Classifier agent for message classification
 
 import json
+import re
 import litellm
-from typing import Dict
-from .logging_config import get_logger
+from typing import Dict, Optional
+from .cache import LRUCache
+from .local_classifier import get_local_classifier, log_classification_decision
+from .logging_config import get_logger, payload
+from .tracing import atraced_completion, traced_completion
 from ..constants.prompts import CLASSIFICATION_PROMPT
 
+# Process-wide classification cache, shared by every session (Streamlit only
+# imports this module once per server process)
+CLASSIFICATION_CACHE_SIZE = 2048
+CLASSIFICATION_CACHE_TTL_SECONDS = 6 * 60 * 60
+_classification_cache = LRUCache(
+    max_size=CLASSIFICATION_CACHE_SIZE, ttl_seconds=CLASSIFICATION_CACHE_TTL_SECONDS
+)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_message(user_message: str) -> str:
+    """Normalize a message for cache lookups: case, surrounding/trailing punctuation and whitespace."""
+    text = _WHITESPACE_RE.sub(" ", str(user_message or "")).strip().lower()
+    return text.rstrip("?!. ").strip()
+
+
 class ClassifierAgent:
     """Agent that classifies user messages into chit-chat or data queries, and determines if visualization is needed."""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, use_local_classifier: bool = True):
         self.logger = get_logger(__name__)
         self.api_key = api_key
         self.model = "gpt-4o-mini"
         
         # Set OpenAI API key for litellm
         litellm.api_key = api_key
+        self.cache = _classification_cache
+        self.local_classifier = get_local_classifier() if use_local_classifier else None
+
+    def cache_stats(self) -> Dict:
+        """Return hit/miss statistics of the shared classification cache."""
+        return self.cache.stats()
+        
+    def _precheck(self, user_message: str, cache_key: str) -> Optional[Dict]:
+        """Return a classification from the cache or the local pre-classifier, if confident."""
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            self.logger.debug("Classification cache hit for: %s", payload(cache_key, 100))
+            return dict(cached)
+
+        # Route unambiguous messages locally; only low-confidence ones pay for an LLM call
+        if self.local_classifier is not None:
+            local = self.local_classifier.classify(user_message)
+            if self.local_classifier.is_confident(local):
+                self.logger.info("Local classification: %s, needs_visualization: %s (confidence %.2f)", local['message_type'], local['needs_visualization'], local['confidence'])
+                return local
+        return None
+
+    def _completion_kwargs(self, user_message: str) -> Dict:
+        """Build the litellm request for classifying user_message."""
+        prompt = CLASSIFICATION_PROMPT.format(user_message=user_message)
+        return {
+            "model": f"openai/{self.model}",
+            "messages": [
+                {"role": "system", "content": "You are a helpful classification assistant. Always respond with valid JSON."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0,
+            "response_format": {"type": "json_object"},
+        }
+
+    def _parse_response(self, response, user_message: str, cache_key: str) -> Dict:
+        """Validate the LLM response, then cache and log the decision."""
+        # Extract the response
+        content = response.choices[0].message.content
+        self.logger.debug("Classification response: %s", payload(content))
+        
+        # Parse JSON response
+        classification = json.loads(content)
+        
+        # Validate response structure
+        if "message_type" not in classification:
+            raise ValueError("Missing 'message_type' in classification response")
+        if "needs_visualization" not in classification:
+            raise ValueError("Missing 'needs_visualization' in classification response")
+        
+        # Ensure message_type is valid
+        if classification["message_type"] not in ["chit_chat", "data_query"]:
+            self.logger.warning("Invalid message_type: %s, defaulting to 'data_query'", classification['message_type'])
+            classification["message_type"] = "data_query"
+        
+        self.logger.info("Classification: %s, needs_visualization: %s", classification['message_type'], classification['needs_visualization'])
+
+        # Only successful LLM classifications are cached; fallbacks below are not
+        self.cache.set(cache_key, dict(classification))
+        try:
+            log_classification_decision(user_message, classification)
+        except OSError as e:
+            self.logger.warning("Could not log classification decision: %s", e)
+        
+        return classification
+
+    def _fallback(self, error: Exception) -> Dict:
+        """Default to data_query when the LLM call or its parsing fails."""
+        if isinstance(error, json.JSONDecodeError):
+            self.logger.error("Failed to parse classification JSON: %s", error)
+            return {
+                "message_type": "data_query",
+                "needs_visualization": False,
+                "reasoning": "Failed to parse classification response"
+            }
+        self.logger.error("Error in classify_message: %s", error)
+        import traceback
+        self.logger.error(traceback.format_exc())
+        return {
+            "message_type": "data_query",
+            "needs_visualization": False,
+            "reasoning": f"Error during classification: {str(error)}"
+        }
         
     def classify_message(self, user_message: str) -> Dict:
         """
@@ -28,61 +132,42 @@ class ClassifierAgent:
             
         Returns:
             dict with keys: message_type, needs_visualization, reasoning
+            (plus confidence when answered by the local pre-classifier)
         """
-        self.logger.debug(f"Classifying message: {user_message[:100]}")
+        self.logger.debug("Classifying message: %s", payload(user_message, 100))
+
+        cache_key = normalize_message(user_message)
+        precheck = self._precheck(user_message, cache_key)
+        if precheck is not None:
+            return precheck
         
         try:
-            # Format the prompt
-            prompt = CLASSIFICATION_PROMPT.format(user_message=user_message)
-            
-            # Call OpenAI via litellm
-            response = litellm.completion(
-                model=f"openai/{self.model}",
-                messages=[
-                    {"role": "system", "content": "You are a helpful classification assistant. Always respond with valid JSON."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0,
-                response_format={"type": "json_object"}
-            )
-            
-            # Extract the response
-            content = response.choices[0].message.content
-            self.logger.debug(f"Classification response: {content}")
-            
-            # Parse JSON response
-            classification = json.loads(content)
-            
-            # Validate response structure
-            if "message_type" not in classification:
-                raise ValueError("Missing 'message_type' in classification response")
-            if "needs_visualization" not in classification:
-                raise ValueError("Missing 'needs_visualization' in classification response")
-            
-            # Ensure message_type is valid
-            if classification["message_type"] not in ["chit_chat", "data_query"]:
-                self.logger.warning(f"Invalid message_type: {classification['message_type']}, defaulting to 'data_query'")
-                classification["message_type"] = "data_query"
-            
-            self.logger.info(f"Classification: {classification['message_type']}, needs_visualization: {classification['needs_visualization']}")
-            
-            return classification
-            
-        except json.JSONDecodeError as e:
-            self.logger.error(f"Failed to parse classification JSON: {e}")
-            # Default to data_query if parsing fails
-            return {
-                "message_type": "data_query",
-                "needs_visualization": False,
-                "reasoning": "Failed to parse classification response"
-            }
+            response = traced_completion("classifier", **self._completion_kwargs(user_message))
+            return self._parse_response(response, user_message, cache_key)
         except Exception as e:
-            self.logger.error(f"Error in classify_message: {e}")
-            import traceback
-            self.logger.error(traceback.format_exc())
-            # Default to data_query on error
-            return {
-                "message_type": "data_query",
-                "needs_visualization": False,
-                "reasoning": f"Error during classification: {str(e)}"
-            }
+            return self._fallback(e)
+
+    async def aclassify_message(self, user_message: str) -> Dict:
+        """
+        Async variant of classify_message built on litellm.acompletion.
+
+        Does not block the event loop while waiting for the LLM.
+
+        Args:
+            user_message: The user's input message
+
+        Returns:
+            dict with keys: message_type, needs_visualization, reasoning
+        """
+        self.logger.debug("Classifying message (async): %s", payload(user_message, 100))
+
+        cache_key = normalize_message(user_message)
+        precheck = self._precheck(user_message, cache_key)
+        if precheck is not None:
+            return precheck
+
+        try:
+            response = await atraced_completion("classifier", **self._completion_kwargs(user_message))
+            return self._parse_response(response, user_message, cache_key)
+        except Exception as e:
+            return self._fallback(e)
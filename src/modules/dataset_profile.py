@@ -0,0 +1,104 @@
+# Precomputed dataset profile for agent and plot prompts
+
+import threading
+from typing import Dict
+import pandas as pd
+from .cache import LRUCache
+from .logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Columns with at most this many distinct values get their top values listed
+PROFILE_MAX_CATEGORICAL_UNIQUE = 25
+PROFILE_TOP_K = 5
+PROFILE_MAX_VALUE_CHARS = 40
+PROFILE_CACHE_SIZE = 32
+
+_profile_cache = LRUCache(max_size=PROFILE_CACHE_SIZE)
+_profile_lock = threading.Lock()
+
+
+def _format_value(value) -> str:
+    text = str(value)
+    if len(text) > PROFILE_MAX_VALUE_CHARS:
+        text = text[: PROFILE_MAX_VALUE_CHARS - 3] + "..."
+    return text
+
+
+def build_profile(df: pd.DataFrame) -> Dict:
+    """
+    Compute a compact profile of a DataFrame with vectorized pandas operations.
+
+    Args:
+        df: The dataset
+
+    Returns:
+        dict with row count and, per column: dtype, null count, distinct count,
+        min/max for numeric and datetime columns and top values for low-cardinality ones
+    """
+    null_counts = df.isna().sum()
+    try:
+        unique_counts = df.nunique(dropna=True)
+    except TypeError:
+        unique_counts = df.astype(str).nunique(dropna=True)
+
+    ranged = df.select_dtypes(include=["number", "datetime", "datetimetz"]).select_dtypes(exclude=["bool"])
+    minimums = ranged.min() if not ranged.empty else pd.Series(dtype=object)
+    maximums = ranged.max() if not ranged.empty else pd.Series(dtype=object)
+
+    columns = []
+    for column in df.columns:
+        info = {
+            "name": str(column),
+            "dtype": str(df[column].dtype),
+            "nulls": int(null_counts[column]),
+            "unique": int(unique_counts[column]),
+        }
+        if column in minimums.index:
+            info["min"] = _format_value(minimums[column])
+            info["max"] = _format_value(maximums[column])
+        if info["unique"] <= PROFILE_MAX_CATEGORICAL_UNIQUE:
+            top = df[column].value_counts(dropna=True).head(PROFILE_TOP_K)
+            info["top_values"] = [(_format_value(v), int(c)) for v, c in top.items()]
+        columns.append(info)
+
+    return {"rows": int(len(df)), "columns": columns}
+
+
+def format_profile(profile: Dict) -> str:
+    """Render a profile as plain text for LLM prompts."""
+    lines = [f"Rows: {profile['rows']}", f"Columns ({len(profile['columns'])}):"]
+    for info in profile["columns"]:
+        parts = [f"dtype={info['dtype']}", f"nulls={info['nulls']}", f"unique={info['unique']}"]
+        if "min" in info:
+            parts.append(f"min={info['min']}")
+            parts.append(f"max={info['max']}")
+        if "top_values" in info:
+            top = ", ".join(f"{value} ({count})" for value, count in info["top_values"])
+            parts.append(f"top=[{top}]")
+        lines.append(f"- {info['name']}: " + ", ".join(parts))
+    return "\n".join(lines)
+
+
+def get_dataset_profile(df: pd.DataFrame, dataset_fingerprint: str) -> str:
+    """
+    Return the formatted profile of a dataset, computing it once per fingerprint.
+
+    Args:
+        df: The dataset
+        dataset_fingerprint: Identity of the dataset (see fingerprint.py)
+
+    Returns:
+        str: Profile text ready to be placed in prompts
+    """
+    cached = _profile_cache.get(dataset_fingerprint)
+    if cached is not None:
+        return cached
+    with _profile_lock:
+        cached = _profile_cache.get(dataset_fingerprint)
+        if cached is not None:
+            return cached
+        profile_text = format_profile(build_profile(df))
+        _profile_cache.set(dataset_fingerprint, profile_text)
+        logger.info("Computed dataset profile for %s (%s chars)", dataset_fingerprint, len(profile_text))
+        return profile_text
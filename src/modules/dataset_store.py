@@ -0,0 +1,207 @@
+# Memory-mapped, read-only dataset copies shared by sessions and worker processes
+
+import glob
+import os
+import threading
+from typing import Iterable, Optional
+import pandas as pd
+from .cache import LRUCache
+from .logging_config import get_logger
+
+DATASET_STORE_DIR = os.getenv("DATASET_STORE_DIR", os.path.join(".cache", "datasets"))
+
+# Attached frames kept per process; the data itself lives in the OS page cache
+DATASET_STORE_MAX_ATTACHED = 16
+
+# Disk bounds of the store; least recently used files are deleted beyond them
+DATASET_STORE_MAX_MB = int(os.getenv("DATASET_STORE_MAX_MB", "10240"))
+DATASET_STORE_MAX_FILES = int(os.getenv("DATASET_STORE_MAX_FILES", "64"))
+
+
+def attach_dataset(path: str) -> pd.DataFrame:
+    """
+    Map an Arrow IPC file into memory and wrap it as a DataFrame.
+
+    Numeric columns without nulls and Arrow-backed string columns reference the
+    mapped pages directly; other columns are materialized.
+
+    Args:
+        path: Arrow IPC file written by DatasetStore.put
+
+    Returns:
+        pd.DataFrame
+    """
+    import pyarrow as pa
+    source = pa.memory_map(path, "r")
+    table = pa.ipc.open_file(source).read_all()
+    # One block per column, so zero-copy columns are not consolidated into a copy
+    return table.to_pandas(split_blocks=True)
+
+
+class DatasetStore:
+    """One read-only columnar copy of each dataset on local disk, keyed by fingerprint.
+
+    Files are uncompressed Arrow IPC, so every attach is a memory map: Streamlit
+    sessions, agent executors and sandbox workers that use the same fingerprint
+    share the same pages instead of holding private copies. Needs pyarrow; without
+    it nothing is stored and callers keep their own DataFrames.
+
+    The files are never modified. Each attach returns a shallow copy of the mapped
+    frame, so a caller that adds columns or edits values (copy-on-write) changes
+    only its own copy, never the file or other callers' frames.
+
+    The directory is bounded by max_files and max_bytes. A file's mtime records its
+    last use, and the least recently used files are deleted after each write. Deleting
+    a file that is still mapped is safe on POSIX: existing mappings stay valid, and the
+    next attach misses.
+    """
+
+    def __init__(
+        self,
+        store_dir: str = DATASET_STORE_DIR,
+        max_attached: int = DATASET_STORE_MAX_ATTACHED,
+        max_bytes: int = DATASET_STORE_MAX_MB * 1024 * 1024,
+        max_files: int = DATASET_STORE_MAX_FILES,
+    ):
+        self.logger = get_logger(__name__)
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.attached = LRUCache(max_size=max_attached)
+        self._lock = threading.Lock()
+        os.makedirs(store_dir, exist_ok=True)
+
+    def path(self, fingerprint: str) -> str:
+        return os.path.join(self.store_dir, f"{fingerprint}.arrow")
+
+    def contains(self, fingerprint: str) -> bool:
+        return os.path.exists(self.path(fingerprint))
+
+    def _touch(self, fingerprint: str) -> None:
+        try:
+            os.utime(self.path(fingerprint))
+        except OSError:
+            pass
+
+    def evict(self, keep: Iterable[str] = ()) -> int:
+        """
+        Delete least recently used files until the store is within max_files and max_bytes.
+
+        Args:
+            keep: Fingerprints never deleted (e.g. the file just written)
+
+        Returns:
+            int: Number of files deleted
+        """
+        keep_paths = {self.path(fingerprint) for fingerprint in keep}
+        files = []
+        for path in glob.glob(os.path.join(self.store_dir, "*.arrow")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        count, total = len(files), sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, path in files:
+            if count <= self.max_files and total <= self.max_bytes:
+                break
+            if path in keep_paths:
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                # Still open elsewhere on platforms that forbid deleting mapped files
+                self.logger.debug("Could not delete %s: %s", path, e)
+                continue
+            self.attached.delete(os.path.basename(path)[: -len(".arrow")])
+            count, total, removed = count - 1, total - size, removed + 1
+        if removed:
+            self.logger.info("Evicted %s stored datasets (%s files, %.1f MB left)", removed, count, total / 1e6)
+        return removed
+
+    def _write(self, fingerprint: str, df: pd.DataFrame) -> None:
+        import pyarrow as pa
+        path = self.path(fingerprint)
+        table = pa.Table.from_pandas(df)
+        # Write under a temporary name so concurrent readers never map a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+        self.logger.info("Stored dataset %s (%s bytes)", fingerprint, os.path.getsize(path))
+
+    def ensure(self, fingerprint: str, df: pd.DataFrame) -> Optional[str]:
+        """
+        Store a dataset if it is not stored yet.
+
+        Args:
+            fingerprint: Identity of the dataset (see fingerprint.py)
+            df: The dataset
+
+        Returns:
+            str path of the stored file, or None if it could not be stored
+        """
+        if self.contains(fingerprint):
+            self._touch(fingerprint)
+            return self.path(fingerprint)
+        with self._lock:
+            if self.contains(fingerprint):
+                return self.path(fingerprint)
+            try:
+                self._write(fingerprint, df)
+                self.evict(keep=(fingerprint,))
+                return self.path(fingerprint)
+            except ImportError:
+                self.logger.info("pyarrow not installed; datasets are not shared")
+            except Exception as e:
+                self.logger.warning("Could not store dataset %s: %s", fingerprint, e)
+            return None
+
+    def attach(self, fingerprint: str) -> Optional[pd.DataFrame]:
+        """Return the caller's own shallow copy of a stored dataset, or None if not stored."""
+        df = self.attached.get(fingerprint)
+        if df is not None:
+            self._touch(fingerprint)
+            return df.copy(deep=False)
+        if not self.contains(fingerprint):
+            return None
+        self._touch(fingerprint)
+        try:
+            df = attach_dataset(self.path(fingerprint))
+        except Exception as e:
+            self.logger.warning("Could not attach dataset %s: %s", fingerprint, e)
+            return None
+        self.attached.set(fingerprint, df)
+        return df.copy(deep=False)
+
+    def put(self, fingerprint: str, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Store a dataset and return its shared, memory-mapped form.
+
+        Args:
+            fingerprint: Identity of the dataset
+            df: The dataset (a private copy the caller can drop afterwards)
+
+        Returns:
+            pd.DataFrame: a shallow copy attached to the stored file, or df itself if it could not be stored
+        """
+        if self.ensure(fingerprint, df) is None:
+            return df
+        attached = self.attach(fingerprint)
+        return attached if attached is not None else df
+
+
+_dataset_store = None
+_dataset_store_lock = threading.Lock()
+
+
+def get_dataset_store() -> DatasetStore:
+    """Return the process-wide DatasetStore."""
+    global _dataset_store
+    with _dataset_store_lock:
+        if _dataset_store is None:
+            _dataset_store = DatasetStore()
+        return _dataset_store
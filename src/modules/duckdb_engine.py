@@ -0,0 +1,274 @@
+# DuckDB engine: SQL over CSV/Parquet files without loading them into pandas
+
+import os
+import threading
+from typing import List, Optional, Tuple
+import pandas as pd
+from .cache import LRUCache
+from .dataset_profile import PROFILE_MAX_CATEGORICAL_UNIQUE, PROFILE_TOP_K, _format_value, format_profile
+from .fingerprint import fingerprint_bytes
+from .logging_config import get_logger, payload
+
+# Memory DuckDB may use per dataset; larger intermediates spill to DUCKDB_CACHE_DIR
+DUCKDB_MEMORY_LIMIT_MB = int(os.getenv("DUCKDB_MEMORY_LIMIT_MB", "1024"))
+DUCKDB_THREADS = int(os.getenv("DUCKDB_THREADS", "0"))  # 0 keeps DuckDB's default (all cores)
+# Rows of a query result turned into pandas; the rest is dropped and the sql_query observation says so
+DUCKDB_MAX_RESULT_ROWS = int(os.getenv("DUCKDB_MAX_RESULT_ROWS", "10000"))
+DUCKDB_QUERY_TIMEOUT_SECONDS = float(os.getenv("DUCKDB_QUERY_TIMEOUT_SECONDS", "60"))
+# CSV files are converted once to Parquet, whose row groups allow projection and filter pushdown
+DUCKDB_CONVERT_CSV = os.getenv("DUCKDB_CONVERT_CSV", "true").lower() in ("1", "true", "yes")
+DUCKDB_CACHE_DIR = os.getenv("DUCKDB_CACHE_DIR", os.path.join(".cache", "duckdb"))
+DUCKDB_MAX_DATASETS = 8
+
+# Name of the dataset in SQL, matching the 'df' of the pandas engine
+DUCKDB_TABLE = "df"
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+RANGED_TYPE_PREFIXES = ("TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT", "UTINYINT", "USMALLINT",
+                        "UINTEGER", "UBIGINT", "FLOAT", "DOUBLE", "DECIMAL", "DATE", "TIMESTAMP", "TIME")
+
+
+class DuckDBQueryError(Exception):
+    """A query was rejected or failed; the message is meant for the agent."""
+
+
+def duckdb_available() -> bool:
+    try:
+        import duckdb  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def source_fingerprint(path: str) -> str:
+    """
+    Identity of a data file from its path, size and modification time.
+
+    Hashing the contents of a multi-GB file on every start would cost more than the
+    queries, so unlike fingerprint_file this does not read the file.
+    """
+    stat = os.stat(path)
+    return fingerprint_bytes(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+
+
+def _sql_string(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+class DuckDBDataset:
+    """One CSV or Parquet file exposed to SQL as the view `df`.
+
+    Nothing is loaded up front: each query scans the file, reading only the columns
+    and row groups it needs, within a fixed memory limit. CSV sources are first
+    converted to a Parquet copy in DUCKDB_CACHE_DIR (once per file version) so that
+    pushdown applies to them as well. Only query results, capped at max_result_rows,
+    become pandas objects.
+    """
+
+    def __init__(
+        self,
+        source_path: str,
+        fingerprint: Optional[str] = None,
+        memory_limit_mb: int = DUCKDB_MEMORY_LIMIT_MB,
+        threads: int = DUCKDB_THREADS,
+        max_result_rows: int = DUCKDB_MAX_RESULT_ROWS,
+        timeout_seconds: float = DUCKDB_QUERY_TIMEOUT_SECONDS,
+        convert_csv: bool = DUCKDB_CONVERT_CSV,
+        cache_dir: str = DUCKDB_CACHE_DIR,
+    ):
+        import duckdb
+
+        self.logger = get_logger(__name__)
+        self.source_path = source_path
+        self.fingerprint = fingerprint or source_fingerprint(source_path)
+        self.max_result_rows = max_result_rows
+        self.timeout_seconds = timeout_seconds
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+        config = {"memory_limit": f"{memory_limit_mb}MB", "temp_directory": os.path.join(cache_dir, "spill")}
+        if threads > 0:
+            config["threads"] = threads
+        self.con = duckdb.connect(":memory:", config=config)
+        self.scan_path = self._prepare_source(convert_csv)
+        self.con.execute(f"CREATE VIEW {DUCKDB_TABLE} AS SELECT * FROM {self._scan(self.scan_path)}")
+        self._restrict_file_access()
+        self._lock = threading.Lock()
+        self._profile: Optional[str] = None
+        self._row_count: Optional[int] = None
+
+    @staticmethod
+    def _scan(path: str) -> str:
+        if path.lower().endswith(PARQUET_EXTENSIONS):
+            return f"read_parquet({_sql_string(path)})"
+        return f"read_csv_auto({_sql_string(path)}, sample_size=100000)"
+
+    def _prepare_source(self, convert_csv: bool) -> str:
+        """Path the view scans: the source itself, or its Parquet copy for CSV files."""
+        path = os.path.abspath(self.source_path)
+        if path.lower().endswith(PARQUET_EXTENSIONS) or not convert_csv:
+            return path
+        target = os.path.join(self.cache_dir, f"{self.fingerprint}.parquet")
+        if os.path.exists(target):
+            return target
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        self.logger.info("Converting %s to Parquet for pushdown", path)
+        # Streams through DuckDB within the memory limit; written under a temporary name
+        # so concurrent processes never scan a partial file
+        self.con.execute(
+            f"COPY (SELECT * FROM {self._scan(path)}) TO {_sql_string(tmp_path)} (FORMAT PARQUET, COMPRESSION ZSTD)"
+        )
+        os.replace(tmp_path, target)
+        return target
+
+    def _restrict_file_access(self) -> None:
+        """Limit SQL to the dataset file, so queries cannot read or write other files."""
+        import duckdb
+
+        try:
+            self.con.execute(f"SET allowed_paths = [{_sql_string(self.scan_path)}]")
+            self.con.execute("SET enable_external_access = false")
+            self.con.execute("SET lock_configuration = true")
+        except duckdb.Error as e:
+            # allowed_paths needs DuckDB >= 1.3; queries are still limited to SELECT
+            self.logger.warning("Could not restrict DuckDB file access: %s", e)
+
+    def columns(self) -> List[Tuple[str, str]]:
+        """(name, DuckDB type) of every column."""
+        with self._lock:
+            rows = self.con.execute(f"DESCRIBE {DUCKDB_TABLE}").fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def row_count(self) -> int:
+        if self._row_count is None:
+            with self._lock:
+                # Answered from Parquet metadata without reading the data
+                (self._row_count,) = self.con.execute(f"SELECT COUNT(*) FROM {DUCKDB_TABLE}").fetchone()
+        return self._row_count
+
+    def profile(self) -> str:
+        """
+        Dataset profile in the same format as dataset_profile.get_dataset_profile.
+
+        Computed once with SUMMARIZE (one scan) plus a GROUP BY per low-cardinality
+        column; null and distinct counts are DuckDB's estimates.
+        """
+        if self._profile is not None:
+            return self._profile
+        with self._lock:
+            summary = self.con.execute(f"SUMMARIZE {DUCKDB_TABLE}").fetchdf()
+            rows = int(summary["count"].iloc[0]) if len(summary) else 0
+            columns = []
+            for record in summary.to_dict("records"):
+                name, column_type = record["column_name"], record["column_type"]
+                null_percentage = float(record.get("null_percentage") or 0)
+                info = {
+                    "name": name,
+                    "dtype": column_type,
+                    "nulls": int(round(rows * null_percentage / 100)),
+                    "unique": int(record.get("approx_unique") or 0),
+                }
+                if column_type.upper().startswith(RANGED_TYPE_PREFIXES) and record.get("min") is not None:
+                    info["min"] = _format_value(record["min"])
+                    info["max"] = _format_value(record["max"])
+                if info["unique"] <= PROFILE_MAX_CATEGORICAL_UNIQUE:
+                    quoted = '"' + name.replace('"', '""') + '"'
+                    top = self.con.execute(
+                        f"SELECT {quoted}, COUNT(*) AS n FROM {DUCKDB_TABLE} WHERE {quoted} IS NOT NULL "
+                        f"GROUP BY 1 ORDER BY n DESC LIMIT {PROFILE_TOP_K}"
+                    ).fetchall()
+                    info["top_values"] = [(_format_value(value), int(count)) for value, count in top]
+                columns.append(info)
+            self._row_count = rows
+            self._profile = format_profile({"rows": rows, "columns": columns})
+        self.logger.info("Computed DuckDB profile for %s (%s chars)", self.fingerprint, len(self._profile))
+        return self._profile
+
+    def _validate(self, sql: str) -> str:
+        import duckdb
+
+        sql = sql.strip().rstrip(";").strip()
+        if not sql:
+            raise DuckDBQueryError("Empty query")
+        try:
+            statements = self.con.extract_statements(sql)
+        except duckdb.Error as e:
+            raise DuckDBQueryError(f"Invalid SQL: {e}")
+        if len(statements) != 1:
+            raise DuckDBQueryError("Run exactly one statement per call")
+        if statements[0].type not in (duckdb.StatementType.SELECT, duckdb.StatementType.EXPLAIN):
+            raise DuckDBQueryError("Only read-only SELECT queries are allowed")
+        return sql
+
+    def query(self, sql: str) -> pd.DataFrame:
+        """
+        Run a read-only query and return at most max_result_rows rows as a DataFrame.
+
+        When rows were dropped, df.attrs['truncated'] is True.
+
+        Args:
+            sql: One SELECT statement against the view `df`
+
+        Returns:
+            pd.DataFrame: The (capped) result
+
+        Raises:
+            DuckDBQueryError: If the query is rejected, fails or times out
+        """
+        import duckdb
+
+        sql = self._validate(sql)
+        self.logger.debug("DuckDB query: %s", payload(sql))
+        # A cursor is a separate connection to the same database, so queries run concurrently
+        cursor = self.con.cursor()
+        timer = threading.Timer(self.timeout_seconds, cursor.interrupt)
+        timer.start()
+        try:
+            cursor.execute(sql)
+            rows = cursor.fetchmany(self.max_result_rows + 1)
+            columns = [d[0] for d in cursor.description or []]
+        except duckdb.InterruptException:
+            raise DuckDBQueryError(f"Query timed out after {self.timeout_seconds:g} seconds; aggregate or filter more")
+        except duckdb.Error as e:
+            raise DuckDBQueryError(f"{type(e).__name__}: {e}")
+        finally:
+            timer.cancel()
+            cursor.close()
+        truncated = len(rows) > self.max_result_rows
+        result = pd.DataFrame.from_records(rows[: self.max_result_rows], columns=columns)
+        if truncated:
+            result.attrs["truncated"] = True
+            self.logger.info("DuckDB result capped at %s rows", self.max_result_rows)
+        return result
+
+    def close(self) -> None:
+        self.con.close()
+
+
+_datasets = LRUCache(max_size=DUCKDB_MAX_DATASETS)
+_datasets_lock = threading.Lock()
+
+
+def get_duckdb_dataset(source_path: str, fingerprint: Optional[str] = None) -> DuckDBDataset:
+    """
+    Return the process-wide DuckDBDataset for a file, opening it on first use.
+
+    Args:
+        source_path: CSV or Parquet file
+        fingerprint: Identity of the file, if already known (see source_fingerprint)
+
+    Returns:
+        DuckDBDataset shared by every agent on the file
+    """
+    if not duckdb_available():
+        raise ImportError("The duckdb engine needs the 'duckdb' package: pip install duckdb")
+    fingerprint = fingerprint or source_fingerprint(source_path)
+    dataset = _datasets.get(fingerprint)
+    if dataset is None:
+        with _datasets_lock:
+            dataset = _datasets.get(fingerprint)
+            if dataset is None:
+                dataset = DuckDBDataset(source_path, fingerprint=fingerprint)
+                _datasets.set(fingerprint, dataset)
+    return dataset
+
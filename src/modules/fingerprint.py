@@ -0,0 +1,82 @@
+# Dataset fingerprints used as cache keys for answers, plot code and profiles
+
+import hashlib
+import json
+from typing import BinaryIO, Union
+import pandas as pd
+
+CHUNK_SIZE = 1024 * 1024  # 1 MiB per read when hashing streams
+DIGEST_SIZE = 16  # 128-bit BLAKE2b digests
+
+
+def _new_hasher():
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def fingerprint_bytes(data: Union[bytes, bytearray, memoryview]) -> str:
+    """Return the fingerprint of raw file contents held in memory."""
+    hasher = _new_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def fingerprint_stream(stream: BinaryIO, chunk_size: int = CHUNK_SIZE) -> str:
+    """
+    Hash a binary file-like object in fixed-size chunks.
+
+    The stream position is restored afterwards, so the same object (for example
+    a Streamlit UploadedFile) can still be parsed by pandas.
+
+    Args:
+        stream: Readable binary file-like object
+        chunk_size: Bytes read per iteration
+
+    Returns:
+        str: Hex fingerprint, identical to fingerprint_bytes on the same contents
+    """
+    hasher = _new_hasher()
+    position = stream.tell() if hasattr(stream, "tell") else None
+    if position is not None:
+        stream.seek(0)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    if position is not None:
+        stream.seek(position)
+    return hasher.hexdigest()
+
+
+def fingerprint_file(path: str, chunk_size: int = CHUNK_SIZE) -> str:
+    """Return the fingerprint of a file on disk, read in chunks."""
+    with open(path, "rb") as f:
+        return fingerprint_stream(f, chunk_size=chunk_size)
+
+
+def fingerprint_dataframe(df: pd.DataFrame) -> str:
+    """
+    Fingerprint an in-memory DataFrame with a vectorized per-column hash.
+
+    Column names, dtypes and the index are included, so two frames only share a
+    fingerprint when their contents and schema match.
+
+    Args:
+        df: The DataFrame to fingerprint
+
+    Returns:
+        str: Hex fingerprint
+    """
+    hasher = _new_hasher()
+    hasher.update(json.dumps([str(c) for c in df.columns]).encode("utf-8"))
+    hasher.update(json.dumps([str(t) for t in df.dtypes]).encode("utf-8"))
+    hasher.update(pd.util.hash_pandas_object(df.index).values.tobytes())
+    for column in df.columns:
+        series = df[column]
+        try:
+            hashed = pd.util.hash_pandas_object(series, index=False)
+        except TypeError:
+            # Unhashable cells (lists, dicts) fall back to their string form
+            hashed = pd.util.hash_pandas_object(series.astype(str), index=False)
+        hasher.update(hashed.values.tobytes())
+    return hasher.hexdigest()
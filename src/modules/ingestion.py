@@ -0,0 +1,150 @@
+# Memory-optimized CSV ingestion
+
+import warnings
+from typing import Dict, List, Tuple
+import numpy as np
+import pandas as pd
+from .logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Rows read up front to infer column types
+SAMPLE_ROWS = 20000
+
+# Object columns whose sampled distinct/non-null ratio is at most this become categoricals
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+CATEGORY_MAX_UNIQUE = 10000
+
+# Share of sampled values that must parse as dates for a column to be read as datetime
+DATETIME_MIN_PARSE_RATIO = 0.95
+
+# Integers are not downcast below this width: int8/int16 arithmetic in generated
+# pandas code (e.g. df['Pclass'] * 1000) would silently overflow
+MIN_INT_DTYPE = np.int32
+
+
+def _pyarrow_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _looks_like_datetime(values: pd.Series) -> bool:
+    non_null = values.dropna()
+    if non_null.empty:
+        return False
+    # Purely numeric strings (ids, years stored as text) are not treated as dates
+    if pd.to_numeric(non_null, errors="coerce").notna().mean() > 0.5:
+        return False
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        parsed = pd.to_datetime(non_null, errors="coerce", format="mixed")
+    return parsed.notna().mean() >= DATETIME_MIN_PARSE_RATIO
+
+
+def infer_dtypes(sample: pd.DataFrame) -> Tuple[Dict[str, str], List[str]]:
+    """
+    Infer compact dtypes for the text columns of a sample.
+
+    Args:
+        sample: The first rows of the CSV, read with default dtypes
+
+    Returns:
+        tuple: (dtype map for pd.read_csv, list of columns to parse as dates)
+    """
+    string_dtype = "string[pyarrow]" if _pyarrow_available() else None
+    dtype_map: Dict[str, str] = {}
+    parse_dates: List[str] = []
+    for column in sample.columns:
+        values = sample[column]
+        # Text is 'object' before pandas 3 and the 'str' dtype from pandas 3 on
+        if not (pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)):
+            continue
+        if _looks_like_datetime(values):
+            parse_dates.append(column)
+            continue
+        non_null = values.dropna()
+        n_unique = non_null.nunique()
+        if len(non_null) and n_unique <= CATEGORY_MAX_UNIQUE and n_unique / len(non_null) <= CATEGORY_MAX_UNIQUE_RATIO:
+            dtype_map[column] = "category"
+        elif string_dtype:
+            dtype_map[column] = string_dtype
+    return dtype_map, parse_dates
+
+
+def downcast_numeric(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcast numeric columns in place where it is lossless.
+
+    Integers are narrowed down to MIN_INT_DTYPE; floats become float32 only when
+    every value round-trips exactly, so query results are unchanged.
+    """
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_bool_dtype(series):
+            continue
+        if pd.api.types.is_integer_dtype(series) and isinstance(series.dtype, np.dtype) and series.dtype.kind in "iu":
+            downcast = pd.to_numeric(series, downcast="integer")
+            if downcast.dtype.itemsize < np.dtype(MIN_INT_DTYPE).itemsize:
+                downcast = downcast.astype(MIN_INT_DTYPE)
+            if downcast.dtype.itemsize < series.dtype.itemsize:
+                df[column] = downcast
+        elif pd.api.types.is_float_dtype(series) and series.dtype == np.float64:
+            downcast = series.astype(np.float32)
+            if np.array_equal(downcast.to_numpy(dtype=np.float64), series.to_numpy(), equal_nan=True):
+                df[column] = downcast
+    return df
+
+
+def read_csv_optimized(source, sample_rows: int = SAMPLE_ROWS, **read_csv_kwargs) -> Tuple[pd.DataFrame, Dict]:
+    """
+    Read a CSV with compact dtypes inferred from a sample of the file.
+
+    Low-cardinality text becomes categorical, other text Arrow-backed strings (when
+    pyarrow is installed), date-like columns are parsed, and numbers are downcast.
+
+    Args:
+        source: Path or binary file-like object (e.g. a Streamlit UploadedFile)
+        sample_rows: Number of rows used for type inference
+        **read_csv_kwargs: Extra arguments forwarded to pd.read_csv
+
+    Returns:
+        tuple: (DataFrame, report dict with memory usage before/after and converted columns)
+    """
+    is_stream = hasattr(source, "read")
+    sample = pd.read_csv(source, nrows=sample_rows, **read_csv_kwargs)
+    if is_stream:
+        source.seek(0)
+    dtype_map, parse_dates = infer_dtypes(sample)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        df = pd.read_csv(source, dtype=dtype_map or None, parse_dates=parse_dates or None, **read_csv_kwargs)
+    if is_stream:
+        source.seek(0)
+    downcast_numeric(df)
+
+    # The naive footprint is extrapolated from the sample, which was read with default dtypes
+    sample_bytes = int(sample.memory_usage(deep=True).sum())
+    memory_before = int(sample_bytes / max(len(sample), 1) * len(df)) if len(sample) < len(df) else sample_bytes
+    memory_after = int(df.memory_usage(deep=True).sum())
+    converted = {
+        str(column): str(df[column].dtype)
+        for column in df.columns
+        if str(df[column].dtype) != str(sample[column].dtype)
+    }
+    report = {
+        "rows": len(df),
+        "columns": len(df.columns),
+        "memory_before_bytes": memory_before,
+        "memory_after_bytes": memory_after,
+        "reduction_ratio": (memory_before / memory_after) if memory_after else 1.0,
+        "converted_columns": converted,
+    }
+    logger.info(
+        "Optimized CSV ingestion: %s rows, memory %.1f MB -> %.1f MB (%.1fx)",
+        len(df), memory_before / 1e6, memory_after / 1e6, report["reduction_ratio"],
+    )
+    return df, report
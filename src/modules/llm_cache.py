@@ -0,0 +1,294 @@
+# Content-addressed LLM completion cache shared by every process on the host
+
+import hashlib
+import json
+import os
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence
+import litellm
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, Generation
+from langchain_openai import ChatOpenAI
+from .cache import SQLiteCache
+from .logging_config import get_logger
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(".cache", "llm_completions.sqlite3"))
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", "256"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000"))
+# Calls sampled above this temperature are meant to vary and are never cached
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.3"))
+
+# Request fields that change the completion; everything else (api_key, timeouts) is ignored.
+# The endpoint is always part of the key (see request_endpoint)
+KEY_FIELDS = ("model", "messages", "tools", "tool_choice", "temperature", "response_format", "max_tokens", "stop", "seed")
+
+DEFAULT_OPENAI_ENDPOINT = "https://api.openai.com/v1"
+
+
+def default_endpoint() -> str:
+    """Endpoint OpenAI clients use when none is passed, read at call time (tests and benchmarks override it)."""
+    return os.getenv("OPENAI_BASE_URL") or os.getenv("OPENAI_API_BASE") or DEFAULT_OPENAI_ENDPOINT
+
+
+def request_endpoint(request: Dict) -> str:
+    """Endpoint a request goes to, so responses of different servers (e.g. a stub) never mix."""
+    return str(request.get("api_base") or request.get("base_url") or default_endpoint()).rstrip("/")
+
+
+def _canonical(value: Any) -> Any:
+    """JSON-compatible form of request values (pydantic models, tuples) for hashing."""
+    if hasattr(value, "model_dump"):
+        return value.model_dump()
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+class LLMCompletionCache:
+    """Stores LLM responses keyed by a hash of the request that produced them.
+
+    Backed by SQLiteCache (WAL mode, LRU eviction by row count and total bytes),
+    so every Streamlit replica on a host reads and fills the same file. Only
+    low-temperature, non-streaming requests are cached.
+    """
+
+    def __init__(self, backend: SQLiteCache, max_temperature: float = LLM_CACHE_MAX_TEMPERATURE):
+        self.logger = get_logger(__name__)
+        self.backend = backend
+        self.max_temperature = max_temperature
+
+    @staticmethod
+    def make_key(namespace: str, request: Dict) -> str:
+        """
+        Build the cache key for a request.
+
+        Args:
+            namespace: Client the request comes from ('litellm', 'langchain'), since their
+                stored formats differ
+            request: Request fields; only KEY_FIELDS and the endpoint are hashed
+
+        Returns:
+            str: Hex digest used as the cache key
+        """
+        fields = {field: _canonical(request.get(field)) for field in KEY_FIELDS if request.get(field) is not None}
+        fields["endpoint"] = request_endpoint(request)
+        raw = json.dumps([namespace, fields], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def is_cacheable(self, request: Dict) -> bool:
+        """Whether a litellm request is deterministic enough to be served from the cache."""
+        if request.get("stream") or request.get("n", 1) != 1:
+            return False
+        temperature = request.get("temperature")
+        # Provider default temperatures sample freely
+        return temperature is not None and temperature <= self.max_temperature
+
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            self.logger.warning("LLM cache lookup failed: %s", e)
+            return None
+
+    def set(self, key: str, value: Any) -> None:
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            self.logger.warning("Could not store LLM response in cache: %s", e)
+
+    def get_completion(self, request: Dict) -> Optional[litellm.ModelResponse]:
+        """Return the cached litellm response for a request, or None."""
+        if not self.is_cacheable(request):
+            return None
+        payload = self.get(self.make_key("litellm", request))
+        if payload is None:
+            return None
+        response = litellm.ModelResponse(**payload)
+        # Nothing was spent on this call
+        response.usage = litellm.Usage(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+        return response
+
+    def set_completion(self, request: Dict, response) -> None:
+        """Store a litellm response if the request is cacheable."""
+        if not self.is_cacheable(request):
+            return
+        payload = response.model_dump() if hasattr(response, "model_dump") else dict(response)
+        self.set(self.make_key("litellm", request), payload)
+
+    def stats(self) -> Dict:
+        return self.backend.stats()
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+
+class LangChainLLMCache(BaseCache):
+    """LangChain cache over the shared completion store, for chat models.
+
+    The key is the serialized prompt messages plus LangChain's llm_string, which
+    holds the model, temperature and bound tools (and the endpoint, for CachedChatOpenAI). Cached generations are marked
+    with response_metadata['cache_hit'] and carry no token usage.
+    """
+
+    def __init__(self, cache: LLMCompletionCache):
+        self.cache = cache
+
+    def _key(self, prompt: str, llm_string: str) -> str:
+        return self.cache.make_key("langchain", {"messages": prompt, "model": llm_string})
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        payload = self.cache.get(self._key(prompt, llm_string))
+        if payload is None:
+            return None
+        try:
+            generations = [loads(item) for item in payload]
+        except Exception as e:
+            self.cache.logger.warning("Discarding unreadable LLM cache entry: %s", e)
+            return None
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            if message is not None:
+                message.response_metadata = {**(message.response_metadata or {}), "cache_hit": True}
+                if isinstance(message, AIMessage) and message.usage_metadata:
+                    message.usage_metadata = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        self.cache.set(self._key(prompt, llm_string), [dumps(generation) for generation in return_val])
+
+    def clear(self, **kwargs: Any) -> None:
+        self.cache.clear()
+
+
+def _replay_chunk(generation: Generation) -> ChatGenerationChunk:
+    """A cached chat generation as a single stream chunk, tool calls included."""
+    message = generation.message
+    tool_call_chunks = [
+        {"name": call["name"], "args": json.dumps(call["args"]), "id": call.get("id"), "index": index}
+        for index, call in enumerate(getattr(message, "tool_calls", None) or [])
+    ]
+    return ChatGenerationChunk(
+        message=AIMessageChunk(
+            content=message.content,
+            tool_call_chunks=tool_call_chunks,
+            response_metadata=message.response_metadata,
+            usage_metadata=getattr(message, "usage_metadata", None),
+            id=message.id,
+        ),
+        generation_info=generation.generation_info,
+    )
+
+
+class CachedChatOpenAI(ChatOpenAI):
+    """ChatOpenAI whose streamed calls also read and fill its cache.
+
+    LangChain consults a chat model's cache on invoke/generate only; streamed calls
+    (which the agent makes) bypass it. Here a hit replays the stored message as one
+    chunk and a miss is stored once the stream completes.
+    """
+
+    def _get_llm_string(self, stop: Optional[List[str]] = None, **kwargs: Any) -> str:
+        # The model parameters do not include the endpoint; add it to every cache key
+        endpoint = request_endpoint({"api_base": self.openai_api_base})
+        return f"{super()._get_llm_string(stop=stop, **kwargs)}---endpoint:{endpoint}"
+
+    def _stream_cache(self) -> Optional[BaseCache]:
+        return self.cache if isinstance(self.cache, BaseCache) else None
+
+    @staticmethod
+    def _merge(chunks: List[ChatGenerationChunk]) -> ChatGeneration:
+        merged = chunks[0]
+        for chunk in chunks[1:]:
+            merged = merged + chunk
+        message = merged.message
+        return ChatGeneration(
+            message=AIMessage(
+                content=message.content,
+                tool_calls=message.tool_calls,
+                invalid_tool_calls=message.invalid_tool_calls,
+                response_metadata=message.response_metadata,
+                usage_metadata=message.usage_metadata,
+                id=message.id,
+            ),
+            generation_info=merged.generation_info,
+        )
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        cache = self._stream_cache()
+        if cache is None:
+            yield from super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            return
+        prompt, llm_string = dumps(messages), self._get_llm_string(stop=stop, **kwargs)
+        cached = cache.lookup(prompt, llm_string)
+        if cached:
+            chunk = _replay_chunk(cached[0])
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+            return
+        chunks = []
+        for chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        if chunks:
+            cache.update(prompt, llm_string, [self._merge(chunks)])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        cache = self._stream_cache()
+        if cache is None:
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                yield chunk
+            return
+        prompt, llm_string = dumps(messages), self._get_llm_string(stop=stop, **kwargs)
+        cached = await cache.alookup(prompt, llm_string)
+        if cached:
+            chunk = _replay_chunk(cached[0])
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+            return
+        chunks = []
+        async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        if chunks:
+            await cache.aupdate(prompt, llm_string, [self._merge(chunks)])
+
+
+_llm_cache = None
+_langchain_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> Optional[LLMCompletionCache]:
+    """Return the process-wide LLMCompletionCache, or None if LLM_CACHE_ENABLED is off."""
+    global _llm_cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            backend = SQLiteCache(
+                LLM_CACHE_PATH,
+                max_entries=LLM_CACHE_MAX_ENTRIES,
+                table="llm_completions",
+                max_bytes=LLM_CACHE_MAX_MB * 1024 * 1024,
+            )
+            _llm_cache = LLMCompletionCache(backend)
+        return _llm_cache
+
+
+def get_langchain_llm_cache() -> Optional[LangChainLLMCache]:
+    """Return the LangChain view of the process-wide LLM cache, or None if disabled."""
+    global _langchain_llm_cache
+    cache = get_llm_cache()
+    if cache is None:
+        return None
+    with _llm_cache_lock:
+        if _langchain_llm_cache is None:
+            _langchain_llm_cache = LangChainLLMCache(cache)
+        return _langchain_llm_cache
@@ -0,0 +1,262 @@
+# Local (no LLM) pre-classifier for user messages
+
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+from .logging_config import get_logger, LOG_DIR
+from ..constants.prompts import CHIT_CHAT_RESPONSES
+
+# Decisions made by the LLM classifier are appended here and used as training data.
+# The file is rotated like the other logs; training reads it and its newest backup
+DECISION_LOG_PATH = os.path.join(LOG_DIR, "classification_decisions.jsonl")
+DECISION_LOG_MAX_BYTES = 10 * 1024 * 1024
+DECISION_LOG_BACKUP_COUNT = 5
+
+# Below this confidence the caller should fall back to the LLM classifier
+DEFAULT_CONFIDENCE_THRESHOLD = 0.8
+
+# Minimum number of logged decisions before the TF-IDF model is trained
+MIN_TRAINING_SAMPLES = 50
+MAX_TRAINING_SAMPLES = 20000
+
+_NORMALIZE_RE = re.compile(r"[^\w\s]")
+
+_CHIT_CHAT_RE = re.compile(
+    r"^(hi|hello|hey|hiya|yo|thanks|thank you|thx|ok|okay|cool|great|bye|goodbye|see you|"
+    r"good (morning|afternoon|evening|night)|how are you( doing)?|who are you|what can you do)"
+    r"( there| so much| a lot| again)?$"
+)
+
+_VISUALIZATION_RE = re.compile(
+    r"\b(plot|plots|chart|charts|graph|graphs|histogram|histograms|visuali[sz]e|visuali[sz]ation|"
+    r"pie|bar|scatter|heatmap|heat map|boxplot|box plot|line chart|diagram|draw)\b"
+)
+
+_DATA_QUERY_RE = re.compile(
+    r"\b(how many|average|mean|median|mode|sum|total|count|"
+    r"percentage|percent|proportion|ratio|maximum|minimum|max|min|oldest|youngest|highest|lowest|"
+    r"number of|rate|standard deviation|std|variance|correlation|unique|distinct|missing|null|"
+    r"rows|columns|top \d+)\b"
+)
+
+# Question openers that are just as common in off-topic messages ("what is your name",
+# "show me a joke"); they suggest a data question but never decide it alone
+_GENERIC_QUERY_RE = re.compile(r"\b(how much|what (is|was|were|are)|list|show|which|who)\b")
+
+# Phrases that usually produce tabular (grouped) output, which the LLM classifier
+# tends to mark as needing a chart; left to the LLM when no chart is asked for
+_GROUPED_RE = re.compile(r"\b(by|each|per|breakdown|broken down|compare|comparison|across|grouped|group)\b")
+
+
+def _normalize(text: str) -> str:
+    return _NORMALIZE_RE.sub("", str(text or "")).lower().strip()
+
+
+class LocalClassifier:
+    """Keyword/regex rules plus an optional TF-IDF + logistic-regression model.
+
+    Returns the same shape as ClassifierAgent.classify_message with an added
+    'confidence' score, so unambiguous traffic can be routed without an LLM call.
+    """
+
+    def __init__(self, confidence_threshold: float = DEFAULT_CONFIDENCE_THRESHOLD):
+        self.logger = get_logger(__name__)
+        self.confidence_threshold = confidence_threshold
+        self._chit_chat_phrases = {_normalize(k) for k in CHIT_CHAT_RESPONSES}
+        self._type_model = None
+        self._viz_model = None
+        self._lock = threading.Lock()
+
+    @property
+    def has_model(self) -> bool:
+        return self._type_model is not None and self._viz_model is not None
+
+    def classify_rules(self, user_message: str) -> Dict:
+        """
+        Classify a message with keyword/regex rules only.
+
+        Args:
+            user_message: The user's input message
+
+        Returns:
+            dict with keys: message_type, needs_visualization, reasoning, confidence
+        """
+        text = _normalize(user_message)
+        if not text:
+            return self._result("chit_chat", False, "Empty message", 0.9)
+
+        if text in self._chit_chat_phrases or _CHIT_CHAT_RE.match(text):
+            return self._result("chit_chat", False, "Greeting or small talk", 0.99)
+
+        if _VISUALIZATION_RE.search(text):
+            return self._result("data_query", True, "Explicit request for a chart", 0.95)
+
+        if _DATA_QUERY_RE.search(text):
+            if _GROUPED_RE.search(text):
+                return self._result("data_query", True, "Grouped/tabular output expected", 0.6)
+            return self._result("data_query", False, "Single-value data question", 0.85)
+
+        if _GENERIC_QUERY_RE.search(text):
+            return self._result("data_query", False, "Generic question wording", 0.6)
+
+        return self._result("data_query", False, "No rule matched", 0.3)
+
+    def classify_model(self, user_message: str) -> Optional[Dict]:
+        """Classify with the trained TF-IDF model, or return None if no model is trained."""
+        with self._lock:
+            type_model, viz_model = self._type_model, self._viz_model
+        if type_model is None or viz_model is None:
+            return None
+        text = _normalize(user_message)
+        type_proba = type_model.predict_proba([text])[0]
+        viz_proba = viz_model.predict_proba([text])[0]
+        type_idx = type_proba.argmax()
+        viz_idx = viz_proba.argmax()
+        message_type = str(type_model.classes_[type_idx])
+        needs_visualization = bool(viz_model.classes_[viz_idx])
+        if message_type == "chit_chat":
+            needs_visualization = False
+            confidence = float(type_proba[type_idx])
+        else:
+            confidence = float(min(type_proba[type_idx], viz_proba[viz_idx]))
+        return self._result(message_type, needs_visualization, "Local TF-IDF model", confidence)
+
+    def classify(self, user_message: str) -> Dict:
+        """
+        Classify with rules, then with the model if the rules are not confident enough.
+
+        Returns:
+            The most confident local classification (may still be below threshold)
+        """
+        best = self.classify_rules(user_message)
+        if best["confidence"] >= self.confidence_threshold:
+            return best
+        try:
+            model_result = self.classify_model(user_message)
+        except Exception as e:
+            self.logger.error("Error in local model classification: %s", e)
+            model_result = None
+        if model_result and model_result["confidence"] > best["confidence"]:
+            best = model_result
+        return best
+
+    def is_confident(self, classification: Dict) -> bool:
+        return classification.get("confidence", 0.0) >= self.confidence_threshold
+
+    def train(self, messages: List[str], message_types: List[str], needs_visualization: List[bool]) -> bool:
+        """
+        Fit the TF-IDF + logistic-regression models.
+
+        Returns:
+            True if the models were trained, False if scikit-learn is missing or data is insufficient
+        """
+        try:
+            from sklearn.feature_extraction.text import TfidfVectorizer
+            from sklearn.linear_model import LogisticRegression
+            from sklearn.pipeline import make_pipeline
+        except ImportError:
+            self.logger.info("scikit-learn not installed; local classifier uses rules only")
+            return False
+
+        if len(messages) < MIN_TRAINING_SAMPLES:
+            self.logger.info("Not enough logged decisions to train local classifier (%s)", len(messages))
+            return False
+        if len(set(message_types)) < 2 or len(set(needs_visualization)) < 2:
+            self.logger.info("Logged decisions contain a single class; skipping local model training")
+            return False
+
+        texts = [_normalize(m) for m in messages]
+
+        def build():
+            return make_pipeline(
+                TfidfVectorizer(ngram_range=(1, 2), min_df=1, sublinear_tf=True),
+                LogisticRegression(max_iter=1000, class_weight="balanced"),
+            )
+
+        type_model = build().fit(texts, message_types)
+        viz_model = build().fit(texts, [bool(v) for v in needs_visualization])
+        with self._lock:
+            self._type_model = type_model
+            self._viz_model = viz_model
+        self.logger.info("Trained local classifier on %s logged decisions", len(texts))
+        return True
+
+    def train_from_log(self, path: str = DECISION_LOG_PATH) -> bool:
+        """Train from the JSONL decision log written by ClassifierAgent (and its newest backup)."""
+        if not os.path.exists(path):
+            return False
+        messages, message_types, needs_visualization = [], [], []
+        try:
+            lines = []
+            for log_path in (f"{path}.1", path):
+                if os.path.exists(log_path):
+                    with open(log_path, "r", encoding="utf-8") as f:
+                        lines.extend(f.readlines())
+            lines = lines[-MAX_TRAINING_SAMPLES:]
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("message_type") not in ("chit_chat", "data_query") or not record.get("message"):
+                    continue
+                messages.append(record["message"])
+                message_types.append(record["message_type"])
+                needs_visualization.append(bool(record.get("needs_visualization")))
+        except OSError as e:
+            self.logger.error("Could not read classification decision log: %s", e)
+            return False
+        return self.train(messages, message_types, needs_visualization)
+
+    @staticmethod
+    def _result(message_type: str, needs_visualization: bool, reasoning: str, confidence: float) -> Dict:
+        return {
+            "message_type": message_type,
+            "needs_visualization": needs_visualization,
+            "reasoning": reasoning,
+            "confidence": confidence,
+        }
+
+
+_local_classifier = None
+_local_classifier_lock = threading.Lock()
+_decision_log_lock = threading.Lock()
+
+
+def get_local_classifier() -> LocalClassifier:
+    """Return the process-wide LocalClassifier, training it from the decision log on first use."""
+    global _local_classifier
+    with _local_classifier_lock:
+        if _local_classifier is None:
+            _local_classifier = LocalClassifier()
+            _local_classifier.train_from_log()
+        return _local_classifier
+
+
+def _rotate_decision_log(path: str) -> None:
+    """Shift path -> path.1 -> ... -> path.N once it reaches DECISION_LOG_MAX_BYTES."""
+    try:
+        if os.path.getsize(path) < DECISION_LOG_MAX_BYTES:
+            return
+        for index in range(DECISION_LOG_BACKUP_COUNT - 1, 0, -1):
+            if os.path.exists(f"{path}.{index}"):
+                os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+        os.replace(path, f"{path}.1")
+    except OSError:
+        # Missing file (first write) or a concurrent rotation by another process
+        pass
+
+
+def log_classification_decision(user_message: str, classification: Dict, path: str = DECISION_LOG_PATH) -> None:
+    """Append an LLM classification decision to the JSONL training log, rotating it when full."""
+    record = {
+        "message": user_message,
+        "message_type": classification.get("message_type"),
+        "needs_visualization": bool(classification.get("needs_visualization")),
+    }
+    with _decision_log_lock:
+        _rotate_decision_log(path)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
@@ -1,62 +1,236 @@
 # src/logging_config.py
 
+import atexit
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import random
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Dict, Optional
 
-# Placeholder for the log directory path
-LOG_DIR = "logs"  # <-- Replace this with your desired log folder path
+# Directory for common.log and the per-module log files
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+
+# Default level of application loggers, and overrides per module, e.g.
+# LOG_LEVELS="sandbox=DEBUG,agent_langchain=WARNING,httpx=WARNING"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_CONSOLE_LEVEL = os.getenv("LOG_CONSOLE_LEVEL", "INFO").upper()
+# Per-module files in addition to common.log
+LOG_PER_MODULE_FILES = os.getenv("LOG_PER_MODULE_FILES", "true").lower() in ("1", "true", "yes")
+# Large payloads (query outputs, LLM responses, code) are cut to this many characters
+# and only this fraction of the records carrying them is kept
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "1000"))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 # Ensure the log directory exists
 os.makedirs(LOG_DIR, exist_ok=True)
 
-def get_logger(module_name: str) -> logging.Logger:
+
+class Payload:
+    """A log argument that is only converted to text, and truncated, when a record is written.
+
+    Use for values that are large or costly to render:
+    logger.debug("Query output: %s", payload(output)).
     """
-    Creates and returns a logger for the specified module.
-    Each logger writes to a module-specific log file and a common log file.
-    
-    Args:
-        module_name (str): The name of the module (typically __name__).
-    
-    Returns:
-        logging.Logger: Configured logger.
+
+    __slots__ = ("value", "max_chars")
+
+    def __init__(self, value: Any, max_chars: int = LOG_PAYLOAD_MAX_CHARS):
+        self.value = value
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        text = str(self.value)
+        if len(text) <= self.max_chars:
+            return text
+        return f"{text[:self.max_chars]}... [{len(text) - self.max_chars} more chars]"
+
+    __repr__ = __str__
+
+
+def payload(value: Any, max_chars: int = LOG_PAYLOAD_MAX_CHARS) -> Payload:
+    """Wrap a large log argument; see Payload."""
+    return Payload(value, max_chars)
+
+
+class PayloadSamplingFilter(logging.Filter):
+    """Keeps a LOG_PAYLOAD_SAMPLE_RATE fraction of the DEBUG/INFO records that carry a Payload."""
+
+    def __init__(self, rate: float = LOG_PAYLOAD_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1.0 or record.levelno > logging.INFO:
+            return True
+        args = record.args if isinstance(record.args, tuple) else ()
+        if not any(isinstance(arg, Payload) for arg in args):
+            return True
+        if random.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    The stock handler formats every record in the calling thread before queueing
+    it. Records here go through an in-process queue, so the message and its args
+    are passed as they are and rendered by the listener's handlers. Log arguments
+    should therefore not be mutated after the call.
     """
-    logger = logging.getLogger(module_name)
-    logger.setLevel(logging.DEBUG)  # Set the desired logging level
-    logger.propagate = False  # Prevent propagation to root logger to avoid duplicates
 
-    # Clear existing handlers to prevent duplicates on Streamlit reruns
-    if logger.handlers:
-        logger.handlers.clear()
-    
-    if not logger.handlers:
-        # Formatter for log messages
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        )
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
 
-        # Module-specific log file handler
-        module_log_path = os.path.join(LOG_DIR, f"{module_name}.log")
-        module_handler = RotatingFileHandler(
-            module_log_path, maxBytes=5*1024*1024, backupCount=5
+
+class ModuleFileHandler(logging.Handler):
+    """Writes each record to logs/<logger name>.log, opening rotating files on first use."""
+
+    def __init__(self, log_dir: str = LOG_DIR, max_bytes: int = 5 * 1024 * 1024, backup_count: int = 5):
+        super().__init__()
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._handlers: Dict[str, RotatingFileHandler] = {}
+
+    def emit(self, record: logging.LogRecord) -> None:
+        handler = self._handlers.get(record.name)
+        if handler is None:
+            handler = RotatingFileHandler(
+                os.path.join(self.log_dir, f"{record.name}.log"), maxBytes=self.max_bytes, backupCount=self.backup_count
+            )
+            handler.setFormatter(self.formatter)
+            self._handlers[record.name] = handler
+        handler.handle(record)
+
+    def close(self) -> None:
+        for handler in self._handlers.values():
+            handler.close()
+        self._handlers.clear()
+        super().close()
+
+
+def _parse_levels(spec: str) -> Dict[str, int]:
+    levels = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        name, level = (part.strip() for part in item.split("=", 1))
+        if name and level:
+            levels[name] = logging.getLevelName(level.upper())
+    return {name: level for name, level in levels.items() if isinstance(level, int)}
+
+
+_module_levels = _parse_levels(LOG_LEVELS)
+_default_level = logging.getLevelName(LOG_LEVEL)
+if not isinstance(_default_level, int):
+    _default_level = logging.INFO
+_queue_handler: Optional[QueueHandler] = None
+_listener: Optional[QueueListener] = None
+_setup_lock = threading.Lock()
+
+
+def _level_for(module_name: str) -> int:
+    """Most specific LOG_LEVELS entry matching a module: full name, dotted prefix or last component."""
+    best, best_length = None, -1
+    for name, level in _module_levels.items():
+        matches = (
+            module_name == name
+            or module_name.startswith(name + ".")
+            or module_name.endswith("." + name)
         )
-        module_handler.setLevel(logging.DEBUG)
-        module_handler.setFormatter(formatter)
-        logger.addHandler(module_handler)
+        if matches and len(name) > best_length:
+            best, best_length = level, len(name)
+    return best if best is not None else _default_level
+
+
+def setup_logging() -> QueueHandler:
+    """
+    Create the process's log handlers once and start the listener thread that runs them.
+
+    Loggers only put records on a queue; formatting and file/console I/O happen on
+    the listener thread. Safe to call repeatedly (e.g. on Streamlit reruns).
+
+    Returns:
+        QueueHandler: The handler attached to every application logger
+    """
+    global _queue_handler, _listener
+    with _setup_lock:
+        if _queue_handler is not None:
+            return _queue_handler
+
+        formatter = logging.Formatter(LOG_FORMAT)
+        handlers = []
 
         # Common log file handler
-        common_log_path = os.path.join(LOG_DIR, "common.log")
         common_handler = RotatingFileHandler(
-            common_log_path, maxBytes=10*1024*1024, backupCount=5
+            os.path.join(LOG_DIR, "common.log"), maxBytes=10*1024*1024, backupCount=5
         )
-        common_handler.setLevel(logging.DEBUG)
         common_handler.setFormatter(formatter)
-        logger.addHandler(common_handler)
+        handlers.append(common_handler)
+
+        # Module-specific log file handler
+        if LOG_PER_MODULE_FILES:
+            module_handler = ModuleFileHandler(LOG_DIR)
+            module_handler.setFormatter(formatter)
+            handlers.append(module_handler)
 
         # Console handler (optional)
         console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
+        console_handler.setLevel(LOG_CONSOLE_LEVEL)
         console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
+
+        log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        _queue_handler = DeferredQueueHandler(log_queue)
+        _queue_handler.addFilter(PayloadSamplingFilter())
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
 
+        # Levels for third-party loggers named in LOG_LEVELS (litellm, httpx, ...)
+        for name, level in _module_levels.items():
+            logging.getLogger(name).setLevel(level)
+        return _queue_handler
+
+
+def shutdown_logging() -> None:
+    """Flush queued records and stop the listener thread."""
+    global _queue_handler, _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+        _listener = None
+        _queue_handler = None
+
+
+def get_logger(module_name: str) -> logging.Logger:
+    """
+    Returns the logger for the specified module, attached to the shared log queue.
+    Records go to logs/common.log, logs/<module>.log and the console.
+
+    Args:
+        module_name (str): The name of the module (typically __name__).
+
+    Returns:
+        logging.Logger: Configured logger.
+    """
+    handler = setup_logging()
+    logger = logging.getLogger(module_name)
+    logger.setLevel(_level_for(module_name))
+    logger.propagate = False  # Prevent propagation to root logger to avoid duplicates
+    # Loggers are process-wide; attach the queue handler only once (Streamlit reruns, repeated construction)
+    if handler not in logger.handlers:
+        for stale in [h for h in logger.handlers if isinstance(h, QueueHandler)]:
+            logger.removeHandler(stale)
+        logger.addHandler(handler)
     return logger
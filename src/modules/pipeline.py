@@ -0,0 +1,143 @@
+# Request pipeline: classification + data agent, optionally speculative
+
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+from .logging_config import get_logger
+from .tracing import stage
+
+logger = get_logger(__name__)
+
+
+async def _classify(classifier, question: str) -> Dict:
+    with stage("classification"):
+        return await classifier.aclassify_message(question)
+
+
+async def astream_answer(
+    classifier,
+    get_chatbot: Callable[[bool], Awaitable],
+    question: str,
+    chat_history: list = None,
+    speculative: bool = True,
+) -> AsyncIterator[Dict]:
+    """
+    Classify a message and stream the data agent's answer to it.
+
+    Yields a {'type': 'classification', 'classification': ...} event first, then
+    the events of ChatwithCSV.astream_chat, ending with a 'result' event whose
+    result is None for chit-chat.
+
+    In speculative mode the agent (without visualization tooling) starts at the
+    same time as classification; its events are buffered until the message is
+    known to be a data query that needs no chart. The run is cancelled if it is
+    chit-chat, and replaced by the visualization agent if a chart is needed: an
+    answer written without charting tools can contradict a chart attached to it
+    ("I can't create charts").
+
+    Args:
+        classifier: A ClassifierAgent
+        get_chatbot: Async callable returning a ChatwithCSV for a needs_visualization flag
+        question: The user's message
+        chat_history: Previous messages for context
+        speculative: Run classification and the agent concurrently
+    """
+    if not speculative:
+        classification = await _classify(classifier, question)
+        yield {"type": "classification", "classification": classification}
+        if classification.get("message_type") == "chit_chat":
+            yield {"type": "result", "result": None}
+            return
+        chatbot = await get_chatbot(bool(classification.get("needs_visualization", False)))
+        async for event in chatbot.astream_chat(question, chat_history=chat_history):
+            yield event
+        return
+
+    classify_task = asyncio.create_task(_classify(classifier, question))
+    chatbot = await get_chatbot(False)
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def run_agent():
+        try:
+            async for event in chatbot.astream_chat(question, chat_history=chat_history):
+                events.put_nowait(event)
+        finally:
+            events.put_nowait(None)
+
+    agent_task = asyncio.create_task(run_agent())
+
+    async def cancel_agent(reason: str):
+        agent_task.cancel()
+        try:
+            await agent_task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.debug("Speculative agent run raised after cancellation: %s", e)
+        logger.info("Speculative agent run cancelled: %s", reason)
+
+    try:
+        classification = await classify_task
+        yield {"type": "classification", "classification": classification}
+
+        if classification.get("message_type") == "chit_chat":
+            await cancel_agent("message classified as chit-chat")
+            yield {"type": "result", "result": None}
+            return
+
+        if classification.get("needs_visualization", False):
+            # Nothing of the speculative run has been yielded yet
+            await cancel_agent("a chart is needed")
+            viz_chatbot = await get_chatbot(True)
+            async for event in viz_chatbot.astream_chat(question, chat_history=chat_history):
+                yield event
+            return
+
+        result = None
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            if event["type"] == "result":
+                result = event["result"]
+            else:
+                yield event
+        # Surfaces errors raised by the agent run
+        await agent_task
+        yield {"type": "result", "result": result}
+    finally:
+        for task in (classify_task, agent_task):
+            if not task.done():
+                task.cancel()
+
+
+async def answer_message(
+    classifier,
+    get_chatbot: Callable[[bool], Awaitable],
+    question: str,
+    chat_history: list = None,
+    speculative: bool = True,
+) -> Tuple[Dict, Optional[Dict]]:
+    """
+    Classify a message and, for data queries, answer it with the data agent.
+
+    Non-streaming form of astream_answer. In speculative mode classification and
+    the agent run concurrently, which takes one LLM round trip off the critical
+    path of every data query that needs no chart.
+
+    Args:
+        classifier: A ClassifierAgent
+        get_chatbot: Async callable returning a ChatwithCSV for a needs_visualization flag
+        question: The user's message
+        chat_history: Previous messages for context
+        speculative: Run classification and the agent concurrently
+
+    Returns:
+        tuple: (classification dict, result dict or None for chit-chat)
+    """
+    classification, result = None, None
+    async for event in astream_answer(classifier, get_chatbot, question, chat_history, speculative):
+        if event["type"] == "classification":
+            classification = event["classification"]
+        elif event["type"] == "result":
+            result = event["result"]
+    return classification, result
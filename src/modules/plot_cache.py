@@ -0,0 +1,89 @@
+# Persistent cache of generated Plotly code
+
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+import pandas as pd
+from .cache import SQLiteCache
+from .classifier_agent import normalize_message
+from .logging_config import get_logger
+
+PLOT_CACHE_PATH = os.getenv("PLOT_CACHE_PATH", os.path.join(".cache", "plot_code.sqlite3"))
+PLOT_CACHE_MAX_ENTRIES = int(os.getenv("PLOT_CACHE_MAX_ENTRIES", "5000"))
+
+
+def describe_result_schema(result: Any) -> str:
+    """
+    Describe the shape of a query result without its values.
+
+    DataFrames and Series are described by column names, dtypes and index type.
+    String results (the agent's text output) use only their header and the
+    trailing 'Name: ..., dtype: ...' line, which never hit on differing shapes
+    but may miss on equal ones.
+
+    Args:
+        result: A DataFrame, Series, scalar or the string form of one
+
+    Returns:
+        str: Schema description suitable for cache keys
+    """
+    if isinstance(result, pd.DataFrame):
+        columns = [f"{c}:{t}" for c, t in result.dtypes.items()]
+        return f"DataFrame[{type(result.index).__name__}:{result.index.dtype}]({', '.join(columns)})"
+    if isinstance(result, pd.Series):
+        return f"Series[{type(result.index).__name__}:{result.index.dtype}]({result.name}:{result.dtype})"
+    if isinstance(result, str):
+        lines = [line.strip() for line in result.strip().splitlines() if line.strip()]
+        if not lines:
+            return "text()"
+        footer = lines[-1] if "dtype:" in lines[-1] else ""
+        return f"text({lines[0]}|{footer})"
+    return type(result).__name__
+
+
+class PlotCodeCache:
+    """Plot code keyed by dataset fingerprint, normalized query and result schema.
+
+    Only code that executed successfully is stored, so a hit can go straight to
+    execute_plotly_code without an LLM call.
+    """
+
+    def __init__(self, backend):
+        self.logger = get_logger(__name__)
+        self.backend = backend
+
+    @staticmethod
+    def make_key(dataset_fingerprint: str, user_query: str, result_schema: str) -> str:
+        raw = json.dumps([dataset_fingerprint, normalize_message(user_query), result_schema])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        return self.backend.get(key)
+
+    def set(self, key: str, code: str) -> None:
+        try:
+            self.backend.set(key, code)
+        except Exception as e:
+            self.logger.warning("Could not store plot code in cache: %s", e)
+
+    def delete(self, key: str) -> None:
+        self.backend.delete(key)
+
+    def stats(self) -> Dict:
+        return self.backend.stats()
+
+
+_plot_cache = None
+_plot_cache_lock = threading.Lock()
+
+
+def get_plot_cache() -> PlotCodeCache:
+    """Return the process-wide PlotCodeCache backed by a local SQLite file."""
+    global _plot_cache
+    with _plot_cache_lock:
+        if _plot_cache is None:
+            backend = SQLiteCache(PLOT_CACHE_PATH, max_entries=PLOT_CACHE_MAX_ENTRIES, table="plot_code")
+            _plot_cache = PlotCodeCache(backend)
+        return _plot_cache
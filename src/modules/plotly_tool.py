@@ -1,26 +1,131 @@
 # Plotly visualization tool for LangChain
 
+import asyncio
+import functools
 import json
 import litellm
 import pandas as pd
 from typing import Dict, Optional, Any
 from langchain_core.tools import StructuredTool
 from pydantic import BaseModel, Field
-from .logging_config import get_logger
+from .chart_templates import build_template_chart
+from .logging_config import get_logger, payload
+from .plot_cache import describe_result_schema, get_plot_cache
+from .run_store import current_run_id, figure_store, format_result, result_store
+from .sandbox import get_sandbox_pool
+from .tracing import atraced_completion, stage, traced_completion
 from ..constants.prompts import PLOTLY_GENERATION_PROMPT
 
+# Compiled code objects for recently executed plotly code strings
+COMPILED_CODE_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=COMPILED_CODE_CACHE_SIZE)
+def _compile_plotly_code(code: str):
+    return compile(code, "<plotly_code>", "exec")
+
+
+def result_to_frame(result: Any) -> Optional[pd.DataFrame]:
+    """
+    A query result as a flat DataFrame to chart as 'df' when the full dataset is not in memory.
+
+    Series and grouped results have their index turned into columns.
+    """
+    if isinstance(result, pd.Series):
+        return result.rename(result.name if result.name is not None else "value").reset_index()
+    if isinstance(result, pd.DataFrame):
+        return result if isinstance(result.index, pd.RangeIndex) else result.reset_index()
+    return None
+
+
+def result_frame_info(frame: pd.DataFrame) -> str:
+    """Prompt description of a query result used as 'df' (instead of the dataset profile)."""
+    columns = ", ".join(f"{c} ({t})" for c, t in frame.dtypes.items())
+    return f"'df' is the result of the query above, not the full dataset: {len(frame)} rows; columns: {columns}"
+
+
 class PlotlyVisualizationTool:
     """Tool for generating Plotly visualizations using LLM."""
     
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        dataset_fingerprint: Optional[str] = None,
+        use_plot_cache: bool = True,
+        use_sandbox: bool = False,
+    ):
         self.logger = get_logger(__name__)
         self.api_key = api_key
         self.model = "gpt-4o-mini"
+        self.dataset_fingerprint = dataset_fingerprint
+        # Generated code is only reusable when we know which dataset it was written for
+        self.plot_cache = get_plot_cache() if use_plot_cache and dataset_fingerprint else None
+        # The sandbox pool is keyed by dataset, so it also needs the fingerprint
+        self.use_sandbox = use_sandbox and dataset_fingerprint is not None
         
         # Set OpenAI API key for litellm
         litellm.api_key = api_key
+
+    def _plot_cache_key(self, user_query: str, data_output: Any, result_schema: Optional[str]) -> Optional[str]:
+        if self.plot_cache is None:
+            return None
+        schema = result_schema or describe_result_schema(data_output)
+        return self.plot_cache.make_key(self.dataset_fingerprint, user_query, schema)
+
+    def cached_plotly_code(self, user_query: str, data_output: Any, result_schema: Optional[str] = None) -> Optional[str]:
+        """Return previously validated code for the same dataset, query and result schema."""
+        key = self._plot_cache_key(user_query, data_output, result_schema)
+        if key is None:
+            return None
+        code = self.plot_cache.get(key)
+        if code:
+            self.logger.info("Plot code cache hit; skipping LLM call")
+        return code
+
+    def remember_plotly_code(self, user_query: str, data_output: Any, code: str, result_schema: Optional[str] = None) -> None:
+        """Store code that executed successfully so identical requests can skip the LLM."""
+        key = self._plot_cache_key(user_query, data_output, result_schema)
+        if key is not None and code:
+            self.plot_cache.set(key, code)
     
-    def generate_plotly_code(self, user_query: str, data_output: str, dataframe_info: str) -> str:
+    def _completion_kwargs(self, user_query: str, data_output: str, dataframe_info: str) -> Dict:
+        """Build the litellm request for generating plotly code."""
+        prompt = PLOTLY_GENERATION_PROMPT.format(
+            user_query=user_query,
+            data_output=str(data_output)[:2000],  # Limit length to avoid token issues
+            dataframe_info=dataframe_info
+        )
+        return {
+            "model": f"openai/{self.model}",
+            "messages": [
+                {"role": "system", "content": "You are a data visualization expert. Generate only valid Python code using Plotly."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.3,  # Slight creativity for better visualizations
+        }
+
+    def _clean_code(self, response) -> str:
+        """Extract runnable code from the LLM response."""
+        code = response.choices[0].message.content.strip()
+        
+        # Remove markdown code blocks if present
+        if code.startswith("```python"):
+            code = code[9:]
+        elif code.startswith("```"):
+            code = code[3:]
+        if code.endswith("```"):
+            code = code[:-3]
+        code = code.strip()
+        
+        # Remove fig.show() if present (not needed for Streamlit)
+        code = code.replace("fig.show()", "").strip()
+        # Remove any trailing semicolons or empty lines
+        code = code.rstrip(";").strip()
+        
+        self.logger.debug("Generated plotly code: %s", payload(code, 200))
+        return code
+
+    def generate_plotly_code(self, user_query: str, data_output: str, dataframe_info: str, result_schema: Optional[str] = None) -> str:
         """
         Generate Plotly code using LLM based on user query and data output.
         
@@ -28,53 +133,48 @@ class PlotlyVisualizationTool:
             user_query: The user's original query
             data_output: The output from the pandas query (can be string representation of DataFrame or Series)
             dataframe_info: Information about the dataframe structure
+            result_schema: Schema of the query result, for the plot code cache (derived from data_output if omitted)
             
         Returns:
             str: Python code that generates a Plotly figure
         """
-        self.logger.debug(f"Generating plotly code for query: {user_query[:100]}")
+        self.logger.debug("Generating plotly code for query: %s", payload(user_query, 100))
+        cached = self.cached_plotly_code(user_query, data_output, result_schema)
+        if cached:
+            return cached
         
         try:
-            # Format the prompt
-            prompt = PLOTLY_GENERATION_PROMPT.format(
-                user_query=user_query,
-                data_output=str(data_output)[:2000],  # Limit length to avoid token issues
-                dataframe_info=dataframe_info
-            )
-            
-            # Call OpenAI via litellm
-            response = litellm.completion(
-                model=f"openai/{self.model}",
-                messages=[
-                    {"role": "system", "content": "You are a data visualization expert. Generate only valid Python code using Plotly."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3  # Slight creativity for better visualizations
-            )
-            
-            # Extract the response
-            code = response.choices[0].message.content.strip()
-            
-            # Remove markdown code blocks if present
-            if code.startswith("```python"):
-                code = code[9:]
-            elif code.startswith("```"):
-                code = code[3:]
-            if code.endswith("```"):
-                code = code[:-3]
-            code = code.strip()
-            
-            # Remove fig.show() if present (not needed for Streamlit)
-            code = code.replace("fig.show()", "").strip()
-            # Remove any trailing semicolons or empty lines
-            code = code.rstrip(";").strip()
-            
-            self.logger.debug(f"Generated plotly code (first 200 chars): {code[:200]}")
-            
-            return code
+            response = traced_completion("plotly", **self._completion_kwargs(user_query, data_output, dataframe_info))
+            return self._clean_code(response)
+        except Exception as e:
+            self.logger.error("Error generating plotly code: %s", e)
+            import traceback
+            self.logger.error(traceback.format_exc())
+            return None
+
+    async def agenerate_plotly_code(self, user_query: str, data_output: str, dataframe_info: str, result_schema: Optional[str] = None) -> str:
+        """
+        Async variant of generate_plotly_code built on litellm.acompletion.
+        
+        Args:
+            user_query: The user's original query
+            data_output: The output from the pandas query
+            dataframe_info: Information about the dataframe structure
+            result_schema: Schema of the query result, for the plot code cache
             
+        Returns:
+            str: Python code that generates a Plotly figure
+        """
+        self.logger.debug("Generating plotly code (async) for query: %s", payload(user_query, 100))
+        cached = self.cached_plotly_code(user_query, data_output, result_schema)
+        if cached:
+            return cached
+        
+        try:
+            response = await atraced_completion("plotly", **self._completion_kwargs(user_query, data_output, dataframe_info))
+            return self._clean_code(response)
         except Exception as e:
-            self.logger.error(f"Error generating plotly code: {e}")
+            self.logger.error("Error generating plotly code: %s", e)
             import traceback
             self.logger.error(traceback.format_exc())
             return None
@@ -92,13 +192,25 @@ class PlotlyVisualizationTool:
         """
         if not code:
             return None
-            
+        with stage("plot_execute"):
+            return self._execute_plotly_code(code, df)
+
+    def _execute_plotly_code(self, code: str, df: pd.DataFrame) -> Optional[Any]:
         self.logger.debug("Executing plotly code")
         
         try:
+            if self.use_sandbox:
+                # Worker processes already hold the dataset; df is only used in-process
+                fig = get_sandbox_pool(self.dataset_fingerprint, df).execute_plotly(code, run_id=current_run_id.get())
+                if fig is None:
+                    self.logger.warning("Plotly code executed but 'fig' variable not found")
+                    return None
+                self.logger.info("Successfully generated plotly figure (sandbox)")
+                return fig
+
             # Create a safe execution environment
             local_vars = {
-                'df': df,
+                'df': df.copy(deep=False),
                 'pd': pd,
                 'px': None,
                 'go': None,
@@ -111,8 +223,8 @@ class PlotlyVisualizationTool:
             local_vars['px'] = px
             local_vars['go'] = go
             
-            # Execute the code
-            exec(code, {"__builtins__": __builtins__}, local_vars)
+            # Execute the code (compiled once per distinct code string)
+            exec(_compile_plotly_code(code), {"__builtins__": __builtins__}, local_vars)
             
             # Get the figure object
             fig = local_vars.get('fig')
@@ -125,17 +237,19 @@ class PlotlyVisualizationTool:
             return fig
             
         except Exception as e:
-            self.logger.error(f"Error executing plotly code: {e}")
+            self.logger.error("Error executing plotly code: %s", e)
             import traceback
             self.logger.error(traceback.format_exc())
             return None
     
-    def create_langchain_tool(self, df: pd.DataFrame) -> StructuredTool:
+    def create_langchain_tool(self, df: pd.DataFrame, dataframe_info: Optional[str] = None) -> StructuredTool:
         """
         Create a LangChain StructuredTool for Plotly visualization.
         
         Args:
-            df: The pandas DataFrame
+            df: The pandas DataFrame, or None when the dataset is not in memory; charts
+                are then drawn from the live result of the agent's last query
+            dataframe_info: Precomputed dataset profile; when given it replaces the agent-supplied description
             
         Returns:
             LangChain StructuredTool object
@@ -146,6 +260,41 @@ class PlotlyVisualizationTool:
             data_output: str = Field(description="The output from the pandas query (string representation of DataFrame or Series)")
             dataframe_info: str = Field(description="Information about the dataframe structure (columns, rows, etc.)")
         
+        profile = dataframe_info
+
+        def _live_result():
+            """Return the live pandas result of this run's last REPL call, if any."""
+            run_id = current_run_id.get()
+            if run_id is None:
+                return None
+            result = result_store.get(run_id, "query_result")
+            return result if isinstance(result, (pd.Series, pd.DataFrame)) else None
+
+        def _plot_inputs(result, dataframe_info: str):
+            """The frame the plot code runs on as 'df', and how it is described to the LLM."""
+            if df is not None:
+                return df, profile or dataframe_info
+            # No full dataset in memory (DuckDB engine): chart the query result itself
+            frame = result_to_frame(result)
+            return frame, result_frame_info(frame) if frame is not None else None
+
+        def _tool_response(code: Optional[str], fig) -> str:
+            if fig is None:
+                return "Failed to execute plotly code" if code else "Failed to generate plotly code"
+            
+            # Hand the validated figure to ChatwithCSV through the run's side channel,
+            # so it is not rebuilt from code a second time
+            run_id = current_run_id.get()
+            if run_id is not None:
+                figure_store.put(run_id, code, fig)
+            self.logger.info("Plotly tool completed successfully, returning response")
+            response_data = {
+                "plotly_code": code,
+                "success": True,
+                "message": "Plotly visualization generated successfully"
+            }
+            return json.dumps(response_data)
+
         def plotly_tool_func(query: str, data_output: str, dataframe_info: str) -> str:
             """
             Tool function that generates and executes plotly code.
@@ -156,38 +305,62 @@ class PlotlyVisualizationTool:
                 dataframe_info: Information about the dataframe structure
             """
             try:
-                self.logger.debug(f"Plotly tool called with query: {query[:100]}")
-                
-                # Generate plotly code
-                code = self.generate_plotly_code(query, data_output, dataframe_info)
-                
-                if not code:
-                    return "Failed to generate plotly code"
-                
-                # Execute code to verify it works (but don't store the figure)
-                fig = self.execute_plotly_code(code, df)
-                
-                if fig is None:
-                    return "Failed to execute plotly code"
-                
-                # Don't cache the figure - we'll regenerate it from code when needed
-                # Just verify the code works, then return the code
-                self.logger.info("Plotly tool completed successfully, returning response")
-                response_data = {
-                    "plotly_code": code,
-                    "success": True,
-                    "message": "Plotly visualization generated successfully"
-                }
-                return json.dumps(response_data)
+                self.logger.debug("Plotly tool called with query: %s", payload(query, 100))
+                # Prefer the live result over the agent's transcription of it
+                result = _live_result()
+                if result is not None:
+                    data_output = format_result(result)
+                schema = describe_result_schema(result) if result is not None else None
+                # Common shapes are charted deterministically, without an LLM call
+                template = build_template_chart(query, df, result)
+                if template is not None:
+                    return _tool_response(template[1], template[0])
+                frame, info = _plot_inputs(result, dataframe_info)
+                if frame is None:
+                    return "Error: run a query first; the chart is drawn from its result"
+                code = self.generate_plotly_code(query, data_output, info, result_schema=schema)
+                # Execute code to verify it works
+                fig = self.execute_plotly_code(code, frame) if code else None
+                if fig is not None:
+                    self.remember_plotly_code(query, data_output, code, result_schema=schema)
+                return _tool_response(code, fig)
                 
             except Exception as e:
-                self.logger.error(f"Error in plotly_tool_func: {e}")
+                self.logger.error("Error in plotly_tool_func: %s", e)
+                import traceback
+                self.logger.error(traceback.format_exc())
+                return f"Error: {str(e)}"
+
+        async def aplotly_tool_func(query: str, data_output: str, dataframe_info: str) -> str:
+            """Coroutine version of plotly_tool_func, used by the agent's async path."""
+            try:
+                self.logger.debug("Plotly tool (async) called with query: %s", payload(query, 100))
+                result = _live_result()
+                if result is not None:
+                    data_output = format_result(result)
+                schema = describe_result_schema(result) if result is not None else None
+                template = await asyncio.to_thread(build_template_chart, query, df, result)
+                if template is not None:
+                    return _tool_response(template[1], template[0])
+                frame, info = _plot_inputs(result, dataframe_info)
+                if frame is None:
+                    return "Error: run a query first; the chart is drawn from its result"
+                code = await self.agenerate_plotly_code(query, data_output, info, result_schema=schema)
+                # Figure construction is CPU-bound; keep it off the event loop
+                fig = await asyncio.to_thread(self.execute_plotly_code, code, frame) if code else None
+                if fig is not None:
+                    self.remember_plotly_code(query, data_output, code, result_schema=schema)
+                return _tool_response(code, fig)
+
+            except Exception as e:
+                self.logger.error("Error in aplotly_tool_func: %s", e)
                 import traceback
                 self.logger.error(traceback.format_exc())
                 return f"Error: {str(e)}"
         
         return StructuredTool.from_function(
             func=plotly_tool_func,
+            coroutine=aplotly_tool_func,
             name="generate_plotly_visualization",
             description="""Generates interactive Plotly visualizations (charts, histograms, bar charts, pie charts). 
             Use ONLY after you have run a pandas query to get the data. Pass 'query' (user question), 'data_output' (the exact string result from your pandas query - e.g. df['Age'].dropna() or value_counts()), and 'dataframe_info' (e.g. df.columns.tolist() or df.info()). 
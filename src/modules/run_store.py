@@ -0,0 +1,94 @@
+# Per-run side channel between agent tools and ChatwithCSV
+
+import threading
+from contextvars import ContextVar
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+# Id of the chat_with_a_df run currently executing. Set before the agent is invoked;
+# asyncio tasks and LangChain's executor threads copy the context, so tools see it.
+current_run_id: ContextVar[Optional[str]] = ContextVar("chatwithcsv_run_id", default=None)
+
+
+class RunStore:
+    """Thread-safe store of objects produced during a run, keyed by run id.
+
+    Tools put live objects here (figures, query results) instead of round-tripping
+    them through strings; the run's owner reads them back and discards the run.
+    """
+
+    def __init__(self):
+        self._runs: Dict[str, Dict[Hashable, Any]] = {}
+        self._lock = threading.Lock()
+
+    def put(self, run_id: str, key: Hashable, value: Any) -> None:
+        with self._lock:
+            entries = self._runs.setdefault(run_id, {})
+            # Re-inserting moves the key to the end, so last() sees the newest value
+            entries.pop(key, None)
+            entries[key] = value
+
+    def get(self, run_id: str, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._runs.get(run_id, {}).get(key, default)
+
+    def pop(self, run_id: str, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._runs.get(run_id, {}).pop(key, default)
+
+    def last(self, run_id: str) -> Optional[Tuple[Hashable, Any]]:
+        """Return the most recently stored (key, value) of a run, if any."""
+        with self._lock:
+            entries = self._runs.get(run_id)
+            if not entries:
+                return None
+            key = next(reversed(entries))
+            return key, entries[key]
+
+    def discard(self, run_id: str) -> None:
+        with self._lock:
+            self._runs.pop(run_id, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._runs)
+
+
+# Validated Plotly figures, keyed by the code that produced them
+figure_store = RunStore()
+
+# Live results (DataFrame/Series/scalar) of the agent's pandas REPL calls
+result_store = RunStore()
+
+# Display limits used when a live result has to be turned into text
+RESULT_MAX_ROWS = 60
+RESULT_MAX_COLUMNS = 20
+RESULT_MAX_CHARS = 5000
+
+
+def format_result(result: Any, max_rows: int = RESULT_MAX_ROWS, max_chars: int = RESULT_MAX_CHARS) -> Optional[str]:
+    """
+    Render a query result as bounded text without formatting the full object.
+
+    Args:
+        result: A DataFrame, Series, scalar or string
+        max_rows: Rows shown for DataFrames/Series (head and tail)
+        max_chars: Hard cap on the returned text
+
+    Returns:
+        str or None if result is None
+    """
+    if result is None:
+        return None
+    to_string = getattr(result, "to_string", None)
+    if callable(to_string) and hasattr(result, "shape"):
+        kwargs = {"max_rows": max_rows}
+        if getattr(result, "ndim", 1) == 2:
+            kwargs["max_cols"] = RESULT_MAX_COLUMNS
+        text = to_string(**kwargs)
+    elif hasattr(result, "content") and isinstance(result.content, str):
+        text = result.content
+    else:
+        text = str(result)
+    if len(text) > max_chars:
+        text = text[: max_chars - 3] + "..."
+    return text
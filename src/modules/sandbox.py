@@ -0,0 +1,488 @@
+# Sandboxed worker processes for executing LLM-generated pandas and Plotly code
+
+import ast
+import asyncio
+import multiprocessing
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import Any, Dict, Optional, Tuple
+import pandas as pd
+from .dataset_store import attach_dataset, get_dataset_store
+from .logging_config import get_logger
+
+SANDBOX_ENABLED = os.getenv("SANDBOX_ENABLED", "true").lower() in ("1", "true", "yes")
+SANDBOX_WORKERS = int(os.getenv("SANDBOX_WORKERS", "2"))  # per dataset
+SANDBOX_TIMEOUT_SECONDS = float(os.getenv("SANDBOX_TIMEOUT_SECONDS", "30"))
+SANDBOX_CPU_SECONDS = int(os.getenv("SANDBOX_CPU_SECONDS", "20"))  # per execution
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "2048"))  # on top of the loaded dataset; 0 disables
+SANDBOX_MAX_DATASETS = int(os.getenv("SANDBOX_MAX_DATASETS", "4"))
+# forkserver/spawn avoid forking the multi-threaded Streamlit server
+SANDBOX_START_METHOD = os.getenv("SANDBOX_START_METHOD", "forkserver")
+
+# Column used to ship a Series through Arrow IPC
+_SERIES_COLUMN = "__sandbox_series__"
+
+
+class SandboxError(Exception):
+    """Raised when generated code could not be run to completion in the sandbox."""
+
+
+class SandboxTimeout(SandboxError):
+    """Raised when an execution exceeded its wall-clock timeout; the worker was killed."""
+
+
+class SandboxCancelled(SandboxError):
+    """Raised when an execution was cancelled by its run; the worker was killed."""
+
+
+class _CPULimitExceeded(BaseException):
+    # BaseException, so generated code's `except Exception` cannot swallow it
+    pass
+
+
+def _encode_result(value: Any) -> Tuple[str, bytes, Optional[Dict]]:
+    """Serialize a result for the pipe: Arrow IPC for pandas objects, pickle otherwise."""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        try:
+            import pyarrow as pa
+            is_series = isinstance(value, pd.Series)
+            frame = value.to_frame(name=_SERIES_COLUMN) if is_series else value
+            table = pa.Table.from_pandas(frame, preserve_index=True)
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            meta = {"series": is_series, "name": value.name if is_series else None}
+            return "arrow", sink.getvalue().to_pybytes(), meta
+        except Exception:
+            # Mixed object columns and the like; pickle handles them
+            pass
+    try:
+        return "pickle", pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), None
+    except Exception:
+        # Modules, generators, open handles: the agent only needs to see the text
+        return "pickle", pickle.dumps(repr(value), protocol=pickle.HIGHEST_PROTOCOL), None
+
+
+def _decode_result(encoding: str, data: bytes, meta: Optional[Dict]) -> Any:
+    if encoding == "arrow":
+        import pyarrow as pa
+        frame = pa.ipc.open_stream(data).read_all().to_pandas()
+        if meta and meta.get("series"):
+            return frame[_SERIES_COLUMN].rename(meta.get("name"))
+        return frame
+    return pickle.loads(data)
+
+
+def _sanitize_query(query: str) -> str:
+    """Strip markdown fences and a leading 'python', as the pandas REPL tool does."""
+    query = query.strip()
+    if query.startswith("```"):
+        query = query[3:]
+        if query.startswith("python"):
+            query = query[6:]
+    if query.endswith("```"):
+        query = query[:-3]
+    return query.strip()
+
+
+def _run_repl(query: str, namespace: Dict) -> Any:
+    """Run code with PythonAstREPLTool semantics: value of the last expression, else stdout."""
+    try:
+        tree = ast.parse(_sanitize_query(query))
+        exec(ast.unparse(ast.Module(tree.body[:-1], type_ignores=[])), namespace)
+        last = ast.unparse(ast.Module(tree.body[-1:], type_ignores=[]))
+        io_buffer = StringIO()
+        try:
+            with redirect_stdout(io_buffer):
+                value = eval(last, namespace)
+            return io_buffer.getvalue() if value is None else value
+        except MemoryError:
+            raise
+        except Exception:
+            with redirect_stdout(io_buffer):
+                exec(last, namespace)
+            return io_buffer.getvalue()
+    except MemoryError:
+        raise
+    except Exception as e:
+        return f"{type(e).__name__}: {str(e)}"
+
+
+def _run_plotly(code: str, df: pd.DataFrame) -> Any:
+    """Execute Plotly code against the dataset and return its 'fig' variable."""
+    import plotly.express as px
+    import plotly.graph_objects as go
+    # A shallow copy, so in-place edits by the chart code do not outlive it
+    local_vars = {"df": df.copy(deep=False), "pd": pd, "px": px, "go": go, "fig": None}
+    exec(compile(code, "<plotly_code>", "exec"), {"__builtins__": __builtins__}, local_vars)
+    return local_vars.get("fig")
+
+
+def _address_space_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _worker_main(conn, dataset, cpu_seconds: int, memory_bytes: int) -> None:
+    """
+    Worker loop. Holds the dataset and one namespace per run (run affinity keeps a
+    run's REPL variables on the same worker), and applies resource limits.
+
+    `dataset` is the path of a DatasetStore file, attached by memory map so all
+    workers share its pages, or a DataFrame sent to the worker as a private copy.
+    Requests are (op, run_id, code, finished_runs); replies are ("ok", encoded) or
+    ("error", message).
+    """
+    df = attach_dataset(dataset) if isinstance(dataset, str) else dataset
+    try:
+        import resource
+        import signal
+    except ImportError:
+        resource = None
+
+    state = {"executing": False}
+    if resource is not None:
+        def _on_cpu_limit(signum, frame):
+            # SIGXCPU repeats every second past the soft limit; only interrupt user code
+            if state["executing"]:
+                state["executing"] = False
+                raise _CPULimitExceeded()
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+        baseline = _address_space_bytes()
+        if memory_bytes and baseline is not None:
+            limit = baseline + memory_bytes
+            try:
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+            except (ValueError, OSError):
+                pass
+
+    namespaces: Dict[str, Dict] = {}
+    while True:
+        try:
+            op, run_id, code, finished_runs = conn.recv()
+        except (EOFError, OSError):
+            return
+        if op == "shutdown":
+            return
+        for finished in finished_runs:
+            namespaces.pop(finished, None)
+
+        if resource is not None and cpu_seconds:
+            # RLIMIT_CPU is cumulative per process; move the soft limit past what is used.
+            # The hard limit is left alone (it could not be raised again); code stuck in
+            # C past the soft limit is stopped by the caller's wall-clock timeout.
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            try:
+                resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+            except (ValueError, OSError):
+                pass
+
+        try:
+            state["executing"] = True
+            if op == "repl":
+                namespace = namespaces.get(run_id) if run_id is not None else None
+                if namespace is None:
+                    # Each run edits its own shallow copy of the worker's dataset
+                    namespace = {"df": df.copy(deep=False), "pd": pd}
+                    if run_id is not None:
+                        namespaces[run_id] = namespace
+                value = _run_repl(code, namespace)
+            elif op == "plotly":
+                value = _run_plotly(code, df)
+            else:
+                raise ValueError(f"Unknown sandbox operation: {op}")
+            state["executing"] = False
+            reply = ("ok", _encode_result(value))
+        except _CPULimitExceeded:
+            reply = ("error", f"CPU time limit of {cpu_seconds}s exceeded")
+        except MemoryError:
+            reply = ("error", f"Memory limit of {memory_bytes // (1024 ** 2)} MB exceeded")
+        except Exception as e:
+            reply = ("error", f"{type(e).__name__}: {str(e)}")
+        state["executing"] = False
+        try:
+            conn.send(reply)
+        except (EOFError, OSError):
+            return
+
+
+class _Worker:
+    def __init__(self, ctx, dataset, cpu_seconds: int, memory_bytes: int):
+        parent_conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, dataset, cpu_seconds, memory_bytes),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.busy_run: Optional[str] = None
+        self.busy = False
+        self.cancelled = False
+        # Set when its pool shut down mid-execution; the worker is closed once it returns
+        self.retiring = False
+        self.finished_runs = []
+
+    def kill(self) -> None:
+        try:
+            self.process.kill()
+            self.process.join(timeout=1)
+        except Exception:
+            pass
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class SandboxPool:
+    """Pre-started worker processes that hold one dataset and run generated code.
+
+    Each execution gets a CPU-time limit, the workers an address-space limit, and the
+    caller a wall-clock timeout. A worker that times out, is cancelled or dies is
+    killed and replaced, so runaway code never blocks the server process. Calls
+    from the same run go to the same worker, which keeps that run's REPL variables.
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        workers: int = SANDBOX_WORKERS,
+        timeout_seconds: float = SANDBOX_TIMEOUT_SECONDS,
+        cpu_seconds: int = SANDBOX_CPU_SECONDS,
+        memory_mb: int = SANDBOX_MEMORY_MB,
+        start_method: str = SANDBOX_START_METHOD,
+        dataset_path: Optional[str] = None,
+    ):
+        self.logger = get_logger(__name__)
+        self.df = df
+        # Workers attach the shared file when there is one instead of receiving a copy
+        self.dataset = dataset_path or df
+        self.size = max(1, workers)
+        self.timeout_seconds = timeout_seconds
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_mb * 1024 ** 2
+        if start_method not in multiprocessing.get_all_start_methods():
+            start_method = "spawn"
+        self._ctx = multiprocessing.get_context(start_method)
+        self._workers = []
+        self._affinity: Dict[str, _Worker] = {}
+        self._cond = threading.Condition()
+        self.metrics = {"executions": 0, "timeouts": 0, "cancellations": 0, "crashes": 0, "restarts": 0}
+
+    def start(self) -> None:
+        """Start any missing workers (a no-op when the pool is already warm)."""
+        with self._cond:
+            self._workers = [w for w in self._workers if w.process.is_alive() or w.busy]
+            while len(self._workers) < self.size:
+                self._workers.append(_Worker(self._ctx, self.dataset, self.cpu_seconds, self.memory_bytes))
+            self._cond.notify_all()
+
+    def shutdown(self) -> None:
+        """
+        Stop all idle workers; a later execution starts the pool again.
+
+        Busy workers leave the pool but finish their current execution, so other
+        sessions' in-flight runs are not aborted; they are closed when it returns.
+        """
+        with self._cond:
+            workers, self._workers = self._workers, []
+            self._affinity.clear()
+            idle = []
+            for worker in workers:
+                if worker.busy:
+                    worker.retiring = True
+                else:
+                    idle.append(worker)
+        for worker in idle:
+            self._stop_worker(worker)
+
+    @staticmethod
+    def _stop_worker(worker: _Worker) -> None:
+        try:
+            worker.conn.send(("shutdown", None, None, []))
+        except Exception:
+            pass
+        worker.kill()
+
+    def _retire_if_done_locked(self, worker: _Worker) -> None:
+        """Close a retiring worker once its execution has returned."""
+        if worker.retiring and not worker.busy:
+            self._stop_worker(worker)
+
+    def _replace_locked(self, worker: _Worker) -> None:
+        worker.kill()
+        for run_id in [r for r, w in self._affinity.items() if w is worker]:
+            del self._affinity[run_id]
+        # Retiring workers already left the pool and are not replaced
+        if worker in self._workers:
+            self._workers.remove(worker)
+            self._workers.append(_Worker(self._ctx, self.dataset, self.cpu_seconds, self.memory_bytes))
+            self.metrics["restarts"] += 1
+        self._cond.notify_all()
+
+    def _acquire(self, run_id: Optional[str]) -> _Worker:
+        with self._cond:
+            if len(self._workers) < self.size:
+                self.start()
+            while True:
+                worker = self._affinity.get(run_id) if run_id is not None else None
+                if worker is None:
+                    idle = [w for w in self._workers if not w.busy]
+                    worker = idle[0] if idle else None
+                if worker is not None and not worker.busy:
+                    worker.busy = True
+                    worker.busy_run = run_id
+                    worker.cancelled = False
+                    if run_id is not None:
+                        self._affinity[run_id] = worker
+                    return worker
+                self._cond.wait()
+
+    def _release(self, worker: _Worker) -> None:
+        with self._cond:
+            worker.busy = False
+            worker.busy_run = None
+            self._retire_if_done_locked(worker)
+            self._cond.notify_all()
+
+    def _execute(self, op: str, code: str, run_id: Optional[str], timeout: Optional[float]) -> Any:
+        timeout = self.timeout_seconds if timeout is None else timeout
+        worker = self._acquire(run_id)
+        self.metrics["executions"] += 1
+        try:
+            with self._cond:
+                finished, worker.finished_runs = worker.finished_runs, []
+            worker.conn.send((op, run_id, code, finished))
+            if not worker.conn.poll(timeout):
+                with self._cond:
+                    self.metrics["timeouts"] += 1
+                    self._replace_locked(worker)
+                raise SandboxTimeout(f"Execution exceeded {timeout:.0f}s and was stopped")
+            status, payload = worker.conn.recv()
+        except (EOFError, OSError, BrokenPipeError) as e:
+            with self._cond:
+                cancelled = worker.cancelled
+                self._replace_locked(worker)
+                if not cancelled:
+                    self.metrics["crashes"] += 1
+            if cancelled:
+                raise SandboxCancelled("Execution was cancelled")
+            raise SandboxError(f"Sandbox worker exited unexpectedly ({type(e).__name__}); it was likely killed by a resource limit")
+        finally:
+            self._release(worker)
+        if status == "error":
+            raise SandboxError(payload)
+        return _decode_result(*payload)
+
+    def execute_query(self, query: str, run_id: Optional[str] = None, timeout: Optional[float] = None) -> Any:
+        """
+        Run pandas code against the dataset with Python REPL semantics.
+
+        Args:
+            query: Code to run; the value of its last expression is returned
+            run_id: Run the call belongs to (keeps variables between calls of a run)
+            timeout: Wall-clock limit in seconds (defaults to the pool's)
+
+        Returns:
+            The result object (DataFrame/Series/scalar) or captured stdout
+
+        Raises:
+            SandboxError: on timeout, cancellation or resource limits
+        """
+        return self._execute("repl", query, run_id, timeout)
+
+    def execute_plotly(self, code: str, run_id: Optional[str] = None, timeout: Optional[float] = None) -> Any:
+        """Execute Plotly code against the dataset and return the figure (or None)."""
+        return self._execute("plotly", code, run_id, timeout)
+
+    async def aexecute_query(self, query: str, run_id: Optional[str] = None, timeout: Optional[float] = None) -> Any:
+        """Async variant of execute_query; cancelling the awaiting task kills the execution."""
+        try:
+            return await asyncio.to_thread(self.execute_query, query, run_id, timeout)
+        except asyncio.CancelledError:
+            if run_id is not None:
+                self.cancel(run_id)
+            raise
+
+    async def aexecute_plotly(self, code: str, run_id: Optional[str] = None, timeout: Optional[float] = None) -> Any:
+        """Async variant of execute_plotly."""
+        try:
+            return await asyncio.to_thread(self.execute_plotly, code, run_id, timeout)
+        except asyncio.CancelledError:
+            if run_id is not None:
+                self.cancel(run_id)
+            raise
+
+    def cancel(self, run_id: str) -> bool:
+        """Kill the worker currently executing code for run_id. Returns True if one was."""
+        with self._cond:
+            worker = self._affinity.get(run_id)
+            if worker is None or not worker.busy or worker.busy_run != run_id:
+                return False
+            worker.cancelled = True
+            self.metrics["cancellations"] += 1
+            # The waiting caller sees the closed pipe, replaces the worker and raises
+            worker.process.kill()
+        self.logger.info("Cancelled sandbox execution for run %s", run_id)
+        return True
+
+    def end_run(self, run_id: str) -> None:
+        """Forget a run's affinity; its namespace is dropped with the worker's next request."""
+        with self._cond:
+            worker = self._affinity.pop(run_id, None)
+            if worker is not None:
+                worker.finished_runs.append(run_id)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            alive = sum(1 for w in self._workers if w.process.is_alive())
+            busy = sum(1 for w in self._workers if w.busy)
+            return {**self.metrics, "workers": alive, "busy": busy, "active_runs": len(self._affinity)}
+
+
+_sandbox_pools: "OrderedDict[str, SandboxPool]" = OrderedDict()
+_sandbox_lock = threading.Lock()
+
+
+def get_sandbox_pool(dataset_fingerprint: str, df: pd.DataFrame) -> SandboxPool:
+    """
+    Return the process-wide sandbox pool for a dataset, starting it if needed.
+
+    At most SANDBOX_MAX_DATASETS pools keep running workers; the least recently used
+    one is shut down beyond that (it restarts on its next execution). Its in-flight
+    runs finish first (see SandboxPool.shutdown).
+
+    Args:
+        dataset_fingerprint: Identity of the dataset (see fingerprint.py)
+        df: The dataset; workers attach its DatasetStore copy (stored here if missing)
+
+    Returns:
+        SandboxPool
+    """
+    evicted = []
+    with _sandbox_lock:
+        pool = _sandbox_pools.get(dataset_fingerprint)
+        if pool is None:
+            pool = SandboxPool(df, dataset_path=get_dataset_store().ensure(dataset_fingerprint, df))
+            _sandbox_pools[dataset_fingerprint] = pool
+        _sandbox_pools.move_to_end(dataset_fingerprint)
+        while len(_sandbox_pools) > SANDBOX_MAX_DATASETS:
+            _, old = _sandbox_pools.popitem(last=False)
+            evicted.append(old)
+    for old in evicted:
+        old.shutdown()
+    pool.start()
+    return pool
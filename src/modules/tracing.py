@@ -0,0 +1,439 @@
+# Per-request tracing: stage latencies, LLM calls and tokens, JSON lines and Prometheus export
+
+import asyncio
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueListener, RotatingFileHandler
+from typing import Any, Deque, Dict, Iterator, List, Optional
+import litellm
+from langchain_core.callbacks import BaseCallbackHandler
+from .llm_cache import get_llm_cache
+from .logging_config import LOG_DIR, get_logger
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", os.path.join(LOG_DIR, "traces.jsonl"))
+TRACE_METRICS_PATH = os.getenv("TRACE_METRICS_PATH", os.path.join(LOG_DIR, "metrics.prom"))
+# The metrics file is rewritten at most this often, by a background thread
+TRACE_METRICS_INTERVAL_SECONDS = float(os.getenv("TRACE_METRICS_INTERVAL_SECONDS", "10"))
+TRACE_LOG_MAX_BYTES = 10 * 1024 * 1024
+TRACE_LOG_BACKUP_COUNT = 5
+
+# Samples kept per stage for quantiles
+TRACE_QUANTILE_WINDOW = 2048
+TRACE_QUANTILES = (0.5, 0.95, 0.99)
+TRACE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+METRIC_PREFIX = "chatwithcsv"
+
+
+class RequestTrace:
+    """Timings and LLM usage of one request. Safe to update from tool threads."""
+
+    def __init__(self, name: str, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes: Dict[str, Any] = dict(attributes)
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration_seconds: Optional[float] = None
+        self.stages: List[Dict] = []
+        self.llm_calls: List[Dict] = []
+        self.agent_iterations = 0
+        self.marks: Dict[str, float] = {}
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def add_stage(self, name: str, start: float, duration: float) -> None:
+        with self._lock:
+            self.stages.append({"name": name, "start": round(start, 6), "duration": round(duration, 6)})
+
+    def record_llm_call(
+        self,
+        source: str,
+        model: Optional[str],
+        duration: float,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        cached: bool = False,
+    ) -> None:
+        with self._lock:
+            self.llm_calls.append({
+                "source": source,
+                "model": model,
+                "duration": round(duration, 6),
+                "prompt_tokens": int(prompt_tokens or 0),
+                "completion_tokens": int(completion_tokens or 0),
+                "cached": cached,
+            })
+
+    def add_iteration(self) -> None:
+        with self._lock:
+            self.agent_iterations += 1
+
+    def mark(self, name: str) -> None:
+        """Record the first time an event happened (e.g. first streamed token)."""
+        with self._lock:
+            self.marks.setdefault(name, round(self.elapsed(), 6))
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "trace_id": self.trace_id,
+                "name": self.name,
+                "attributes": self.attributes,
+                "started_at": self.started_at,
+                "duration_seconds": self.duration_seconds,
+                "status": self.status,
+                "error": self.error,
+                "stages": list(self.stages),
+                "marks": dict(self.marks),
+                "llm_call_count": len(self.llm_calls),
+                "prompt_tokens": sum(c["prompt_tokens"] for c in self.llm_calls),
+                "completion_tokens": sum(c["completion_tokens"] for c in self.llm_calls),
+                "agent_iterations": self.agent_iterations,
+                "llm_calls": list(self.llm_calls),
+            }
+
+
+current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("chatwithcsv_trace", default=None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a block as a stage of the current request (no-op outside a trace)."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = trace.elapsed()
+    try:
+        yield
+    finally:
+        trace.add_stage(name, start, trace.elapsed() - start)
+
+
+def _usage_from_response(response) -> Dict[str, int]:
+    usage = getattr(response, "usage", None)
+    if usage is None and isinstance(response, dict):
+        usage = response.get("usage")
+    if usage is None:
+        return {"prompt_tokens": 0, "completion_tokens": 0}
+    get = usage.get if isinstance(usage, dict) else lambda key, default=0: getattr(usage, key, default)
+    return {"prompt_tokens": get("prompt_tokens", 0) or 0, "completion_tokens": get("completion_tokens", 0) or 0}
+
+
+def record_completion(source: str, kwargs: Dict, response, duration: float, cached: bool = False) -> None:
+    """Record a litellm completion on the current trace."""
+    trace = current_trace.get()
+    if trace is None:
+        return
+    trace.record_llm_call(source, kwargs.get("model"), duration, cached=cached, **_usage_from_response(response))
+
+
+def traced_completion(source: str, **kwargs):
+    """litellm.completion through the shared LLM cache, recorded on the current trace under `source`."""
+    cache = get_llm_cache()
+    started = time.perf_counter()
+    with stage(f"llm:{source}"):
+        response = cache.get_completion(kwargs) if cache else None
+        cached = response is not None
+        if not cached:
+            response = litellm.completion(**kwargs)
+            if cache:
+                cache.set_completion(kwargs, response)
+    record_completion(source, kwargs, response, time.perf_counter() - started, cached=cached)
+    return response
+
+
+async def atraced_completion(source: str, **kwargs):
+    """litellm.acompletion through the shared LLM cache, recorded on the current trace under `source`."""
+    cache = get_llm_cache()
+    started = time.perf_counter()
+    with stage(f"llm:{source}"):
+        # SQLite calls can wait on another process's write lock; keep them off the event loop
+        response = await asyncio.to_thread(cache.get_completion, kwargs) if cache else None
+        cached = response is not None
+        if not cached:
+            response = await litellm.acompletion(**kwargs)
+            if cache:
+                await asyncio.to_thread(cache.set_completion, kwargs, response)
+    record_completion(source, kwargs, response, time.perf_counter() - started, cached=cached)
+    return response
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records agent LLM calls (tokens, latency), iterations and tool calls on a trace."""
+
+    def __init__(self, trace: RequestTrace, source: str = "agent"):
+        self.trace = trace
+        self.source = source
+        self._starts: Dict[Any, float] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._starts[run_id] = self.trace.elapsed()
+        # Each agent iteration is one model call
+        self.trace.add_iteration()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._starts[run_id] = self.trace.elapsed()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start = self._starts.pop(run_id, None)
+        if start is None:
+            return
+        duration = self.trace.elapsed() - start
+        prompt_tokens = completion_tokens = 0
+        model = None
+        cached = False
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                metadata = getattr(message, "usage_metadata", None) or {}
+                prompt_tokens += metadata.get("input_tokens", 0)
+                completion_tokens += metadata.get("output_tokens", 0)
+                response_metadata = getattr(message, "response_metadata", None) or {}
+                model = model or response_metadata.get("model_name")
+                # Set by LangChainLLMCache on replayed generations
+                cached = cached or bool(response_metadata.get("cache_hit"))
+        if not (prompt_tokens or completion_tokens) and response.llm_output:
+            token_usage = response.llm_output.get("token_usage") or {}
+            prompt_tokens = token_usage.get("prompt_tokens", 0)
+            completion_tokens = token_usage.get("completion_tokens", 0)
+            model = model or response.llm_output.get("model_name")
+        self.trace.add_stage(f"llm:{self.source}", start, duration)
+        self.trace.record_llm_call(self.source, model, duration, prompt_tokens, completion_tokens, cached=cached)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._starts.pop(run_id, None)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._starts[run_id] = self.trace.elapsed()
+
+    def on_tool_end(self, output, *, run_id, name: str = None, **kwargs):
+        self._end_tool(run_id, name or kwargs.get("name"))
+
+    def on_tool_error(self, error, *, run_id, name: str = None, **kwargs):
+        self._end_tool(run_id, name or kwargs.get("name"))
+
+    def _end_tool(self, run_id, name: Optional[str]) -> None:
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            self.trace.add_stage(f"tool:{name or 'unknown'}", start, self.trace.elapsed() - start)
+
+
+class _Quantiles:
+    def __init__(self, window: int = TRACE_QUANTILE_WINDOW):
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.buckets = [0] * len(TRACE_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(TRACE_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+    def quantile(self, q: float) -> float:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _JSONLine:
+    """A trace rendered as JSON only when its record is written, on the listener thread."""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: Dict):
+        self.data = data
+
+    def __str__(self) -> str:
+        return json.dumps(self.data, default=str)
+
+
+class TraceRecorder:
+    """Aggregates finished traces and exports them.
+
+    Every trace is appended to a rotating JSON lines file; stage latencies feed
+    histograms (cumulative buckets) and quantiles over a sliding window, rendered
+    in the Prometheus text format. File I/O stays off the request path: trace
+    lines go through a queue to a listener thread (as application logs do), and
+    the metrics file is rewritten every metrics_interval seconds when it changed.
+    """
+
+    def __init__(
+        self,
+        log_path: str = TRACE_LOG_PATH,
+        metrics_path: Optional[str] = TRACE_METRICS_PATH,
+        metrics_interval: float = TRACE_METRICS_INTERVAL_SECONDS,
+    ):
+        self.logger = get_logger(__name__)
+        self.log_path = log_path
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self._stages: Dict[str, _Quantiles] = {}
+        self._counters = {"requests": 0, "errors": 0, "llm_calls": 0, "cached_llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._iterations = _Quantiles()
+        self._lock = threading.Lock()
+
+        handler = RotatingFileHandler(log_path, maxBytes=TRACE_LOG_MAX_BYTES, backupCount=TRACE_LOG_BACKUP_COUNT, delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        self._listener = QueueListener(self._queue, handler)
+        self._listener.start()
+        self._metrics_dirty = False
+        self._closed = threading.Event()
+        if metrics_path:
+            threading.Thread(target=self._metrics_loop, name="trace-metrics", daemon=True).start()
+        atexit.register(self.close)
+
+    def record(self, trace: RequestTrace) -> None:
+        data = trace.to_dict()
+        with self._lock:
+            self._counters["requests"] += 1
+            self._counters["errors"] += data["status"] != "ok"
+            self._counters["llm_calls"] += data["llm_call_count"]
+            self._counters["cached_llm_calls"] += sum(1 for c in data["llm_calls"] if c["cached"])
+            self._counters["prompt_tokens"] += data["prompt_tokens"]
+            self._counters["completion_tokens"] += data["completion_tokens"]
+            self._iterations.observe(data["agent_iterations"])
+            self._observe(f"request:{data['name']}", data["duration_seconds"] or 0.0)
+            # Stages that ran several times in one request (tool calls, LLM calls) count once each
+            for item in data["stages"]:
+                self._observe(item["name"], item["duration"])
+            for name, offset in data["marks"].items():
+                self._observe(f"mark:{name}", offset)
+            self._metrics_dirty = True
+        if not self._closed.is_set():
+            self._queue.put(logging.makeLogRecord({
+                "name": __name__, "levelno": logging.INFO, "levelname": "INFO", "msg": "%s", "args": (_JSONLine(data),),
+            }))
+
+    def _metrics_loop(self) -> None:
+        while not self._closed.wait(self.metrics_interval):
+            self.flush_metrics()
+
+    def flush_metrics(self) -> None:
+        """Rewrite the metrics file if traces were recorded since the last write."""
+        with self._lock:
+            dirty, self._metrics_dirty = self._metrics_dirty, False
+        if not dirty or not self.metrics_path:
+            return
+        try:
+            self.write_prometheus(self.metrics_path)
+        except Exception as e:
+            self.logger.warning("Could not write trace metrics: %s", e)
+
+    def close(self) -> None:
+        """Write pending trace lines and the final metrics, and stop the background threads."""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.flush_metrics()
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+
+    def _observe(self, name: str, value: float) -> None:
+        self._stages.setdefault(name, _Quantiles()).observe(value)
+
+    def prometheus_text(self) -> str:
+        """Render counters, stage histograms and p50/p95/p99 in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for key, value in self._counters.items():
+                metric = f"{METRIC_PREFIX}_{key}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {value}")
+
+            histogram = f"{METRIC_PREFIX}_stage_duration_seconds"
+            summary = f"{METRIC_PREFIX}_stage_latency_seconds"
+            lines.append(f"# TYPE {histogram} histogram")
+            for name, stats in sorted(self._stages.items()):
+                label = name.replace("\\", "\\\\").replace('"', '\\"')
+                for bound, count in zip(TRACE_BUCKETS, stats.buckets):
+                    lines.append(f'{histogram}_bucket{{stage="{label}",le="{bound}"}} {count}')
+                lines.append(f'{histogram}_bucket{{stage="{label}",le="+Inf"}} {stats.count}')
+                lines.append(f'{histogram}_sum{{stage="{label}"}} {stats.total:.6f}')
+                lines.append(f'{histogram}_count{{stage="{label}"}} {stats.count}')
+            lines.append(f"# TYPE {summary} summary")
+            for name, stats in sorted(self._stages.items()):
+                label = name.replace("\\", "\\\\").replace('"', '\\"')
+                for q in TRACE_QUANTILES:
+                    lines.append(f'{summary}{{stage="{label}",quantile="{q}"}} {stats.quantile(q):.6f}')
+                lines.append(f'{summary}_sum{{stage="{label}"}} {stats.total:.6f}')
+                lines.append(f'{summary}_count{{stage="{label}"}} {stats.count}')
+
+            iterations = f"{METRIC_PREFIX}_agent_iterations"
+            lines.append(f"# TYPE {iterations} summary")
+            for q in TRACE_QUANTILES:
+                lines.append(f'{iterations}{{quantile="{q}"}} {self._iterations.quantile(q)}')
+            lines.append(f"{iterations}_sum {self._iterations.total}")
+            lines.append(f"{iterations}_count {self._iterations.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+_trace_recorder = None
+_trace_recorder_lock = threading.Lock()
+
+
+def get_trace_recorder() -> TraceRecorder:
+    """Return the process-wide TraceRecorder."""
+    global _trace_recorder
+    with _trace_recorder_lock:
+        if _trace_recorder is None:
+            _trace_recorder = TraceRecorder()
+        return _trace_recorder
+
+
+@contextmanager
+def start_trace(name: str, **attributes) -> Iterator[Optional[RequestTrace]]:
+    """
+    Trace a request: stages, LLM calls and tool calls inside the block are recorded
+    on it, and it is exported when the block exits.
+
+    Args:
+        name: Kind of request (e.g. "chat")
+        **attributes: Extra fields stored with the trace
+
+    Yields:
+        RequestTrace, or None when TRACING_ENABLED is false
+    """
+    if not TRACING_ENABLED:
+        yield None
+        return
+    trace = RequestTrace(name, **attributes)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.status = "error"
+        trace.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        trace.duration_seconds = round(trace.elapsed(), 6)
+        current_trace.reset(token)
+        get_trace_recorder().record(trace)
@@ -0,0 +1,192 @@
+# Parse-once cache for uploaded CSV files
+
+import glob
+import json
+import os
+import threading
+from typing import Dict, Optional, Tuple
+import pandas as pd
+from .cache import LRUCache
+from .dataset_store import DatasetStore, get_dataset_store
+from .fingerprint import fingerprint_file, fingerprint_stream
+from .ingestion import read_csv_optimized
+from .logging_config import get_logger
+
+UPLOAD_CACHE_DIR = os.getenv("UPLOAD_CACHE_DIR", os.path.join(".cache", "uploads"))
+
+# Parsed DataFrames kept in process memory, shared by every session
+UPLOAD_CACHE_MAX_IN_MEMORY = 4
+
+# Ingestion reports kept on disk; the datasets they describe are bounded by the DatasetStore
+UPLOAD_CACHE_MAX_SNAPSHOTS = int(os.getenv("UPLOAD_CACHE_MAX_SNAPSHOTS", "256"))
+
+
+class UploadCache:
+    """Parses each distinct CSV once, keyed by the fingerprint of its raw bytes.
+
+    Parsed frames are handed to the DatasetStore, and sessions get its read-only,
+    memory-mapped copy. Streamlit reruns, other users of the same file and server
+    restarts attach to that copy instead of re-parsing the CSV. The ingestion report
+    is kept next to it in the cache directory. Without pyarrow, the parsed frame is
+    shared through the in-memory layer only.
+
+    Reports whose dataset the store has evicted are deleted after each write. The
+    remaining reports are capped at max_snapshots, least recently used first.
+
+    Every caller gets its own shallow copy of the frame: the data is shared, but
+    generated code that adds columns or edits in place (copy-on-write) only changes
+    that caller's copy.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = UPLOAD_CACHE_DIR,
+        max_in_memory: int = UPLOAD_CACHE_MAX_IN_MEMORY,
+        store: Optional[DatasetStore] = None,
+        max_snapshots: int = UPLOAD_CACHE_MAX_SNAPSHOTS,
+    ):
+        self.logger = get_logger(__name__)
+        self.cache_dir = cache_dir
+        self.max_snapshots = max_snapshots
+        self.memory = LRUCache(max_size=max_in_memory)
+        self.store = store or get_dataset_store()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _report_path(self, fingerprint: str) -> str:
+        return os.path.join(self.cache_dir, f"{fingerprint}.json")
+
+    def _load_snapshot(self, fingerprint: str) -> Optional[Tuple[pd.DataFrame, Dict]]:
+        report_path = self._report_path(fingerprint)
+        if not os.path.exists(report_path):
+            return None
+        df = self.store.attach(fingerprint)
+        if df is None:
+            return None
+        try:
+            with open(report_path, "r", encoding="utf-8") as f:
+                report = json.load(f)
+            # The mtime records last use, for pruning
+            os.utime(report_path)
+            return df, report
+        except Exception as e:
+            self.logger.warning("Could not read snapshot for %s: %s", fingerprint, e)
+            return None
+
+    def _write_snapshot(self, fingerprint: str, df: pd.DataFrame, report: Dict) -> pd.DataFrame:
+        """Store the parsed frame and its report; returns the shared copy to use instead of df."""
+        shared = self.store.put(fingerprint, df)
+        if shared is df:
+            return df
+        report_path = self._report_path(fingerprint)
+        try:
+            # Write to a temporary name first so concurrent readers never see a partial file
+            with open(report_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(report, f)
+            os.replace(report_path + ".tmp", report_path)
+        except Exception as e:
+            self.logger.warning("Could not write snapshot report for %s: %s", fingerprint, e)
+        self.prune(keep=fingerprint)
+        return shared
+
+    def prune(self, keep: Optional[str] = None) -> int:
+        """
+        Delete reports of evicted datasets, then the least recently used beyond max_snapshots.
+
+        Args:
+            keep: Fingerprint whose report is never deleted
+
+        Returns:
+            int: Number of reports deleted
+        """
+        reports = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*.json")):
+            fingerprint = os.path.basename(path)[: -len(".json")]
+            try:
+                reports.append((os.path.getmtime(path), fingerprint, path))
+            except OSError:
+                continue
+        reports.sort()
+        doomed = [r for r in reports if r[1] != keep and not self.store.contains(r[1])]
+        live = [r for r in reports if r not in doomed]
+        overflow = len(live) - self.max_snapshots
+        doomed += [r for r in live if r[1] != keep][:max(overflow, 0)]
+        for _, _, path in doomed:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if doomed:
+            self.logger.info("Pruned %s upload snapshot reports", len(doomed))
+        return len(doomed)
+
+    def get(self, fingerprint: str) -> Optional[Tuple[pd.DataFrame, Dict]]:
+        """
+        Return an already parsed dataset by fingerprint, without a source to parse.
+
+        Args:
+            fingerprint: Fingerprint returned by load
+
+        Returns:
+            tuple: (DataFrame, ingestion report), or None if it was never loaded or was evicted
+        """
+        cached = self.memory.get(fingerprint)
+        if cached is None:
+            with self._lock:
+                cached = self.memory.get(fingerprint)
+                if cached is None:
+                    cached = self._load_snapshot(fingerprint)
+                    if cached is not None:
+                        self.memory.set(fingerprint, cached)
+        if cached is None:
+            return None
+        return cached[0].copy(deep=False), cached[1]
+
+    def load(self, source, fingerprint: str = None) -> Tuple[pd.DataFrame, str, Dict]:
+        """
+        Return the parsed DataFrame for a CSV, parsing it only on first sight.
+
+        Args:
+            source: Path or binary file-like object with the CSV contents
+            fingerprint: Precomputed fingerprint of the raw bytes, if already known
+
+        Returns:
+            tuple: (DataFrame, fingerprint, ingestion report); the DataFrame is the caller's own shallow copy
+        """
+        if fingerprint is None:
+            fingerprint = fingerprint_stream(source) if hasattr(source, "read") else fingerprint_file(source)
+
+        cached = self.memory.get(fingerprint)
+        if cached is not None:
+            self.logger.debug("Upload cache hit (memory) for %s", fingerprint)
+            return cached[0].copy(deep=False), fingerprint, cached[1]
+
+        with self._lock:
+            cached = self.memory.get(fingerprint)
+            if cached is not None:
+                return cached[0].copy(deep=False), fingerprint, cached[1]
+
+            snapshot = self._load_snapshot(fingerprint)
+            if snapshot is not None:
+                self.logger.info("Upload cache hit (snapshot) for %s", fingerprint)
+                df, report = snapshot
+            else:
+                self.logger.info("Parsing CSV for %s", fingerprint)
+                df, report = read_csv_optimized(source)
+                # Drop the private parsed copy in favour of the memory-mapped one
+                df = self._write_snapshot(fingerprint, df, report)
+            self.memory.set(fingerprint, (df, report))
+        return df.copy(deep=False), fingerprint, report
+
+
+_upload_cache = None
+_upload_cache_lock = threading.Lock()
+
+
+def get_upload_cache() -> UploadCache:
+    """Return the process-wide UploadCache."""
+    global _upload_cache
+    with _upload_cache_lock:
+        if _upload_cache is None:
+            _upload_cache = UploadCache()
+        return _upload_cache
@@ -0,0 +1,384 @@
+# Headless HTTP API for ChatwithCSV (ASGI, run with `python -m src.server`)
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import threading
+import uuid
+from typing import AsyncIterator, Dict, List, Optional
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+from .constants.prompts import CHIT_CHAT_RESPONSES
+from .modules.agent_langchain import ChatwithCSV
+from .modules.agent_pool import get_agent_pool
+from .modules.cache import LRUCache
+from .modules.classifier_agent import ClassifierAgent, normalize_message
+from .modules.fingerprint import fingerprint_bytes
+from .modules.logging_config import get_logger, payload
+from .modules.pipeline import astream_answer
+from .modules.tracing import get_trace_recorder, start_trace
+from .modules.upload_cache import get_upload_cache
+
+load_dotenv()
+
+# Questions answered at once; beyond that up to SERVER_MAX_QUEUED wait, and the rest get 429
+SERVER_MAX_CONCURRENCY = int(os.getenv("SERVER_MAX_CONCURRENCY", "8"))
+SERVER_MAX_QUEUED = int(os.getenv("SERVER_MAX_QUEUED", "16"))
+SERVER_MAX_UPLOAD_MB = int(os.getenv("SERVER_MAX_UPLOAD_MB", "512"))
+# Charts are kept for later retrieval by id
+SERVER_MAX_CHARTS = int(os.getenv("SERVER_MAX_CHARTS", "1024"))
+SERVER_RETRY_AFTER_SECONDS = 2
+
+DEFAULT_CHIT_CHAT_RESPONSE = "Hello! How can I help you with your data analysis today?"
+
+logger = get_logger(__name__)
+
+
+class AdmissionControl:
+    """Bounds concurrent work and the queue in front of it.
+
+    enter() refuses immediately when max_active requests run and max_queued
+    more are already waiting, so overload turns into fast 429s instead of an
+    unbounded backlog of slow requests.
+    """
+
+    def __init__(self, max_active: int = SERVER_MAX_CONCURRENCY, max_queued: int = SERVER_MAX_QUEUED):
+        self.max_active = max(1, max_active)
+        self.max_queued = max(0, max_queued)
+        self._semaphore = asyncio.Semaphore(self.max_active)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def saturated(self) -> bool:
+        return self.active + self.waiting >= self.max_active + self.max_queued
+
+    async def enter(self) -> bool:
+        """Take a slot, waiting in the queue if needed; False (and nothing taken) when saturated."""
+        if self.saturated():
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return True
+
+    def leave(self) -> None:
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self) -> Dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "max_active": self.max_active,
+            "max_queued": self.max_queued,
+        }
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """StreamingResponse that returns its admission slot however the response ends.
+
+    Releasing from the body generator is not enough: when the client disconnects
+    before the body is iterated, the generator never starts and its finally never runs.
+    """
+
+    def __init__(self, content, admission: AdmissionControl, **kwargs):
+        super().__init__(content, **kwargs)
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.admission.leave()
+
+
+class ChatService:
+    """Datasets, agents and charts behind the HTTP routes.
+
+    Agents come from the process-wide AgentPool, so every request on a dataset
+    reuses the same ChatwithCSV. Datasets are parsed once through the UploadCache
+    and looked up by fingerprint.
+    """
+
+    def __init__(self, api_key: str, max_concurrency: int = SERVER_MAX_CONCURRENCY, max_queued: int = SERVER_MAX_QUEUED):
+        self.logger = get_logger(__name__)
+        self.api_key = api_key
+        self.classifier = ClassifierAgent(api_key=api_key)
+        self.admission = AdmissionControl(max_concurrency, max_queued)
+        self.charts = LRUCache(max_size=SERVER_MAX_CHARTS)
+        self.names: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def add_dataset(self, data: bytes, name: Optional[str] = None) -> Dict:
+        """Parse (or find) an uploaded CSV; runs in a worker thread."""
+        fingerprint = fingerprint_bytes(data)
+        df, fingerprint, report = get_upload_cache().load(io.BytesIO(data), fingerprint=fingerprint)
+        with self._lock:
+            self.names[fingerprint] = name or self.names.get(fingerprint) or f"{fingerprint[:12]}.csv"
+        return self.describe_dataset(fingerprint, df, report)
+
+    def get_dataset(self, fingerprint: str):
+        return get_upload_cache().get(fingerprint)
+
+    def describe_dataset(self, fingerprint: str, df, report: Dict) -> Dict:
+        return {
+            "dataset_id": fingerprint,
+            "name": self.names.get(fingerprint),
+            "rows": int(len(df)),
+            "columns": [str(c) for c in df.columns],
+            "dtypes": {str(c): str(t) for c, t in df.dtypes.items()},
+            "memory_bytes": (report or {}).get("memory_after_bytes"),
+        }
+
+    def store_chart(self, figure) -> str:
+        chart_id = uuid.uuid4().hex
+        self.charts.set(chart_id, figure.to_json())
+        return chart_id
+
+    def serialize_result(self, question: str, classification: Dict, result: Optional[Dict]) -> Dict:
+        """JSON body for an answer; figures are stored and referenced by chart_id."""
+        if result is None:
+            answer = CHIT_CHAT_RESPONSES.get(normalize_message(question), DEFAULT_CHIT_CHAT_RESPONSE)
+            return {"answer": answer, "message_type": "chit_chat", "classification": classification}
+        figure = result.get("visualization_figure")
+        query_output = result.get("query_output")
+        return {
+            "answer": result.get("answer") or "I don't know",
+            "message_type": (classification or {}).get("message_type", "data_query"),
+            "classification": classification,
+            "query_executed": result.get("query_executed"),
+            "query_output": None if query_output is None else str(query_output),
+            "plotly_code": result.get("plotly_code"),
+            "chart_id": self.store_chart(figure) if figure is not None else None,
+            "cached": bool(result.get("cached", False)),
+            "error": result.get("error"),
+        }
+
+    async def astream(self, fingerprint: str, question: str, chat_history: List[Dict], speculative: bool) -> AsyncIterator[Dict]:
+        """
+        Answer a question on a dataset, yielding the pipeline's progress events.
+
+        Args:
+            fingerprint: Dataset id returned by the upload route
+            question: The user's question
+            chat_history: Previous {"role", "content"} messages
+            speculative: Run classification and the agent concurrently
+
+        Yields:
+            dict events; the last one is {"type": "result", "result": <serialized answer>}
+        """
+        dataset = self.get_dataset(fingerprint)
+        if dataset is None:
+            raise KeyError(fingerprint)
+        df, report = dataset
+        pool = get_agent_pool()
+        leases = []
+
+        async def get_chatbot(needs_visualization: bool):
+            chatbot = await pool.aacquire(
+                fingerprint,
+                needs_visualization,
+                lambda: ChatwithCSV(
+                    api_key=self.api_key,
+                    df=df,
+                    needs_visualization=needs_visualization,
+                    dataset_fingerprint=fingerprint,
+                ),
+                dataset_bytes=(report or {}).get("memory_after_bytes", 0),
+            )
+            leases.append((needs_visualization, chatbot))
+            return chatbot
+
+        classification = None
+        try:
+            with start_trace("api", speculative=speculative, dataset=fingerprint):
+                async for event in astream_answer(self.classifier, get_chatbot, question, chat_history, speculative):
+                    if event["type"] == "classification":
+                        classification = event["classification"]
+                        yield event
+                    elif event["type"] == "result":
+                        yield {"type": "result", "result": self.serialize_result(question, classification, event["result"])}
+                    else:
+                        yield event
+        finally:
+            for needs_visualization, chatbot in leases:
+                pool.release(fingerprint, needs_visualization, chatbot)
+
+
+def _service(request: Request) -> ChatService:
+    return request.app.state.service
+
+
+def _error(status: int, message: str, **headers) -> JSONResponse:
+    return JSONResponse({"error": message}, status_code=status, headers=headers or None)
+
+
+def _saturated() -> JSONResponse:
+    return _error(429, "Server is at capacity, retry later", **{"Retry-After": str(SERVER_RETRY_AFTER_SECONDS)})
+
+
+async def health(request: Request) -> Response:
+    return JSONResponse({"status": "ok", "admission": _service(request).admission.stats()})
+
+
+async def upload_dataset(request: Request) -> Response:
+    """POST /datasets: raw CSV bytes as the body (e.g. curl --data-binary @file.csv), ?name= optional."""
+    service = _service(request)
+    max_bytes = SERVER_MAX_UPLOAD_MB * 1024 * 1024
+    if int(request.headers.get("content-length") or 0) > max_bytes:
+        return _error(413, f"Upload larger than {SERVER_MAX_UPLOAD_MB} MB")
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            return _error(413, f"Upload larger than {SERVER_MAX_UPLOAD_MB} MB")
+        chunks.append(chunk)
+    if not size:
+        return _error(400, "Empty upload; send the CSV file as the request body")
+    try:
+        dataset = await asyncio.to_thread(service.add_dataset, b"".join(chunks), request.query_params.get("name"))
+    except Exception as e:
+        logger.warning("Could not parse uploaded CSV: %s", e)
+        return _error(400, f"Could not parse CSV: {e}")
+    logger.info("Dataset %s uploaded (%s rows)", dataset["dataset_id"], dataset["rows"])
+    return JSONResponse(dataset, status_code=201)
+
+
+async def get_dataset(request: Request) -> Response:
+    service = _service(request)
+    fingerprint = request.path_params["dataset_id"]
+    dataset = service.get_dataset(fingerprint)
+    if dataset is None:
+        return _error(404, "Unknown dataset")
+    return JSONResponse(service.describe_dataset(fingerprint, *dataset))
+
+
+def _sse(event: Dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+
+async def ask(request: Request) -> Response:
+    """
+    POST /datasets/{dataset_id}/ask with {"question", "chat_history"?, "speculative"?, "stream"?}.
+
+    Returns the answer as JSON, or as server-sent events (classification, token,
+    tool_start, tool_end, result) when "stream" is true or the client accepts
+    text/event-stream.
+    """
+    service = _service(request)
+    fingerprint = request.path_params["dataset_id"]
+    try:
+        body = await request.json()
+    except Exception:
+        return _error(400, "Body must be JSON")
+    question = str(body.get("question") or "").strip()
+    if not question:
+        return _error(400, "'question' is required")
+    if service.get_dataset(fingerprint) is None:
+        return _error(404, "Unknown dataset")
+    chat_history = body.get("chat_history") or []
+    speculative = bool(body.get("speculative", True))
+    stream = bool(body.get("stream")) or "text/event-stream" in request.headers.get("accept", "")
+
+    if not await service.admission.enter():
+        return _saturated()
+
+    if stream:
+        async def events() -> AsyncIterator[str]:
+            try:
+                async for event in service.astream(fingerprint, question, chat_history, speculative):
+                    yield _sse(event)
+            except Exception as e:
+                logger.error("Streaming answer failed: %s", e)
+                yield _sse({"type": "error", "error": str(e)})
+
+        return AdmittedStreamingResponse(
+            events(), service.admission, media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+        )
+
+    try:
+        result = None
+        async for event in service.astream(fingerprint, question, chat_history, speculative):
+            if event["type"] == "result":
+                result = event["result"]
+        logger.debug("Answered %s: %s", payload(question, 100), payload(result))
+        return JSONResponse(result)
+    except Exception as e:
+        import traceback
+        logger.error(traceback.format_exc())
+        return _error(500, f"Could not answer the question: {e}")
+    finally:
+        service.admission.leave()
+
+
+async def get_chart(request: Request) -> Response:
+    """GET /charts/{chart_id}: the Plotly figure JSON of an answer."""
+    figure_json = _service(request).charts.get(request.path_params["chart_id"])
+    if figure_json is None:
+        return _error(404, "Unknown or expired chart")
+    return Response(figure_json, media_type="application/json")
+
+
+async def metrics(request: Request) -> Response:
+    """Prometheus metrics: request traces plus admission and agent pool gauges."""
+    service = _service(request)
+    lines = [get_trace_recorder().prometheus_text().rstrip("\n")]
+    for name, value in service.admission.stats().items():
+        lines.append(f"chatwithcsv_server_{name} {value}")
+    for name, value in get_agent_pool().stats().items():
+        lines.append(f"chatwithcsv_agent_pool_{name} {value}")
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+def create_app(api_key: Optional[str] = None, max_concurrency: int = SERVER_MAX_CONCURRENCY, max_queued: int = SERVER_MAX_QUEUED) -> Starlette:
+    """
+    Build the ASGI app.
+
+    Args:
+        api_key: OpenAI API key (defaults to OPENAI_API_KEY); point OPENAI_BASE_URL at a
+            stub server such as benchmarks/stub_llm_server.py to run without OpenAI
+        max_concurrency: Questions answered at once
+        max_queued: Questions waiting for a slot before new ones get 429
+
+    Returns:
+        Starlette: The application
+    """
+    routes = [
+        Route("/healthz", health, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/datasets", upload_dataset, methods=["POST"]),
+        Route("/datasets/{dataset_id}", get_dataset, methods=["GET"]),
+        Route("/datasets/{dataset_id}/ask", ask, methods=["POST"]),
+        Route("/charts/{chart_id}", get_chart, methods=["GET"]),
+    ]
+    app = Starlette(routes=routes)
+    app.state.service = ChatService(api_key or os.getenv("OPENAI_API_KEY", ""), max_concurrency, max_queued)
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="ChatwithCSV HTTP API")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVER_PORT", "8000")))
+    parser.add_argument("--max-concurrency", type=int, default=SERVER_MAX_CONCURRENCY)
+    parser.add_argument("--max-queued", type=int, default=SERVER_MAX_QUEUED)
+    args = parser.parse_args()
+    app = create_app(max_concurrency=args.max_concurrency, max_queued=args.max_queued)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
+
+
+if __name__ == "__main__":
+    main()